@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Estimates the altitude and ascent rate of the payload from the barometer and the accelerometer
+'''
+
+import collections
+import logging
+import math
+import threading
+
+import numpy
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Scheduler import PeriodicTask
+
+logger = logging.getLogger('polaroid.altitude')
+
+ISA_TROPOPAUSE_ALTITUDE = 11000.0           # Altitude in metres of the top of the troposphere
+ISA_STRATOSPHERE_SCALE_HEIGHT = 6341.62     # Scale height in metres of the lower stratosphere
+STANDARD_GRAVITY = 9.80665                  # Metres per second squared in 1g
+
+BAROMETER_CHANNEL = flight_recorder.channel('barometer', ('pressure', 'altitude', 'ascent_rate'))
+
+AltitudeEstimate = collections.namedtuple('AltitudeEstimate', ('time', 'altitude', 'ascent_rate', 'pressure',
+                                                               'burst'))
+
+
+def pressure_at_altitude(altitude, sea_level_pressure=r.DEFAULT_SEA_LEVEL_PRESSURE):
+    ''' Returns the atmospheric pressure (in millibars) at an altitude using the International Standard Atmosphere '''
+
+    altitude = max(altitude, 0.0)
+    if altitude <= ISA_TROPOPAUSE_ALTITUDE:
+        return sea_level_pressure * (1 - 2.25577e-5 * altitude) ** 5.25588
+
+    tropopause_pressure = sea_level_pressure * (1 - 2.25577e-5 * ISA_TROPOPAUSE_ALTITUDE) ** 5.25588
+    return tropopause_pressure * math.exp(-(altitude - ISA_TROPOPAUSE_ALTITUDE) / ISA_STRATOSPHERE_SCALE_HEIGHT)
+
+
+def altitude_at_pressure(pressure, sea_level_pressure=r.DEFAULT_SEA_LEVEL_PRESSURE):
+    ''' Returns the altitude (in metres) at which the International Standard Atmosphere has the given pressure '''
+
+    tropopause_pressure = pressure_at_altitude(ISA_TROPOPAUSE_ALTITUDE, sea_level_pressure)
+    if pressure >= tropopause_pressure:
+        return (1 - (pressure / float(sea_level_pressure)) ** (1 / 5.25588)) / 2.25577e-5
+    return ISA_TROPOPAUSE_ALTITUDE - ISA_STRATOSPHERE_SCALE_HEIGHT * math.log(pressure / tropopause_pressure)
+
+
+class AltitudeEstimator(object):
+    '''
+    Tracks the altitude and ascent rate of the payload with a Kalman filter
+
+    Each barometer reading passes through a median filter, so that a single spurious reading can't move the estimate,
+    and is converted to an altitude with the barometric formula. The filter's state is the altitude, the ascent rate
+    and the bias of the measured vertical acceleration; it is predicted forward with the vertical acceleration
+    measured by the IMU sampler (when one is given), less the bias, and corrected with the barometric altitude. The
+    uncertainty of the barometric altitude grows with height, as each millibar spans more metres in thin air, so the
+    filter leans more on its prediction high in the flight.
+
+    The measured acceleration is biased one way, by the centripetal acceleration of the payload swinging and spinning
+    under the balloon and by the scale error of the accelerometer, and integrating the bias would drift the ascent
+    rate. The bias is estimated from the difference between the two, drifting slowly as the swing changes.
+
+    The balloon is taken to have burst once the payload is falling and has dropped r.ALTITUDE_BURST_DROP metres below
+    the highest altitude reached.
+    '''
+
+    def __init__(self, sense, imu_buffer=None, period=r.ALTITUDE_SAMPLE_PERIOD,
+                 sea_level_pressure=r.DEFAULT_SEA_LEVEL_PRESSURE):
+
+        self.sense = sense
+        self.imu_buffer = imu_buffer            # RingBuffer of IMU samples from the camera's sampler, if any
+        self.period = period
+        self.sea_level_pressure = sea_level_pressure
+
+        self.max_altitude = None                # Highest altitude estimated so far
+        self.burst_time = None                  # Clock time at which the burst was detected
+        self.rejected_readings = 0              # Readings from the barometer that were ignored
+
+        self._pressures = collections.deque(maxlen=r.ALTITUDE_MEDIAN_WINDOW)
+        self._state = None                      # [altitude, ascent rate, acceleration bias]
+        self._covariance = None
+        self._time = None
+        self._imu_read = 0                      # Number of the last IMU sample used
+        self._estimate = None
+        self._update_lock = threading.Lock()
+        self._task = None
+
+    def reset(self):
+        ''' Discards the state of the filter, e.g. after the sea level pressure has been changed '''
+
+        with self._update_lock:
+            self._pressures.clear()
+            self._state = None
+            self._covariance = None
+            self._time = None
+            self.max_altitude = None
+
+    def _vertical_acceleration(self):
+        # Mean vertical acceleration (m/s^2) over the IMU samples taken since the last update. The magnitude of the
+        # acceleration less 1g is used, as the payload swings and spins under the balloon and the orientation of the
+        # accelerometer isn't known, which leaves the bias estimated by the filter.
+        if self.imu_buffer is None:
+            return 0.0
+        samples, self._imu_read = self.imu_buffer.since(self._imu_read)
+        if not len(samples):
+            return 0.0
+        magnitude = numpy.sqrt((samples[:, 1:4] ** 2).sum(axis=1)).mean()
+        return float(magnitude - 1.0) * STANDARD_GRAVITY
+
+    def _altitude_variance(self, pressure):
+        # Variance (m^2) of the barometric altitude, from the noise of the barometer and the slope of the formula
+        metres_per_millibar = (altitude_at_pressure(pressure - 0.5, self.sea_level_pressure) -
+                               altitude_at_pressure(pressure + 0.5, self.sea_level_pressure))
+        return (r.ALTITUDE_PRESSURE_NOISE * metres_per_millibar) ** 2
+
+    def update(self, pressure=None, now=None):
+        ''' Takes a new barometer reading, and any new IMU samples, into the estimate
+
+        :param pressure: The reading in millibars (read from the SenseHAT if None)
+        :param now: The time of the reading (the clock time if None)
+        :return: The new AltitudeEstimate, or the previous one if the reading was rejected
+        '''
+
+        if pressure is None:
+            pressure = self.sense.get_pressure()
+        if now is None:
+            now = hardware.clock.time()
+
+        if not pressure > 0:                    # The barometer reads 0 until its first conversion is ready
+            self.rejected_readings += 1
+            return self._estimate
+
+        with self._update_lock:
+            self._pressures.append(pressure)
+            filtered_pressure = sorted(self._pressures)[len(self._pressures) // 2]
+            measured_altitude = altitude_at_pressure(filtered_pressure, self.sea_level_pressure)
+            measurement_variance = self._altitude_variance(filtered_pressure)
+            acceleration = self._vertical_acceleration()
+
+            if self._state is None:
+                self._state = numpy.array([measured_altitude, 0.0, 0.0])
+                self._covariance = numpy.diag([measurement_variance, r.ALTITUDE_INITIAL_RATE_VARIANCE,
+                                               r.ALTITUDE_INITIAL_BIAS_VARIANCE])
+            else:
+                # Predict the state forward with the measured acceleration less its bias...
+                dt = max(now - self._time, 0.0)
+                transition = numpy.array([[1.0, dt, -0.5 * dt ** 2], [0.0, 1.0, -dt], [0.0, 0.0, 1.0]])
+                control = numpy.array([0.5 * dt ** 2, dt, 0.0])
+                self._state = transition.dot(self._state) + control * acceleration
+                self._covariance = (transition.dot(self._covariance).dot(transition.T) +
+                                    numpy.outer(control, control) * r.ALTITUDE_ACCELERATION_NOISE ** 2 +
+                                    numpy.diag([0.0, 0.0, r.ALTITUDE_BIAS_DRIFT ** 2 * dt]))
+
+                # ...then correct it with the barometric altitude
+                innovation = measured_altitude - self._state[0]
+                gain = self._covariance[:, 0] / (self._covariance[0, 0] + measurement_variance)
+                self._state = self._state + gain * innovation
+                self._covariance = self._covariance - numpy.outer(gain, self._covariance[0, :])
+
+            self._time = now
+            altitude, ascent_rate = float(self._state[0]), float(self._state[1])
+
+            self.max_altitude = altitude if self.max_altitude is None else max(self.max_altitude, altitude)
+            if (self.burst_time is None and altitude < self.max_altitude - r.ALTITUDE_BURST_DROP and
+                    ascent_rate < -r.ALTITUDE_BURST_DESCENT_RATE):
+                self.burst_time = now
+                logger.info("Balloon burst detected at %.0fm (descending at %.1fm/s)", self.max_altitude, -ascent_rate)
+
+            self._estimate = AltitudeEstimate(now, altitude, ascent_rate,
+                                              pressure_at_altitude(altitude, self.sea_level_pressure),
+                                              self.burst_time is not None)
+            flight_recorder.record(BAROMETER_CHANNEL, now, (pressure, altitude, ascent_rate))
+            return self._estimate
+
+    def latest(self):
+        ''' Returns the most recent AltitudeEstimate, or None if there hasn't been a reading yet '''
+
+        return self._estimate
+
+    def start(self):
+        if self._task is None:
+            self._task = PeriodicTask('barometer', self.update, self.period)
+            self._task.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task.join()
+            self._task = None
+
+    def is_running(self):
+        return self._task is not None
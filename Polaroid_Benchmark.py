@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Flight replay benchmark for #PolaroidsInSpace
+
+Replays recorded sensor traces (see Utils.Polaroid_Simulator.TraceFlight) through
+Polaroid_Main.take_photos_from_space on the simulated hardware and reports:
+
+    decision latency    flight seconds from the photo trigger condition being met to the first shutter actuation
+    loop CPU time       process CPU seconds used by each pass of the mission loop
+    sleep wall time     real seconds spent in Clock.sleep
+    photo wait          flight seconds between a photo falling due (as planned by the ShotPlanner) and being taken
+    mission duration    flight seconds from launch until the last photo was taken
+
+Real CPU time is stretched by the time warp (1ms of processing at a warp of 3600 is 3.6 flight seconds), so the
+mission timings are only comparable between runs made at the same warp. The default keeps the distortion small while
+replaying a full flight in under a minute.
+
+The results are written as JSON so runs can be compared across versions and settings, e.g.
+
+    python Polaroid_Benchmark.py --record-synthetic /tmp/flight.csv
+    python Polaroid_Benchmark.py /tmp/flight.csv --output before.json
+    python Polaroid_Benchmark.py /tmp/flight.csv --set PHOTOS_INTERVAL_SECONDS=60 --compare before.json
+'''
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import time
+
+import Polaroid_Reference as r
+from Polaroid_Camera import PolaroidCamera
+from Polaroid_Develop import DevelopingTray
+from Polaroid_Main import take_photos_from_space
+from Polaroid_Payload import Payload, Screen
+from Polaroid_Planner import ShotPlanner
+
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Hardware import GPIO
+from Utils.Polaroid_Simulator import TraceFlight, record_trace
+
+TUNABLE_CONSTANTS = ['PHOTOS_INTERVAL_SECONDS', 'PHOTOS_MIN_ATMOSPHERIC_PRESSURE', 'PHOTOS_MAX_TIME_DELAY',
+                     'STABILITY_CHECKS_MAX_ITERATIONS', 'MOVING_AVERAGE_EXP_CONSTANT',
+                     'MOVING_AVERAGE_RATIO_THRESHOLD', 'PLANNER_BURST_ALTITUDE', 'PLANNER_WINDOW_MARGIN',
+                     'PLANNER_MIN_INTERVAL_SECONDS', 'PLANNER_MAX_INTERVAL_SECONDS', 'PLANNER_DEADLINE_FRACTION',
+                     'PLANNER_MAX_RELAXATION']
+
+# The metrics shown in the summary table and compared between runs
+SUMMARY_METRICS = ['decision_latency', 'photo_wait_mean', 'loop_cpu_mean', 'loop_cpu_p95', 'sleep_wall_time',
+                   'mission_duration', 'wall_time']
+
+process_time = getattr(time, 'process_time', None) or time.clock
+
+
+def _percentile(values, percentile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(percentile / 100.0 * (len(values) - 1))), len(values) - 1)]
+
+
+class MissionMeter(object):
+    '''
+    Wraps the clock and the payload objects to measure where the mission spends its time
+    '''
+
+    def __init__(self):
+
+        self.sleep_calls = 0
+        self.sleep_mission_time = 0.0       # Flight seconds requested from Clock.sleep
+        self.sleep_wall_time = 0.0          # Real seconds actually spent in Clock.sleep
+        self.loop_cpu = []                  # Process CPU seconds used by each pass of the mission loop
+        self.photo_cpu = []                 # Process CPU seconds used by each call to take_photo
+        self.unstable_photos = 0            # Photos taken after STABILITY_CHECKS_MAX_ITERATIONS were exhausted
+        self.plans = []                     # The ShotPlan of each photo, if the camera has a planner
+        self.photo_waits = []               # Clock seconds from each planned photo falling due to its shutter
+
+        self._loop_started = None
+        self._original_sleep = None
+        self._stable_found = False          # Whether the camera was found to be stable for the current photo
+
+    def attach(self, clock, payload, camera):
+        ''' Starts measuring the clock and payload objects '''
+
+        self._original_sleep = clock.sleep
+
+        def sleep(seconds):
+            started = time.time()
+            self._original_sleep(seconds)
+            self.sleep_calls += 1
+            self.sleep_mission_time += max(seconds, 0)
+            self.sleep_wall_time += time.time() - started
+        clock.sleep = sleep
+
+        # Each pass of the mission loop starts by reading the pressure
+        get_pressure = payload.get_pressure
+
+        def get_pressure_marked():
+            now = process_time()
+            if self._loop_started is not None:
+                self.loop_cpu.append(now - self._loop_started)
+            self._loop_started = now
+            return get_pressure()
+        payload.get_pressure = get_pressure_marked
+
+        take_photo = camera.take_photo
+
+        def take_photo_timed():
+            self._stable_found = False
+            started = process_time()
+            try:
+                return take_photo()
+            finally:
+                self.photo_cpu.append(process_time() - started)
+                if not self._stable_found:
+                    self.unstable_photos += 1
+        camera.take_photo = take_photo_timed
+
+        camera_is_stable = camera.camera_is_stable
+
+        def camera_is_stable_counted(*args, **kwargs):
+            stable = camera_is_stable(*args, **kwargs)
+            self._stable_found = self._stable_found or stable
+            return stable
+        camera.camera_is_stable = camera_is_stable_counted
+
+        if camera.planner is not None:
+            plan = camera.planner.plan
+
+            def plan_recorded(*args, **kwargs):
+                self.plans.append(plan(*args, **kwargs))
+                return self.plans[-1]
+            camera.planner.plan = plan_recorded
+
+            actuate_shutter = camera.actuate_shutter
+
+            def actuate_shutter_timed():
+                if self.plans:
+                    self.photo_waits.append(clock.time() - self.plans[-1].due)
+                return actuate_shutter()
+            camera.actuate_shutter = actuate_shutter_timed
+
+    def detach(self, clock):
+        ''' Stops measuring the clock '''
+
+        if self._original_sleep is not None:
+            del clock.sleep
+
+
+def trigger_time(flight):
+    ''' Returns the flight time at which the photo trigger condition is first met by the trace '''
+
+    for t, pressure in zip(flight.times, flight.trace['pressure']):
+        if pressure < r.PHOTOS_MIN_ATMOSPHERIC_PRESSURE or t > r.PHOTOS_MAX_TIME_DELAY:
+            return t
+    return r.PHOTOS_MAX_TIME_DELAY
+
+
+def replay(trace_file, time_warp):
+    ''' Flies the mission against a recorded trace and returns the metrics of the run '''
+
+    flight = TraceFlight(trace_file, joystick_script=[], seed=0)
+    hardware.use_backend(hardware.BACKEND_SIMULATED, time_warp=time_warp, simulation=flight)
+
+    GPIO.setmode(GPIO.BOARD)
+    GPIO.setup(r.GPIO_PIN_SHUTTER, GPIO.OUT)
+    GPIO.setup(r.GPIO_PIN_DEVELOP_TRAY, GPIO.OUT)
+    GPIO.setup(r.GPIO_PIN_EXTERNAL_THERMOMETER, GPIO.OUT)
+
+    screen = Screen()
+    payload = Payload()
+    # The planner's settings are passed explicitly so that --set applies to them
+    planner = ShotPlanner(payload, burst_altitude=r.PLANNER_BURST_ALTITUDE,
+                          min_interval=r.PLANNER_MIN_INTERVAL_SECONDS, max_interval=r.PLANNER_MAX_INTERVAL_SECONDS,
+                          max_relaxation=r.PLANNER_MAX_RELAXATION)
+    camera = PolaroidCamera(screen=screen, planner=planner)
+    developing_tray = DevelopingTray()
+
+    meter = MissionMeter()
+    meter.attach(hardware.clock, payload, camera)
+
+    wall_started = time.time()
+    cpu_started = process_time()
+    try:
+        camera.start_sampling()
+        developing_tray.start_sampling()
+        payload.start_sampling(camera.sampler.buffer)
+        payload.set_sea_level_pressure()
+        take_photos_from_space(developing_tray=developing_tray, payload=payload, camera=camera)
+    finally:
+        camera.stop_sampling()
+        developing_tray.stop_sampling()
+        payload.stop_sampling()
+        screen.close()
+        meter.detach(hardware.clock)
+    wall_time = time.time() - wall_started
+    cpu_time = process_time() - cpu_started
+
+    shutter_times = [t for t, pin, state in flight.gpio.history if pin == r.GPIO_PIN_SHUTTER and state]
+    triggered = trigger_time(flight)
+    photo_waits = meter.photo_waits[1:]     # The first photo is due as soon as the trigger is met
+
+    return {
+        'trace': os.path.basename(trace_file),
+        'photos_taken': camera.number_of_photos_taken,
+        'unstable_photos': meter.unstable_photos,
+        'trigger_time': triggered,
+        'first_shutter_time': shutter_times[0] if shutter_times else None,
+        'decision_latency': shutter_times[0] - triggered if shutter_times else None,
+        'shutter_times': shutter_times,
+        'photo_wait_mean': sum(photo_waits) / len(photo_waits) if photo_waits else None,
+        'loop_count': len(meter.loop_cpu) + 1,
+        'loop_cpu_mean': sum(meter.loop_cpu) / len(meter.loop_cpu) if meter.loop_cpu else 0.0,
+        'loop_cpu_p95': _percentile(meter.loop_cpu, 95),
+        'loop_cpu_max': max(meter.loop_cpu) if meter.loop_cpu else 0.0,
+        'photo_cpu_mean': sum(meter.photo_cpu) / len(meter.photo_cpu) if meter.photo_cpu else 0.0,
+        'sleep_calls': meter.sleep_calls,
+        'sleep_mission_time': meter.sleep_mission_time,
+        'sleep_wall_time': meter.sleep_wall_time,
+        'mission_duration': shutter_times[-1] if shutter_times else flight.flight_time(),
+        'wall_time': wall_time,
+        'cpu_time': cpu_time,
+    }
+
+
+def code_version():
+    ''' Returns the git description of the code being benchmarked '''
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except Exception:
+        return 'unknown'
+
+
+def apply_settings(settings):
+    ''' Overrides constants in Polaroid_Reference from NAME=VALUE strings '''
+
+    for setting in settings:
+        name, _, value = setting.partition('=')
+        if not hasattr(r, name):
+            raise ValueError("Unknown setting in Polaroid_Reference: {}".format(name))
+        setattr(r, name, type(getattr(r, name))(value))
+
+
+def print_summary(results, baseline=None):
+    ''' Prints a table of the summary metrics for each trace, with the change from a baseline run if given '''
+
+    previous = dict((run['trace'], run) for run in baseline['runs']) if baseline else {}
+
+    for run in results['runs']:
+        print("{} ({} photos, {} unstable)".format(run['trace'], run['photos_taken'], run['unstable_photos']))
+        for metric in SUMMARY_METRICS:
+            value = run[metric]
+            line = "    {:<20} {:>14}".format(metric, 'n/a' if value is None else '{:.6f}'.format(value))
+            old = previous.get(run['trace'], {}).get(metric)
+            if old is not None and value is not None:
+                change = (value - old) / old * 100 if old else 0.0
+                line += "  (was {:.6f}, {:+.1f}%)".format(old, change)
+            print(line)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Replays recorded flights to benchmark the mission loop")
+    parser.add_argument('traces', nargs='*', help="CSV sensor traces to replay")
+    parser.add_argument('--time-warp', type=float, default=100.0,
+                        help="mission seconds that pass for every real second")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="override a constant in Polaroid_Reference for this run")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--record-synthetic', metavar='TRACE',
+                        help="write a trace of the default simulated flight to this file and exit")
+    parser.add_argument('--log-level', default='WARNING', help="logging level while replaying")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
+    if args.record_synthetic:
+        record_trace(args.record_synthetic)
+        print("Synthetic trace written to {}".format(args.record_synthetic))
+        raise SystemExit(0)
+
+    if not args.traces:
+        parser.error("at least one trace is needed")
+
+    apply_settings(args.set)
+
+    results = {
+        'version': code_version(),
+        'time_warp': args.time_warp,
+        'settings': dict((name, getattr(r, name)) for name in TUNABLE_CONSTANTS),
+        'runs': [replay(trace_file, args.time_warp) for trace_file in args.traces],
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+    print_summary(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -6,13 +6,24 @@ Contains information on controlling the camera and taking photos
 '''
 
 import logging
-import time
-import datetime
+import threading
 
-import RPi.GPIO as GPIO
-from sense_hat import SenseHat
+import numpy
 
 import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Hardware import GPIO
+from Polaroid_Stability import PendulumEstimator, StabilityDetector
+from Utils.Polaroid_Capture import BurstCapture, FrameRing, FrameScorer, FrameWriter
+from Utils.Polaroid_FrameStore import FrameStore
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Sampler import IMUSampler, exponential_moving_average
+from Utils.Polaroid_Timing import timings
+
+logger = logging.getLogger('polaroid.camera')
+
+ACCELERATION_CHANNEL = flight_recorder.channel('acceleration', ('current', 'moving_average'))
+SHUTTER_CHANNEL = flight_recorder.channel('shutter', ('photo',))
 
 
 class PolaroidCamera(object):
@@ -20,15 +31,46 @@ class PolaroidCamera(object):
     Controls the actions of the polaroid camera
     '''
 
-    def __init__(self):
+    def __init__(self, screen=None, pi_camera=None, planner=None):
 
         self.number_of_photos_taken = 0
         self.acceleration_exponential_ma = 1                    # Moving average of the acceleration
         self.current_acceleration = 0
 
-        self.time_last_photo_taken = datetime.datetime.now()    # The time that the previous polaroid photo was taken
+        self.time_last_photo_taken = hardware.clock.now()       # The time that the previous polaroid photo was taken
+        self.last_photo_clock_time = None                       # The same as a clock time, for the planner
+
+        self.sense = hardware.get_sense_hat()
+        self.screen = screen                        # The Screen that the camera reports on, if any
+        self.pi_camera = pi_camera                  # The PiCamera whose frames confirm the camera is still, if any
+        self.planner = planner                      # The ShotPlanner that schedules the photos, if any
+        self.plan = None                            # The plan of the photo currently being taken
+        self._acceleration_lock = threading.Lock()  # The stability monitor and the shutter both read the accelerometer
+
+        self.sampler = IMUSampler(self.sense)               # Reads the IMU in the background once started
+        self._samples_read = 0                              # Number of the last sampler reading used
+        self.stability_detector = StabilityDetector()       # Judges stability over a window of sampler readings
+        self.stability_metrics = None                       # Metrics of the most recent window judged
+        self.pendulum_estimator = PendulumEstimator()       # Predicts when the swinging payload is next still
+        self.swing = None                                   # The most recent estimate of the swing of the payload
+
+    def start_sampling(self):
+        ''' Starts reading the accelerometer and gyroscope in the background
+
+        Once started, the acceleration metrics are taken from the sampler's buffer rather than by reading the sensor,
+        and stability is judged over a window of recent samples by the StabilityDetector.
+
+        :return:
+        '''
+
+        self.sampler.start()
+        logger.info("IMU sampling started at %sHz", r.SAMPLER_RATE_HZ)
+
+    def stop_sampling(self):
+        ''' Stops reading the IMU in the background '''
 
-        self.sense = SenseHat()
+        self.sampler.stop()
+        logger.info("IMU sampling stopped after %s samples", self.sampler.buffer.count)
 
     def take_photo(self):
         ''' Takes a photo with the polaroid camera
@@ -38,48 +80,103 @@ class PolaroidCamera(object):
 
         i = 0                               # Used to control the maximum number of iterations before the photo is taken
 
-        # Check if the minimum time between photos has elapsed, otherwise wait
-        time_now = datetime.datetime.now()
-        time_elapsed = (time_now - self.time_last_photo_taken).total_seconds()
-        if time_elapsed < r.PHOTOS_INTERVAL_SECONDS:
-            time.sleep(r.PHOTOS_INTERVAL_SECONDS - time_elapsed)
-            logging.debug("Sleeping while minimum time between photos elapses")
+        if self.planner is not None:
+            # Wait until the photo is due, then relax the stability thresholds as its deadline approaches
+            self.plan = self.planner.plan(r.PHOTOS_NUMBER_OF_SHOTS - self.number_of_photos_taken,
+                                          self.last_photo_clock_time)
+            if self.plan.due > hardware.clock.time():
+                logger.debug("Sleeping until the next photo is due")
+                hardware.clock.sleep(self.plan.due - hardware.clock.time())
+        else:
+            # Check if the minimum time between photos has elapsed, otherwise wait
+            time_now = hardware.clock.now()
+            time_elapsed = (time_now - self.time_last_photo_taken).total_seconds()
+            if time_elapsed < r.PHOTOS_INTERVAL_SECONDS:
+                hardware.clock.sleep(r.PHOTOS_INTERVAL_SECONDS - time_elapsed)
+                logger.debug("Sleeping while minimum time between photos elapses")
+
+        while i < r.STABILITY_CHECKS_MAX_ITERATIONS and not self._past_deadline():
+            # If the camera isn't already still but the swing of the payload can be predicted, watch for a still moment
+            # until the next end of the swing, then judge the angular rate at the turning point itself (where the
+            # camera is momentarily still) so the shot isn't lost to the lag of the full stability window. Otherwise
+            # wait for a still moment as before.
+            if self.camera_is_stable(timeout=0):
+                break
+            if self.predict_swing() is not None:
+                turning_point = self.swing.next_turning_point - r.PENDULUM_SHUTTER_LEAD_SECONDS
+                while turning_point < hardware.clock.time():    # The estimate took long enough to miss it
+                    turning_point += self.swing.period / 2
+                if self.camera_is_stable(timeout=turning_point - hardware.clock.time()):
+                    break
+                if self.camera_is_stable(timeout=r.PENDULUM_CHECK_SECONDS, rate_window=r.PENDULUM_RATE_WINDOW_SAMPLES):
+                    break
 
-        while i < r.STABILITY_CHECKS_MAX_ITERATIONS:
             if self.camera_is_stable():     # Take the photo if possible and then stop trying
                 break
             else:
-                time.sleep(5)
+                hardware.clock.sleep(5)
                 i +=1
-        # Once the camera is stable or the max iterations are exhausted, take the photo
+        # Once the camera is stable, or the max iterations or the deadline are exhausted, take the photo
         result = self.actuate_shutter()
+        self.plan = None
 
         if result:
             self.number_of_photos_taken += 1
-            self.time_last_photo_taken = datetime.datetime.now()
+            self.time_last_photo_taken = hardware.clock.now()
+            self.last_photo_clock_time = hardware.clock.time()
             return result
         else:
             raise IOError("Photo not taken, unable to actuate shutter")
 
+    def _past_deadline(self):
+        # Whether the deadline of the photo being taken has passed (never, without a planner)
+        return self.plan is not None and hardware.clock.time() >= self.plan.deadline
+
+    @timings.timed('acceleration')
     def get_acceleration(self):
         ''' Updates the acceleration metrics of the camera
 
         :return: True/False depending on whether process was successful
         '''
 
-        try:
-            x, y, z = self.sense.get_accelerometer_raw().values()
-        except Exception, e:
-            logging.error("Error attempting to get x,y,z values from accelerometer")
-            logging.error("Error message: {}".format(e))
-            raise e
-        else:
-            self.current_acceleration = ((x ** 2) + (y ** 2) + (z ** 2)) ** 0.5  # Determine the acceleration
-            self.acceleration_exponential_ma = (self.current_acceleration * (1 - r.MOVING_AVERAGE_EXP_CONSTANT)) + (
-                r.MOVING_AVERAGE_EXP_CONSTANT * self.acceleration_exponential_ma)
-            logging.debug("Current acceleration: {}".format(self.current_acceleration))
-            logging.debug("Current moving average acceleration: {}".format(self.acceleration_exponential_ma))
+        if self.sampler.is_running():
+            return self._update_acceleration_from_sampler()
 
+        with self._acceleration_lock:
+            try:
+                x, y, z = self.sense.get_accelerometer_raw().values()
+            except Exception, e:
+                logger.error("Error attempting to get x,y,z values from accelerometer")
+                logger.error("Error message: %s", e)
+                raise e
+            else:
+                self.current_acceleration = ((x ** 2) + (y ** 2) + (z ** 2)) ** 0.5  # Determine the acceleration
+                self.acceleration_exponential_ma = (self.current_acceleration * (1 - r.MOVING_AVERAGE_EXP_CONSTANT)) + (
+                    r.MOVING_AVERAGE_EXP_CONSTANT * self.acceleration_exponential_ma)
+                logger.debug("Current acceleration: %s", self.current_acceleration)
+                logger.debug("Current moving average acceleration: %s", self.acceleration_exponential_ma)
+
+                return True
+
+    def _update_acceleration_from_sampler(self):
+        ''' Updates the acceleration metrics with the samples taken since the last update
+
+        :return: True/False depending on whether process was successful
+        '''
+
+        with self._acceleration_lock:
+            if self.sampler.is_stalled():
+                logger.error("Accelerometer sampler has no recent readings (newest is %ss old)", self.sampler.age())
+                raise IOError("Accelerometer sampler has stalled")
+
+            samples, self._samples_read = self.sampler.buffer.since(self._samples_read)
+            if len(samples):
+                magnitudes = numpy.sqrt((samples[:, 1:4] ** 2).sum(axis=1))
+                self.current_acceleration = float(magnitudes[-1])
+                self.acceleration_exponential_ma = exponential_moving_average(magnitudes,
+                                                                              self.acceleration_exponential_ma)
+                flight_recorder.record(ACCELERATION_CHANNEL, float(samples[-1, 0]),
+                                       (self.current_acceleration, self.acceleration_exponential_ma))
             return True
 
     def calibrate_acceleration(self):
@@ -88,46 +185,112 @@ class PolaroidCamera(object):
         :return:
         '''
 
+        if self.sampler.is_running():
+            # Seed the average from the samples already in the buffer rather than sampling for another 10 seconds
+            while self.sampler.buffer.count < r.SAMPLER_CALIBRATION_SAMPLES:
+                hardware.clock.sleep(self.sampler.period)
+            with self._acceleration_lock:
+                samples = self.sampler.buffer.latest(r.SAMPLER_CALIBRATION_SAMPLES)
+                magnitudes = numpy.sqrt((samples[:, 1:4] ** 2).sum(axis=1))
+                self.current_acceleration = float(magnitudes[-1])
+                self.acceleration_exponential_ma = exponential_moving_average(magnitudes, magnitudes.mean())
+                self._samples_read = self.sampler.buffer.count
+            return
+
         for _ in range(0,100):
             try:
                 self.get_acceleration()
             except Exception, e:
-                logging.error("Unable to calibrate moving average acceleration")
+                logger.error("Unable to calibrate moving average acceleration")
                 break   # Suppress error so that camera continues to take photos
             else:
-                time.sleep(0.1)
+                hardware.clock.sleep(0.1)
+
+    def predict_swing(self):
+        ''' Estimates the period of the payload's swing and when it will next reach the end of a swing
+
+        :return: PendulumEstimate, or None if the sampler isn't running or there's no regular swing
+        '''
+
+        if not self.sampler.is_running():
+            return None
+
+        samples = self.sampler.buffer.latest(int(r.PENDULUM_HISTORY_SECONDS * r.SAMPLER_RATE_HZ))
+        if len(samples):
+            # If the sampler has fallen behind its rate (e.g. under a large time warp) the same number of samples spans
+            # a longer history, which the estimator would have to resample onto a much larger grid
+            samples = samples[samples[:, 0] >= samples[-1, 0] - r.PENDULUM_HISTORY_SECONDS]
+        try:
+            self.swing = self.pendulum_estimator.estimate(samples, hardware.clock.time())
+        except Exception, e:
+            logger.error("Error attempting to estimate the swing of the payload")
+            logger.error("Error message: %s", e)
+            self.swing = None
+
+        logger.debug("Payload swing estimate: %s", self.swing)
+        return self.swing
 
-    def camera_is_stable(self):
+    def camera_is_stable(self, timeout=None, rate_window=None):
         ''' Uses the accelerometer to determine if the camera is sufficiently stable to take a photo
 
+        With the sampler running, stability is judged by the StabilityDetector over a window of accelerometer and
+        gyroscope samples; otherwise each accelerometer reading is compared against the moving average. If there is a
+        Pi camera, its newest frame must also be sharp (see PiCamera.is_sharp). While a planned photo is overdue the
+        thresholds are relaxed by the planner, as a slightly blurred photo is better than none, and the check gives up
+        at the photo's deadline.
+
+        :param timeout: Seconds to wait for the camera to become stable (r.STABILITY_CHECK_SECONDS if None)
+        :param rate_window: Number of samples to judge the angular rate over (see StabilityDetector.is_stable)
         :return: True/False depending on whether the stability of the camera is within the bounds defined
         '''
 
+        if timeout is None:
+            timeout = r.STABILITY_CHECK_SECONDS
+        if self.plan is not None:
+            timeout = max(min(timeout, self.plan.deadline - hardware.clock.time()), 0)
+
+        # With the sampler running each check only has to wait for the next sample, rather than for a sensor read
+        check_interval = self.sampler.period if self.sampler.is_running() else 0.1
+        max_checks = max(int(timeout / check_interval), 1)     # A timeout of 0 checks once without waiting
+
         i = 0
-        while i < 100:
-            # Make decision dynamic depending on how much was left of the expected flight
-            # i.e. blurry photo better than none?
+        while i < max_checks:
+            relaxation = self.planner.relaxation(self.plan) if self.planner is not None else 1.0
 
             try:
                 self.get_acceleration()
 
             except Exception, e:                 # If the acceleration check raises an error, log it and try again
-                logging.error("Error attempting to check stability of camera")
-                logging.error("Error message: {}".format(e))
+                logger.error("Error attempting to check stability of camera")
+                logger.error("Error message: %s", e)
                 i += 1
 
             else:
-                acceleration_ratio = abs((self.current_acceleration - self.acceleration_exponential_ma)
-                                         / self.acceleration_exponential_ma)
-                # Return whether the current acceleration is sufficiently less than the exponential moving average
-                if acceleration_ratio < r.MOVING_AVERAGE_RATIO_THRESHOLD:
+                if self.sampler.is_running():
+                    # Judge the variance, jerk and angular rate over the most recent window of samples
+                    stable, self.stability_metrics = self.stability_detector.is_stable(
+                        self.sampler.buffer.latest(self.stability_detector.window), rate_window, relaxation)
+                else:
+                    acceleration_ratio = abs((self.current_acceleration - self.acceleration_exponential_ma)
+                                             / self.acceleration_exponential_ma)
+                    # Whether the current acceleration is sufficiently less than the exponential moving average
+                    stable = acceleration_ratio < r.MOVING_AVERAGE_RATIO_THRESHOLD * relaxation
+
+                if stable and r.SHARPNESS_CONFIRMS_STABILITY and self.pi_camera is not None:
+                    # The frames from the Pi camera blur while the payload swings; without a recent frame the IMU
+                    # is trusted on its own
+                    stable = self.pi_camera.is_sharp(relaxation) is not False
+
+                if stable:
+                    logger.debug("Camera stable: %s", self.stability_metrics)
                     return True     # If the camera is sufficiently stable, return True and break the cycle
                 else:
                     i += 1          # Increment the counter
-                    time.sleep(0.1)
+                    hardware.clock.sleep(check_interval)
 
-        return False                # If the camera isn't stable after 100 iterations, return False
+        return False                # If the camera isn't stable after max_checks iterations, return False
 
+    @timings.timed('shutter')
     def actuate_shutter(self):
         ''' Uses the GPIO pins to actuate the camera shutter
 
@@ -136,17 +299,18 @@ class PolaroidCamera(object):
 
         try:
             GPIO.output(r.GPIO_PIN_SHUTTER, True)
-            time.sleep(1)
+            hardware.clock.sleep(1)
             GPIO.output(r.GPIO_PIN_SHUTTER, False)
 
         except Exception, e:
-            logging.error("Error actuating shutter on pin {}".format(r.GPIO_PIN_SHUTTER))
-            logging.error("Error message: {}".format(e))
+            logger.error("Error actuating shutter on pin %s", r.GPIO_PIN_SHUTTER)
+            logger.error("Error message: %s", e)
             return False
         else:
-            logging.info("### Camera shutter actuated ###")
-            s = SenseHat()
-            s.show_message("Camera actuated", scroll_speed=0.05)
+            logger.info("### Camera shutter actuated ###")
+            flight_recorder.record(SHUTTER_CHANNEL, hardware.clock.time(), (self.number_of_photos_taken + 1,))
+            if self.screen is not None:
+                self.screen.write("Camera actuated", key='camera')     # Queued, so doesn't hold up the next photo
             return True
 
     def test(self):
@@ -155,41 +319,157 @@ class PolaroidCamera(object):
         try:
             GPIO.output(r.GPIO_PIN_SHUTTER, False)  # Pin starts false, resetting it false checks pin can be referenced
         except Exception, e:
-            logging.error("Unable to test GPIO pins in Polaroid.test() method")
-            logging.error("Error message: {}".format(e))
+            logger.error("Unable to test GPIO pins in Polaroid.test() method")
+            logger.error("Error message: %s", e)
             raise IOError("Unable to set GPIO pin number {}".format(r.GPIO_PIN_SHUTTER))
 
         try:
             self.get_acceleration()
         except Exception, e:
-            logging.error("Unable to test accelerometer in Polaroid.test() method")
-            logging.error("Error message: {}".format(e))
+            logger.error("Unable to test accelerometer in Polaroid.test() method")
+            logger.error("Error message: %s", e)
             raise IOError("Unable to get acceleration {}".format(e))
 
         try:
-            self.camera_is_stable()
+            self.camera_is_stable(timeout=0)    # Only checks that stability can be judged, not that the camera is still
         except Exception, e:
-            logging.error("Unable to test camera stability in Polaroid.test() method")
-            logging.error("Error message: {}".format(e))
+            logger.error("Unable to test camera stability in Polaroid.test() method")
+            logger.error("Error message: %s", e)
             raise IOError("Unable to test stability of the camera: {}".format(e))
 
         return True
 
 
 class PiCamera(object):
-    ''' Controls the onboard Pi camera module'''
+    ''' Controls the onboard Pi camera module
 
-    def __init__(self):
+    Once started, the camera captures frames continuously into a ring of recent frames in memory, and each frame is
+    scored for sharpness as it arrives. Taking a photo only picks the sharpest frames of the last few seconds for the
+    background writer to save (the rest are never written), so it never holds up the polaroid shutter.
+    '''
 
-        self.save_file_location = None      # The file location of the most recently taken photo
+    def __init__(self, source=None, folder=r.PICAMERA_FOLDER, snapshot=None):
+        '''
+        :param source: Frame source to capture from, e.g. a fake for testing (the Pi camera module if None)
+        :param folder: The directory that the frame store is written to
+        :param snapshot: Called as each frame is captured for a dict of the sensor readings to store with it (see
+                         Utils.Polaroid_FrameStore.SNAPSHOT_FIELDS)
+        '''
+
+        self.save_file_location = None      # The (frame store file, slot) of the most recently taken photo
         self.number_of_photos_taken = 0     # The number of photos taken by the camera
+        self.frames_discarded = 0           # The number of frames of the bursts left out as less sharp
+
+        self.source = source if source is not None else hardware.get_camera()
+        self.folder = folder
+        self.ring = None
+        self.capture = None
+        self.scorer = None
+        self.writer = None
+
+        if self.source is None:
+            logger.warning("Pi camera module not available, digital photos disabled")
+            return
+
+        self.ring = FrameRing(r.PICAMERA_RING_FRAMES, self.source.resolution, snapshot)
+        self.scorer = FrameScorer(self.ring)
+        self.capture = BurstCapture(self.source, self.ring, on_capture=self.scorer.submit)
+
+    def is_available(self):
+        return self.source is not None
+
+    def start(self):
+        ''' Starts capturing frames into the ring and the writer that saves the chosen ones '''
+
+        if not self.is_available() or self.capture.is_running():
+            return
+
+        try:
+            self.writer = FrameWriter(self.ring, FrameStore(self.folder, self.source.resolution), self.scorer)
+        except EnvironmentError, e:         # The polaroids can still be taken without the digital photos
+            logger.error("Unable to write Pi camera frames to %s", self.folder)
+            logger.error("Error message: %s", e)
+            return
+
+        self.writer.start()
+        self.scorer.start()
+        self.capture.start()
+        logger.info("Pi camera capturing at %sfps into a ring of %s frames", r.PICAMERA_FRAME_RATE,
+                    r.PICAMERA_RING_FRAMES)
+
+    def stop(self):
+        ''' Stops capturing and waits for the chosen frames to be written '''
+
+        if self.capture is None or not self.capture.is_running():
+            return
+
+        self.capture.stop()
+        self.scorer.stop()
+        self.writer.stop()
+        logger.info("Pi camera stopped after %s frames (%s scored, %s written, %s discarded, %s missed)",
+                    self.ring.count, self.scorer.frames_scored, self.writer.frames_written, self.frames_discarded,
+                    self.writer.missed_frames)
 
     def take_photo(self):
-        ''' Takes a photo from the Pi camera'''
+        ''' Takes a photo from the Pi camera
+
+        Picks the r.SHARPNESS_KEEP_FRAMES sharpest frames captured over the last r.PICAMERA_BURST_SECONDS to be written
+        in the background, without waiting for them to be written. Frames still waiting to be scored are left out.
 
-        pass
+        :return: The number of frames picked
+        '''
+
+        if self.capture is None or not self.capture.is_running():
+            return 0
+
+        numbers = self.ring.numbers_since(hardware.clock.time() - r.PICAMERA_BURST_SECONDS)
+        best = self.scorer.best(numbers, r.SHARPNESS_KEEP_FRAMES)
+        self.frames_discarded += len(numbers) - len(best)
+        queued = self.writer.select(best)
+        self.number_of_photos_taken += 1
+        logger.info("Pi camera photo %s: %s of %s frames queued to be written (sharpness %s)",
+                    self.number_of_photos_taken, queued, len(numbers),
+                    [round(self.scorer.score(number), 1) for number in best])
+        return queued
+
+    def is_sharp(self, relaxation=1.0):
+        ''' Whether the newest frame is sharp compared with the other frames in the ring
+
+        The camera blurs while the payload swings, so this is a second check (alongside the IMU) that the polaroid is
+        still enough to take a photo.
+
+        :param relaxation: Factor the sharpness required is divided by, e.g. as the deadline for a photo approaches
+        :return: True/False, or None if there's no recent enough frame to judge by
+        '''
+
+        if self.scorer is None or not self.capture.is_running():
+            return None
+
+        latest, median = self.scorer.latest(), self.scorer.median()
+        if latest is None or hardware.clock.time() - latest[0] > r.SHARPNESS_MAX_AGE_SECONDS:
+            return None
+        return latest[1] >= median * r.SHARPNESS_STABLE_RATIO / relaxation
 
     def download(self):
-        ''' Downloads the captured photo'''
+        ''' Waits for the frames picked so far to be written
 
-        pass
+        :return: The (frame store file, slot) of the most recently written frame
+        '''
+
+        if self.writer is not None:
+            self.writer.flush()
+            self.save_file_location = self.writer.last_location
+        return self.save_file_location
+
+    def test(self):
+        ''' Checks that a frame can be captured from the camera '''
+
+        if not self.is_available():
+            raise IOError("Pi camera module not available")
+
+        if self.capture.is_running():
+            if not self.ring.wait(self.ring.count + 1, 2.0 / r.PICAMERA_FRAME_RATE):
+                raise IOError("Pi camera has stopped capturing frames")
+        else:
+            self.ring.capture(self.source)
+        return True
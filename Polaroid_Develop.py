@@ -6,22 +6,20 @@ Module to handle the environment for developing the film once the photo has been
 '''
 
 import logging
-import os
-import time
-import subprocess
-
-import RPi.GPIO as GPIO
 
 import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Hardware import GPIO
+from Utils.Polaroid_PID import PIDController
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Thermometer import ThermometerSampler, discover_thermometers
+from Utils.Polaroid_Timing import timings
+
+logger = logging.getLogger('polaroid.developing_tray')
 
-# Sets up the external thermometer to get the temperature of the developing bath
-# From https://learn.adafruit.com/downloads/pdf/adafruits-raspberry-pi-lesson-11-ds18b20-temperature-sensing.pdf
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
+device_file = hardware.w1_device_file(r.EXTERNAL_THERMOMETER_ID)
 
-base_dir = '/sys/bus/w1/devices/'
-device_folder = base_dir + r.EXTERNAL_THERMOMETER_ID
-device_file = device_folder + '/w1_slave'
+HEATER_CHANNEL = flight_recorder.channel('heater', ('duty_cycle',))
 
 class DevelopingTray(object):
     '''
@@ -33,56 +31,65 @@ class DevelopingTray(object):
         self.temperature = 0
         self.heater_currently_on = False
         self.heater_enabled = True          # Used to disable the heater once photos start to be taken
+        self.heater_duty_cycle = 0.0        # Fraction of the time the heater is currently powered
+        self.heater_duty_seconds = 0.0      # Seconds of full power used by the heater so far (duty cycle x time)
+
+        self.controller = PIDController(r.HEATER_PID_KP, r.HEATER_PID_KI, r.HEATER_PID_KD,
+                                        r.DEVELOP_TRAY_TEMP_SETPOINT)
+        self._pwm = None                    # Software PWM on the heater pin, started on first use
+        self._duty_changed = None           # Clock time at which the duty cycle was last changed
+        self._below_minimum = False         # Whether the tray was below the minimum temperature at the last check
+
+        # Sets up the external thermometers, including the one that measures the temperature of the developing bath
+        hardware.load_w1_modules()
+        self.thermometers = ThermometerSampler(discover_thermometers())
 
         # ToDo: Signal that the heater system is working correctly
 
 
-    def _read_temp_raw(self):
-        ''' Reads the temperature data from the internal *.txt file
+    def start_sampling(self):
+        ''' Starts reading the external thermometers in the background
+
+        Once started, get_temperature uses the latest background reading rather than waiting for the sensor.
 
         :return:
         '''
-        try:
-            catdata = subprocess.Popen(['cat', device_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except Exception, e:
-            logging.error("Unable to open file {}".format(device_file))
-            logging.error("Error: {}".format(e))
-            return False
-        else:
-            out, err = catdata.communicate()
-            out_decode = out.decode('utf-8')
-            lines = out_decode.split('\n')
-            return lines
 
+        self.thermometers.read_all()            # So there's a reading for the first check of the thermostat
+        self.thermometers.start()
+        logger.info("Thermometer sampling started every %ss", self.thermometers.period)
+
+    def stop_sampling(self):
+        ''' Stops reading the external thermometers in the background '''
+
+        self.thermometers.stop()
+        logger.info("Thermometer sampling stopped (%s failed readings)", self.thermometers.error_count)
+
+    @timings.timed('temperature')
     def get_temperature(self):
         ''' Determines the temperature of the environment using the waterproof temperature sensor
 
         :return: True/False on whether the process worked correctly
         '''
 
-        i = 0
         # External temp sensor is a DS18B20
-        lines = self._read_temp_raw()
-        while lines[0].strip()[-3:] != 'YES':
-            time.sleep(0.2)
-            i += 1                              # Increment the counter to prevent infinite loop
-            if i >= 100:
-                logging.error("Maximum number of attempts to read temperature exceeded, process aborted")
-                break
-            lines = self._read_temp_raw()
-
-        equals_pos = lines[1].find('t=')
-
-        if equals_pos != -1:
-            temp_string = lines[1][equals_pos + 2:]
-            temp_celsius = float(temp_string) / 1000.0
-
-            self.temperature = temp_celsius
-            logging.info("New temperature: {}".format(self.temperature))
-            return True
+        if self.thermometers.is_running():
+            reading = self.thermometers.latest(r.THERMOMETER_BATH_CHANNEL)
+            if reading is None or self.thermometers.is_stale(r.THERMOMETER_BATH_CHANNEL):
+                logger.error("No recent temperature from %s", device_file)
+                return False
+            temp_celsius = reading[1]
         else:
-            logging.error("Unable to determine temperature (can't find 't=' in line of output file")
-            return False
+            try:
+                temp_celsius = self.thermometers.read(r.THERMOMETER_BATH_CHANNEL)
+            except IOError, e:
+                logger.error("Unable to determine temperature from %s", device_file)
+                logger.error("Error: %s", e)
+                return False
+
+        self.temperature = temp_celsius
+        logger.info("New temperature: %s", self.temperature)
+        return True
 
     def heater(self, heater_on=False):
         ''' Controls the heating coil for the liquid in the developing tray
@@ -91,39 +98,65 @@ class DevelopingTray(object):
         :return:
         '''
 
-        if heater_on:
-            GPIO.output(r.GPIO_PIN_DEVELOP_TRAY, True)
-        else:
-            GPIO.output(r.GPIO_PIN_DEVELOP_TRAY, False)
+        self.set_heater_duty_cycle(1.0 if heater_on else 0.0)
+
+    def set_heater_duty_cycle(self, duty_cycle):
+        ''' Drives the heating coil with a PWM signal
+
+        :param duty_cycle: Fraction of the time the heater is powered, from 0 (off) to 1 (fully on)
+        :return:
+        '''
+
+        if self._pwm is None:
+            self._pwm = GPIO.PWM(r.GPIO_PIN_DEVELOP_TRAY, r.HEATER_PWM_FREQUENCY)
+            self._pwm.start(0)
+
+        # Record the energy used at the previous duty cycle before changing it
+        now = hardware.clock.time()
+        if self._duty_changed is not None:
+            self.heater_duty_seconds += self.heater_duty_cycle * (now - self._duty_changed)
+        self._duty_changed = now
+
+        self._pwm.ChangeDutyCycle(duty_cycle * 100)
+        self.heater_duty_cycle = duty_cycle
+        self.heater_currently_on = duty_cycle > 0
+        flight_recorder.record(HEATER_CHANNEL, now, (duty_cycle,))
 
     def check(self):
-        ''' Tests the environment and determines whether the heater needs to be turned on or not
+        ''' Measures the temperature of the developing tray and updates the power of the heater to hold it at the
+        setpoint
 
         :return:
         '''
 
         if self.get_temperature():
 
-            if self.heater_enabled:
-
-                if self.temperature < r.DEVELOP_TRAY_TEMP_MIN:
-                    self.heater(heater_on=True)                 # If it's too cold, turn the heater on
-                    self.heater_currently_on=True
-                    logging.info("Updated heater state: {}".format(self.heater_currently_on))
-                elif self.temperature > r.DEVELOP_TRAY_TEMP_MAX:
-                    self.heater(heater_on=False)                # If it's too warm, turn the heater off
-                    self.heater_currently_on=False
-                    logging.info("Updated heater state: {}".format(self.heater_currently_on))
-                else:
-                    pass                                        # Temperature is currently within normal limit
-            else:
+            # Only warned of as the tray falls below the minimum, rather than at every check until it warms up, and
+            # not while the heater is disabled, as it can do nothing about it
+            below_minimum = self.heater_enabled and self.temperature < r.DEVELOP_TRAY_TEMP_MIN
+            if below_minimum and not self._below_minimum:
+                logger.warning("Developing tray below minimum temperature: %s", self.temperature)
+            elif self._below_minimum and not below_minimum and self.heater_enabled:
+                logger.info("Developing tray back above minimum temperature: %s", self.temperature)
+            self._below_minimum = below_minimum
+
+            if not self.heater_enabled:
                 self.heater(heater_on=False)
-                logging.debug("Heater disabled, DevelopingTray.check not performed")
+                self.controller.reset()
+                logger.debug("Heater disabled, DevelopingTray.check not performed")
+            elif self.temperature > r.DEVELOP_TRAY_TEMP_MAX:
+                self.heater(heater_on=False)                    # If it's too warm, turn the heater off regardless
+                self.controller.reset()
+                logger.info("Developing tray above maximum temperature, heater turned off")
+            else:
+                self.set_heater_duty_cycle(self.controller.update(self.temperature, hardware.clock.time()))
+                logger.info("Heater duty cycle: %.3f (%.0f full power seconds used)",
+                            self.heater_duty_cycle, self.heater_duty_seconds)
         else:
             # ToDo: Error, temperature wasn't determined correctly
             self.heater(heater_on=False)
-            logging.error("Unable to get temperature, heater turned to False")
-
+            self.controller.reset()
+            logger.error("Unable to get temperature, heater turned to False")
 
     def test(self):
         ''' Runs diagnostic checks on the developing tray object
@@ -132,24 +165,24 @@ class DevelopingTray(object):
         '''
 
         try:
-            self._read_temp_raw()
+            self.thermometers.read(r.THERMOMETER_BATH_CHANNEL)
         except Exception, e:
-            logging.error("Unable to read file (test): {}".format(device_file))
-            logging.error("Error: {}".format(e))
+            logger.error("Unable to read file (test): %s", device_file)
+            logger.error("Error: %s", e)
             raise IOError("Unable to read file (test): {}".format(device_file))
 
         try:
             self.get_temperature()
         except Exception, e:
-            logging.error("Unable to get temperature using external sensor (test)")
-            logging.error("Error: {}".format(e))
+            logger.error("Unable to get temperature using external sensor (test)")
+            logger.error("Error: %s", e)
             raise IOError("Unable to get temperature using external sensor (test)")
 
         try:
             self.heater(heater_on=False)
         except Exception, e:
-            logging.error("Unable to turn heater off (test)")
-            logging.error("Error: {}".format(e))
+            logger.error("Unable to turn heater off (test)")
+            logger.error("Error: %s", e)
             raise IOError("Unable to turn heater off (test)")
 
         return True
\ No newline at end of file
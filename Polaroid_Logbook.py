@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Post-flight log book for #PolaroidsInSpace
+
+Loads the log files written by Utils.Polaroid_Logging.initialize_logger into a SQLite database, indexed by time, level
+and event type, so the events around each photo can be found without searching the logs by hand, e.g.
+
+    python Polaroid_Logbook.py ingest /media/sdcard/home/pi/polaroid/Logs
+    python Polaroid_Logbook.py around --photo 5 --seconds 30
+    python Polaroid_Logbook.py events --event heater --event pressure
+    python Polaroid_Logbook.py events --level ERROR
+
+The logs are read a line at a time, and each file is remembered by its first line and how far it has been read, so
+running ingest again only loads the lines written since (including after a log has been rotated to output.log.1).
+
+Each record is classified by its message into one of the EVENTS, with the number it reports (e.g. the pressure or the
+photo number) where there is one:
+
+    trigger         the photo taking process started
+    shutter         the camera shutter was actuated
+    photo           a photo was taken (value: the number of the photo)
+    heater          the heater power was changed (value: the duty cycle)
+    pressure        the pressure was measured (value: millibars)
+    temperature     the developing tray temperature was measured (value: celsius)
+    burst           the balloon burst was detected
+    user            a joystick command from the user
+    error           any other ERROR or CRITICAL record
+'''
+
+import argparse
+import calendar
+import datetime
+import glob
+import hashlib
+import os
+import re
+import sqlite3
+
+SEPARATOR = u' ｜ '                     # Between the fields of the lines written by initialize_logger
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+LOG_FILES = ('output.log', 'error_log.log')     # In order of preference; output.log has every record of error_log.log
+
+BATCH_SIZE = 5000                       # Records inserted between commits
+
+# (event, pattern, value) for each kind of message; the value is taken from the first group of the pattern if None
+EVENTS = [
+    ('trigger', re.compile(r'### Photo taking process commenced ###'), None),
+    ('shutter', re.compile(r'### Camera shutter actuated ###'), None),
+    ('photo', re.compile(r'Polaroid photo taken: (\d+)'), None),
+    ('heater', re.compile(r'Heater duty cycle: ([-\d.]+)'), None),
+    ('heater', re.compile(r'heater turned (?:off|to False)|heater disabled'), 0.0),
+    ('pressure', re.compile(r'(?:Current pressure|Payload pressure|Payload current pressure): ([-\d.]+)'), None),
+    ('temperature', re.compile(r'New temperature: ([-\d.]+)'), None),
+    ('burst', re.compile(r'Balloon burst'), None),
+    ('user', re.compile(r'by user'), None),
+]
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sources (
+        id INTEGER PRIMARY KEY,
+        signature TEXT UNIQUE NOT NULL,     -- Hash of the first line of the file, which identifies it once rotated
+        path TEXT NOT NULL,                 -- Where the file was last read from
+        offset INTEGER NOT NULL,            -- Bytes of the file read so far
+        last_record INTEGER                 -- Record that continuation lines (e.g. tracebacks) are added to
+    );
+    CREATE TABLE IF NOT EXISTS records (
+        id INTEGER PRIMARY KEY,
+        source INTEGER NOT NULL REFERENCES sources(id),
+        time REAL NOT NULL,                 -- Seconds since the epoch, taking the log's local time as UTC
+        level TEXT NOT NULL,
+        event TEXT,
+        value REAL,
+        message TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS records_time ON records (time);
+    CREATE INDEX IF NOT EXISTS records_level ON records (level, time);
+    CREATE INDEX IF NOT EXISTS records_event ON records (event, time);
+'''
+
+
+def parse_time(text):
+    ''' Converts a log timestamp such as '2017-04-01 09:30:00,123' to seconds since the epoch
+
+    :return: The time, or None if the text isn't a timestamp
+    '''
+
+    # Read from fixed positions, as strptime is the slowest part of loading a log
+    try:
+        if text[4] != '-' or text[7] != '-' or text[13] != ':' or text[16] != ':':
+            return None
+        moment = (int(text[0:4]), int(text[5:7]), int(text[8:10]), int(text[11:13]), int(text[14:16]),
+                  int(text[17:19]))
+        milliseconds = int(text[20:23]) if len(text) > 19 else 0
+    except (IndexError, ValueError):
+        return None
+    return calendar.timegm(moment) + milliseconds / 1000.0
+
+
+def format_time(seconds):
+    ''' Converts seconds since the epoch back to the timestamp format of the logs '''
+
+    moment = datetime.datetime.utcfromtimestamp(seconds)
+    return moment.strftime('%Y-%m-%d %H:%M:%S,') + '{:03d}'.format(moment.microsecond // 1000)
+
+
+def parse_line(line):
+    ''' Splits a log line into its fields
+
+    :param line: A line of a log, as unicode without the line ending
+    :return: (time, level, message), or None if the line doesn't start a record (e.g. a line of a traceback)
+    '''
+
+    fields = line.split(SEPARATOR, 2)
+    if len(fields) != 3 or fields[1] not in LEVELS:
+        return None
+    seconds = parse_time(fields[0])
+    if seconds is None:
+        return None
+    return seconds, fields[1], fields[2]
+
+
+def classify(message):
+    ''' Finds the event that a log message reports
+
+    :return: (event, value), with None for the value if the event has no number, or (None, None) for other messages
+    '''
+
+    for event, pattern, value in EVENTS:
+        match = pattern.search(message)
+        if match:
+            if value is None and match.groups():
+                try:
+                    value = float(match.group(1))
+                except ValueError:
+                    pass
+            return event, value
+    return None, None
+
+
+class Logbook(object):
+    '''
+    SQLite database of the records from a set of log files
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def ingest(self, log_file):
+        ''' Loads the records of a log file that haven't been loaded already
+
+        :param log_file: Path of the log file
+        :return: Number of records loaded
+        '''
+
+        with open(log_file, 'rb') as f:
+            first_line = f.readline()
+            if not first_line.endswith('\n'):
+                return 0                    # Nothing complete to load yet
+            signature = hashlib.sha1(first_line).hexdigest()
+
+            cursor = self.connection.cursor()
+            row = cursor.execute('SELECT id, offset, last_record FROM sources WHERE signature = ?',
+                                 (signature,)).fetchone()
+            if row is None:
+                cursor.execute('INSERT INTO sources (signature, path, offset) VALUES (?, ?, 0)',
+                               (signature, log_file))
+                source, offset, last_record = cursor.lastrowid, 0, None
+            else:
+                source, offset, last_record = row
+            f.seek(offset)
+
+            loaded = 0
+            batch = []
+            continuation = []               # Lines to add to the message of last_record
+
+            while True:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break                   # The end of the file, or a line that is still being written
+                offset += len(line)
+                text = line.rstrip('\r\n').decode('utf-8', 'replace')
+
+                fields = parse_line(text)
+                if fields is None:
+                    if batch:
+                        batch[-1][5] += u'\n' + text
+                    elif last_record is not None:
+                        continuation.append(text)
+                    continue
+
+                seconds, level, message = fields
+                event, value = classify(message)
+                if event is None and level in ('ERROR', 'CRITICAL'):
+                    event = 'error'
+                batch.append([source, seconds, level, event, value, message])
+
+                if len(batch) >= BATCH_SIZE:
+                    last_record = self._insert(cursor, source, batch, continuation, last_record, offset)
+                    loaded += len(batch)
+                    batch, continuation = [], []
+
+            last_record = self._insert(cursor, source, batch, continuation, last_record, offset)
+            loaded += len(batch)
+            cursor.execute('UPDATE sources SET path = ? WHERE id = ?', (log_file, source))
+            self.connection.commit()
+        return loaded
+
+    def _insert(self, cursor, source, batch, continuation, last_record, offset):
+        # Writes a batch of records and the progress through the file in one transaction
+        if continuation:
+            cursor.execute('UPDATE records SET message = message || ? WHERE id = ?',
+                           (u''.join(u'\n' + line for line in continuation), last_record))
+        if batch:
+            cursor.executemany('INSERT INTO records (source, time, level, event, value, message) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            last_record = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+        cursor.execute('UPDATE sources SET offset = ?, last_record = ? WHERE id = ?', (offset, last_record, source))
+        self.connection.commit()
+        return last_record
+
+    def ingest_folder(self, folder):
+        ''' Loads the logs in a folder, oldest rotation first
+
+        Only output.log and its rotations are loaded if there are any, as they hold every record of error_log.log too.
+
+        :return: Number of records loaded
+        '''
+
+        for name in LOG_FILES:
+            files = glob.glob(os.path.join(folder, name)) + glob.glob(os.path.join(folder, name + '.[0-9]*'))
+            if files:
+                files.sort(key=lambda path: -int(path.rsplit('.', 1)[1]) if path[-1].isdigit() else 0)
+                return sum(self.ingest(path) for path in files)
+        return 0
+
+    def events(self, start=None, end=None, events=None, levels=None, text=None):
+        ''' Returns the records matching every condition given, in time order
+
+        :param start: Earliest time (seconds since the epoch)
+        :param end: Latest time
+        :param events: Event types to include
+        :param levels: Levels to include
+        :param text: Text that the message must contain
+        :return: List of (time, level, event, value, message)
+        '''
+
+        conditions, parameters = [], []
+        if start is not None:
+            conditions.append('time >= ?')
+            parameters.append(start)
+        if end is not None:
+            conditions.append('time <= ?')
+            parameters.append(end)
+        if events:
+            conditions.append('event IN ({})'.format(', '.join('?' * len(events))))
+            parameters.extend(events)
+        if levels:
+            conditions.append('level IN ({})'.format(', '.join('?' * len(levels))))
+            parameters.extend(levels)
+        if text:
+            conditions.append('instr(message, ?) > 0')
+            parameters.append(text)
+
+        query = 'SELECT time, level, event, value, message FROM records'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self.connection.execute(query + ' ORDER BY time, id', parameters).fetchall()
+
+    def photo_time(self, photo):
+        ''' Returns the time at which a photo was taken, or None if it isn't in the logs
+
+        The latest is used if the photo number appears more than once (e.g. logs from several test runs).
+        '''
+
+        row = self.connection.execute("SELECT max(time) FROM records WHERE event = 'photo' AND value = ?",
+                                      (photo,)).fetchone()
+        return row[0]
+
+    def around_photo(self, photo, seconds, events=None, levels=None):
+        ''' Returns the records within seconds of a photo being taken (see events) '''
+
+        taken = self.photo_time(photo)
+        if taken is None:
+            return []
+        return self.events(taken - seconds, taken + seconds, events, levels)
+
+
+def _time_argument(logbook, text):
+    # Accepts a full timestamp or a time of day, which is taken on the day of the first record
+    if text is None:
+        return None
+    seconds = parse_time(text)
+    if seconds is not None:
+        return seconds
+    first = logbook.connection.execute('SELECT min(time) FROM records').fetchone()[0]
+    if first is None:
+        return None
+    return parse_time(format_time(first)[:11] + text)
+
+
+def _print_records(records):
+    for seconds, level, event, value, message in records:
+        print(u'{} {:<8} {:<12} {}'.format(format_time(seconds), level, event or '', message).encode('utf-8'))
+    print("{} records".format(len(records)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Loads the payload's logs into a database and queries them")
+    parser.add_argument('--db', default='logbook.db', help="the SQLite database of the log book")
+    commands = parser.add_subparsers(dest='command')
+
+    ingest_parser = commands.add_parser('ingest', help="load the new records of log files or folders of logs")
+    ingest_parser.add_argument('logs', nargs='+', help="log files, or folders containing output.log")
+
+    around_parser = commands.add_parser('around', help="show the records around a photo")
+    around_parser.add_argument('--photo', type=int, required=True, help="the number of the photo")
+    around_parser.add_argument('--seconds', type=float, default=30, help="seconds before and after the photo")
+
+    events_parser = commands.add_parser('events', help="show the records matching a set of conditions")
+    events_parser.add_argument('--from', dest='start', help="earliest time, e.g. 09:30:00 or '2017-04-01 09:30:00'")
+    events_parser.add_argument('--to', dest='end', help="latest time")
+    events_parser.add_argument('--text', help="text that the message must contain")
+
+    for command_parser in (around_parser, events_parser):
+        command_parser.add_argument('--event', action='append', help="event type to show; may be repeated")
+        command_parser.add_argument('--level', action='append', type=str.upper, help="level to show; may be repeated")
+
+    args = parser.parse_args()
+    logbook = Logbook(args.db)
+
+    try:
+        if args.command == 'ingest':
+            for path in args.logs:
+                loaded = logbook.ingest_folder(path) if os.path.isdir(path) else logbook.ingest(path)
+                print("{}: {} new records".format(path, loaded))
+
+        elif args.command == 'around':
+            if logbook.photo_time(args.photo) is None:
+                parser.exit(1, "Photo {} isn't in the log book\n".format(args.photo))
+            _print_records(logbook.around_photo(args.photo, args.seconds, args.event, args.level))
+
+        elif args.command == 'events':
+            _print_records(logbook.events(_time_argument(logbook, args.start), _time_argument(logbook, args.end),
+                                          args.event, args.level, args.text))
+    finally:
+        logbook.close()
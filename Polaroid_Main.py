@@ -5,19 +5,28 @@
 Main script for #PolaroidsInSpace
 '''
 
-#import logging
-import os
+import argparse
+import datetime
+import logging
+import Queue
+import threading
 import time
 
-import RPi.GPIO as GPIO
-
 import Polaroid_Reference as r
-from Polaroid_Camera import PolaroidCamera
+from Polaroid_Camera import PiCamera, PolaroidCamera
 from Polaroid_Develop import DevelopingTray
 from Polaroid_Payload import Payload, Screen
+from Polaroid_Planner import ShotPlanner
 
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Checkpoint import MissionCheckpoint, PHASE_ASCENT, PHASE_COMPLETE, PHASE_PHOTOS
+from Utils.Polaroid_Hardware import GPIO
 from Utils.Polaroid_Logging import *
-from Utils.Sensehat_Stick import SenseStick
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Scheduler import MissionScheduler
+from Utils.Polaroid_Timing import timings
+
+logger = logging.getLogger('polaroid.main')
 
 # Set up the logging for the script
 #logging.basicConfig(filename="Polaroid_Log.txt",
@@ -25,181 +34,466 @@ from Utils.Sensehat_Stick import SenseStick
 #                    format='%(levelname)s: %(asctime)s %(message)s',
 #                    datefmt='%m/%d/%Y %I:%M:%S')
 
-initialize_logger(r.CONFIG_LOGGING_FOLDER)
-
 
-def run_diagnostic_checks(screen=None,developing_tray=None,payload=None,camera=None):
-    ''' Runs a series of dignostic tests on the payload to ensure that it's working correctly '''
-
-    screen.write("Running start-up diagnostics...")
-    number_of_errors = 0
-    g = [0, 255, 0]
-    r = [255, 0, 0]
-
-    # Payload
+def _run_check(name, test, results):
+    # Runs one diagnostic check on its own thread, putting (name, error) on the results queue when it finishes
     try:
-        payload.test()
+        test()
     except Exception, e:
-        logging.info("Payload config test failed")
-        logging.info("Error message: {}".format(e))
-        screen.write("Payload failed: {}".format(e))
-        number_of_errors +=1
-        screen.set_pixel(0,0,r)
+        results.put((name, e))
     else:
-        logging.info("Payload config test passed")
-        screen.write("Payload: passed")
-        screen.set_pixel(0,0,g)
+        results.put((name, None))
 
-    time.sleep(1)
+def run_diagnostic_checks(screen=None,developing_tray=None,payload=None,camera=None,pi_camera=None,
+                          timeout=r.DIAGNOSTIC_TIMEOUT_SECONDS):
+    ''' Runs a series of dignostic tests on the payload to ensure that it's working correctly
 
-    # Camera
-    try:
-        camera.test()
-    except Exception, e:
-        logging.info("Camera config test failed")
-        logging.info("Error message: {}".format(e))
-        screen.write("Camera failed: {}".format(e))
-        number_of_errors +=1
-        screen.set_pixel(1,0,r)
-    else:
-        logging.info("Camera config test passed")
-        screen.write("Camera: passed")
-        screen.set_pixel(1,0,g)
+    The checks run at the same time, each on its own thread, and the status pixel of each is set as it finishes (amber
+    while it runs, then green or red). A check that hasn't finished within timeout (real) seconds, e.g. because a
+    sensor read has hung, is failed and left to finish in the background. Only a short summary is scrolled at the end.
 
-    time.sleep(1)
+    :param timeout: Real seconds the checks are given to finish
+    :return: True if every check passed
+    '''
 
-    # Developing tray
-    try:
-        developing_tray.test()
-    except Exception, e:
-        logging.info("Developing tray config test failed")
-        logging.info("Error message: {}".format(e))
-        screen.write("Developing tray failed: {}".format(e))
-        number_of_errors +=1
-        screen.set_pixel(2,0,r)
+    g = [0, 255, 0]
+    r = [255, 0, 0]
+    amber = [255, 160, 0]
+
+    # The name, log description and status pixel of each check
+    checks = [('payload', "Payload", payload.test, (0, 0)),
+              ('camera', "Camera", camera.test, (1, 0)),
+              ('developing tray', "Developing tray", developing_tray.test, (2, 0))]
+    if pi_camera is not None and pi_camera.is_available():
+        checks.append(('pi camera', "Pi camera", pi_camera.test, (3, 0)))
     else:
-        logging.info("Developing tray config test passed")
-        screen.write("Developing tray passed")
-        screen.set_pixel(2,0,g)
-
-    time.sleep(1)
+        logger.info("Pi camera config test skipped, as there's no Pi camera module")     # The camera is optional
+    pixels = dict((name, pixel) for name, _, _, pixel in checks)
+    descriptions = dict((name, description) for name, description, _, _ in checks)
+
+    logger.info("Running start-up diagnostics")
+    results = Queue.Queue()
+    for name, _, test, pixel in checks:
+        screen.set_pixel(pixel[0], pixel[1], amber)
+        thread = threading.Thread(target=_run_check, args=(name, test, results), name='diagnostic_' + name)
+        thread.daemon = True            # A check that hangs mustn't keep the payload from shutting down
+        thread.start()
+
+    failed = []
+    pending = set(pixels)
+    deadline = time.time() + timeout
+    while pending:
+        try:
+            name, error = results.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            break
 
-    screen.write("Start-up checks completed", save_previous_screen=False)
+        pending.discard(name)
+        x, y = pixels[name]
+        if error is None:
+            logger.info("%s config test passed", descriptions[name])
+            screen.set_pixel(x, y, g)
+        else:
+            logger.info("%s config test failed", descriptions[name])
+            logger.info("Error message: %s", error)
+            failed.append(name)
+            screen.set_pixel(x, y, r)
+
+    for name in sorted(pending):
+        logger.info("%s config test failed", descriptions[name])
+        logger.info("Error message: no result within %ss", timeout)
+        failed.append(name)
+        screen.set_pixel(pixels[name][0], pixels[name][1], r)
+
+    if failed:
+        screen.write("Failed: {}".format(", ".join(failed)), save_previous_screen=False,
+                     priority=screen.PRIORITY_ERROR, key='diagnostics')
+    else:
+        screen.write("Checks passed", save_previous_screen=False, key='diagnostics')
     # Set the corner pixel to save the state for the user
-    if number_of_errors ==0:
+    if not failed:
         screen.set_pixel(0, 0, g)
     else:
         screen.set_pixel(0, 0, r)
 
-    logging.info("Number of errors on run_diagnostic_checks: {}".format(number_of_errors))
+    logger.info("Number of errors on run_diagnostic_checks: %s", len(failed))
+
+    return not failed
 
-    return number_of_errors==0
+def sensor_snapshot(camera=None, payload=None, developing_tray=None):
+    ''' Returns the latest sensor readings by name, to be stored with each frame from the Pi camera
+
+    Only the readings already taken by the background samplers are used, so it doesn't hold up the camera.
+    '''
 
-def take_photos_from_space(developing_tray=None,payload=None,camera=None):
+    snapshot = {}
+    estimate = payload.altitude_estimator.latest()
+    if estimate is not None:
+        snapshot.update(pressure=estimate.pressure, altitude=estimate.altitude, ascent_rate=estimate.ascent_rate)
+    samples = camera.sampler.buffer.latest(1)
+    if len(samples):
+        snapshot.update(zip(('accel_x', 'accel_y', 'accel_z', 'gyro_x', 'gyro_y', 'gyro_z'), samples[-1, 1:]))
+    reading = developing_tray.thermometers.latest(r.THERMOMETER_BATH_CHANNEL)
+    if reading is not None:
+        snapshot['tray_temperature'] = reading[1]
+    return snapshot
+
+def show_timings(screen=None):
+    ''' Logs the latency of each of the hot paths and scrolls their 95th percentiles across the screen '''
+
+    logger.info("Timings requested by user")
+    timings.log()
+    screen.write(timings.short_summary(), key='timings')
+
+def mission_state(payload=None, camera=None, developing_tray=None):
+    ''' Returns the state of the mission to be saved in a checkpoint (see Utils.Polaroid_Checkpoint) '''
+
+    now = hardware.clock.time()
+    flight_duration = (hardware.clock.now() - payload.launch_time).total_seconds()
+    return {
+        'launch_time': now - flight_duration,
+        'flight_duration': flight_duration,
+        'sea_level_pressure': payload.sea_level_pressure,
+        'photos_taken': camera.number_of_photos_taken,
+        'last_photo_time': camera.last_photo_clock_time,
+        'heater_enabled': developing_tray.heater_enabled,
+        'heater_duty_cycle': developing_tray.heater_duty_cycle,
+        'heater_duty_seconds': developing_tray.heater_duty_seconds,
+        'heater_integral': developing_tray.controller.integral,
+    }
+
+def restore_mission_state(state, payload=None, camera=None, developing_tray=None):
+    ''' Puts the payload, camera and developing tray back into the state saved by a checkpoint
+
+    The Pi has no real-time clock, so after a reboot its clock may be behind the time of the checkpoint. The launch
+    and the last photo are placed relative to the time of the checkpoint rather than by their clock times, and if the
+    clock is behind it the time spent rebooting is taken to be nothing.
+    '''
+
+    now = hardware.clock.time()
+    since_saved = max(now - state['saved_at'], 0)
+
+    flight_duration = state['flight_duration'] + since_saved
+    payload.launch_time = hardware.clock.now() - datetime.timedelta(seconds=flight_duration)
+    payload.get_flight_time()
+    payload.sea_level_pressure = state['sea_level_pressure'] or r.DEFAULT_SEA_LEVEL_PRESSURE
+    payload.altitude_estimator.sea_level_pressure = payload.sea_level_pressure
+    payload.altitude_estimator.reset()
+
+    camera.number_of_photos_taken = state['photos_taken']
+    if state['last_photo_time'] is not None:
+        since_last_photo = state['saved_at'] - state['last_photo_time'] + since_saved
+        camera.last_photo_clock_time = now - since_last_photo
+        camera.time_last_photo_taken = hardware.clock.now() - datetime.timedelta(seconds=since_last_photo)
+
+    developing_tray.heater_enabled = state['heater_enabled']
+    developing_tray.heater_duty_seconds = state['heater_duty_seconds']
+    if state['heater_enabled']:
+        # Carry on heating as before rather than waiting for the integral of the controller to build up again
+        developing_tray.controller.integral = state['heater_integral']
+        developing_tray.set_heater_duty_cycle(state['heater_duty_cycle'])
+
+    logger.info("Mission state restored: %s photos taken, %.0fs since launch, heater %s", camera.number_of_photos_taken,
+                flight_duration, 'enabled' if developing_tray.heater_enabled else 'disabled')
+
+def take_photos_from_space(developing_tray=None,payload=None,camera=None,screen=None,stick=None,pi_camera=None,
+                           checkpoint=None,resume_phase=None):
     ''' Takes photos from space using the on-board Polaroid camera, continues until all available shots have been taken
 
+    The thermostat, altitude sampling, stability monitoring and status display each run as their own periodic task,
+    and the joystick is answered by its listener thread, so they carry on while the camera waits to take a photo. Each
+    polaroid is paired with a burst of frames from the Pi camera, which are written in the background.
+
+    :param checkpoint: MissionCheckpoint that the state of the mission is saved to, if any
+    :param resume_phase: The phase of an interrupted mission being resumed (PHASE_ASCENT or PHASE_PHOTOS), or None
     :return:
     '''
 
-    while True:
+    photos_triggered = threading.Event()
+    phase = [resume_phase or PHASE_ASCENT]     # The current phase, updated by the mission loop
+    checkpoint_lock = threading.Lock()          # So a periodic save can't overwrite a newer phase with an older one
 
-        developing_tray.check()                                 # Check to see whether the tray should be heated
+    def save_checkpoint():
+        if checkpoint is not None:
+            with checkpoint_lock:
+                if phase[0] == PHASE_COMPLETE:
+                    checkpoint.clear()          # Nothing to resume, so the next boot starts a new mission
+                else:
+                    checkpoint.save(phase[0], **mission_state(payload, camera, developing_tray))
+
+    if resume_phase == PHASE_PHOTOS:
+        photos_triggered.set()              # The photos had already started, so don't wait for the altitude again
+
+    def sample_altitude():
         payload.get_pressure()                                  # Check the altitude of the payload
         payload.get_flight_time()                               # Check how long the payload has been in flight
 
-        logging.info("Payload pressure: {}".format(payload.current_pressure))
-        logging.info("Payload flight time: {}".format(payload.flight_duration))
+        logger.info("Payload pressure: %s", payload.current_pressure)
+        logger.info("Payload flight time: %s", payload.flight_duration)
 
         # Check if the payload is high enough or the delay since launch has been long enough. If so, start to take photos
         if payload.current_pressure < r.PHOTOS_MIN_ATMOSPHERIC_PRESSURE or payload.flight_duration > r.PHOTOS_MAX_TIME_DELAY:
+            photos_triggered.set()
+        elif payload.burst_detected:                            # The balloon burst early, so this is as high as it gets
+            logger.info("Balloon burst before the photos were triggered")
+            photos_triggered.set()
+
+    def show_status(event):
+        if event.key == stick.KEY_RIGHT:
+            show_timings(screen)
+            return
+        logger.info("Mission status requested by user")
+        screen.write("Photos: {} Pressure: {:.0f}".format(camera.number_of_photos_taken, payload.current_pressure),
+                     key='status')
+
+    scheduler = MissionScheduler()
+    scheduler.add_task('thermostat', developing_tray.check, r.SCHEDULER_THERMOSTAT_PERIOD)  # Heat the tray if needed
+    scheduler.add_task('altitude', sample_altitude, r.SCHEDULER_ALTITUDE_PERIOD)
+    scheduler.add_task('stability', camera.get_acceleration, r.SCHEDULER_STABILITY_PERIOD)
+    if checkpoint is not None:
+        scheduler.add_task('checkpoint', save_checkpoint, r.CHECKPOINT_SECONDS)   # Saves the first as it starts
+    if screen is not None:
+        scheduler.add_task('display', lambda: screen.show_mission_status(camera.number_of_photos_taken,
+                                                                         developing_tray.heater_currently_on),
+                           r.SCHEDULER_DISPLAY_PERIOD)
+        if stick is not None:
+            stick.add_callback(show_status)     # Right shows the timings, any other press the status of the mission
+            stick.start()
+    scheduler.start()
 
-            camera.calibrate_acceleration()  # Set an initial moving average for the payload
-            logging.info("Camera acceleration calibrated: {}".format(camera.acceleration_exponential_ma))
-
-            logging.info("### Photo taking process commenced ###")
-            logging.info("Payload current pressure: {}".format(payload.current_pressure))
-            logging.info("Payload flight duration: {}".format(payload.flight_duration))
+    try:
+        while not hardware.clock.wait(photos_triggered, r.SCHEDULER_ALTITUDE_PERIOD):
+            pass
+
+        camera.calibrate_acceleration()  # Set an initial moving average for the payload
+        logger.info("Camera acceleration calibrated: %s", camera.acceleration_exponential_ma)
+
+        logger.info("### Photo taking process commenced ###")
+        logger.info("Payload current pressure: %s", payload.current_pressure)
+        logger.info("Payload flight duration: %s", payload.flight_duration)
+
+        developing_tray.heater_enabled = False              # Disable the heater once the photos start to prevent
+        logger.info("Developing tray heater disabled")      # them being burned by the wire
+        phase[0] = PHASE_PHOTOS
+        save_checkpoint()
+
+        # Keep trying to take photos while there are photos available in the cartridge
+        while camera.number_of_photos_taken < r.PHOTOS_NUMBER_OF_SHOTS:
+            # Test to see whether photo should be taken and if so, take one
+            camera.take_photo()
+            logger.info("Polaroid photo taken: %s", camera.number_of_photos_taken)
+            save_checkpoint()                       # So the photo isn't taken again after a reboot
+            if pi_camera is not None:
+                pi_camera.take_photo()              # Only queues the frames, so doesn't hold up the next polaroid
+            logger.info("Payload current acceleration: %s", camera.current_acceleration)
+            logger.info("Payload average acceleration: %s", camera.acceleration_exponential_ma)
+            logger.info("Payload swing estimate: %s", camera.swing)
+            logger.info("Payload current pressure: %s", payload.current_pressure)
+            logger.info("Payload flight duration: %s", payload.flight_duration)
+
+        logger.info("All polaroids photo taken, process ended")
+        phase[0] = PHASE_COMPLETE
+        save_checkpoint()
+
+    finally:
+        scheduler.stop()
+        if stick is not None:
+            stick.stop()
+            stick.clear_callbacks()
+
+def discard_requested(screen=None, stick=None, timeout=r.CHECKPOINT_DISCARD_SECONDS):
+    ''' Gives the user a moment at boot to discard the checkpoint of an interrupted mission by pressing left
+
+    :param timeout: Real seconds to wait for the press
+    :return: True if the checkpoint should be discarded
+    '''
 
-            developing_tray.heater_enabled = False              # Disable the heater once the photos start to prevent
-            logging.info("Developing tray heater disabled")     # them being burned by the wire
+    screen.write("Resuming", key='status')
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for event in stick.read_events(deadline - time.time()):
+            if event.key == stick.KEY_LEFT and event.state in (stick.STATE_PRESS, stick.STATE_HOLD):
+                logger.info("Mission checkpoint discarded by user")
+                screen.write("Checkpoint discarded", key='status')
+                return True
+    return False
+
+def fly_mission(developing_tray=None,payload=None,camera=None,screen=None,stick=None,pi_camera=None,checkpoint=None,
+                resume_phase=None):
+    ''' Takes the photos (see take_photos_from_space), then stops the payload once they've all been taken '''
+
+    take_photos_from_space(developing_tray=developing_tray, payload=payload, camera=camera, screen=screen, stick=stick,
+                           pi_camera=pi_camera, checkpoint=checkpoint, resume_phase=resume_phase)
+    pi_camera.stop()
+    camera.stop_sampling()
+    developing_tray.stop_sampling()
+    payload.stop_sampling()
+    timings.stop_logging()
+    flight_recorder.close()
+    screen.close()
+    shutdown_logger()
+
+def main(simulate=False, time_warp=1.0, logging_folder=r.CONFIG_LOGGING_FOLDER, splash=r.SPLASH_MODE,
+         recorder_folder=r.RECORDER_FOLDER, logging_level=r.LOGGING_LEVEL, subsystem_levels=None,
+         frame_folder=r.PICAMERA_FOLDER, checkpoint_file=r.CHECKPOINT_FILE):
+    ''' Runs the payload from power-on until the mission is complete
+
+    If the checkpoint shows that a mission was interrupted recently (e.g. by a brownout rebooting the Pi), it is resumed
+    in the phase it had reached, skipping the splash screen, the diagnostics and the wait for the joystick, unless left
+    is pressed within r.CHECKPOINT_DISCARD_SECONDS of it being found.
+
+    :param simulate: True to run against the simulated hardware instead of the Raspberry Pi
+    :param time_warp: Speed of the mission clock relative to real time
+    :param logging_folder: The directory that the *.log files are written to
+    :param logging_level: Lowest level of the messages logged
+    :param subsystem_levels: Dict of logging levels by subsystem, e.g. {'camera': 'INFO'} (r.LOGGING_SUBSYSTEM_LEVELS
+                             if None)
+    :param splash: Splash screen shown at start-up: 'full', 'short' or 'none'
+    :param recorder_folder: The directory that the binary flight recording is written to
+    :param frame_folder: The directory that the frame store of the Pi camera is written to
+    :param checkpoint_file: The file that the checkpoint of the mission is saved to
+    :return:
+    '''
 
-            # Keep trying to take photos while there are photos available in the cartridge
-            while camera.number_of_photos_taken < r.PHOTOS_NUMBER_OF_SHOTS:
-                # Test to see whether photo should be taken and if so, take one
-                camera.take_photo()
-                logging.info("Polaroid photo taken: {}".format(camera.number_of_photos_taken))
-                logging.info("Payload current acceleration: {}".format(camera.current_acceleration))
-                logging.info("Payload average acceleration: {}".format(camera.acceleration_exponential_ma))
-                logging.info("Payload current pressure: {}".format(payload.current_pressure))
-                logging.info ("Payload flight duration: {}".format(payload.flight_duration))
+    initialize_logger(logging_folder, logging_level, subsystem_levels)
 
-            logging.info("All polaroids photo taken, process ended")
-            break
+    if simulate:
+        hardware.use_backend(hardware.BACKEND_SIMULATED, time_warp=time_warp)
 
+    try:
+        flight_recorder.open(recorder_folder)
+    except (IOError, OSError), e:       # The flight can go ahead without the recording, so carry on regardless
+        logger.error("Unable to start the flight recorder in %s", recorder_folder)
+        logger.error("Error message: %s", e)
+    timings.start_logging()             # Summarise the latency of the hot paths in the log every few minutes
+
+    screen = Screen()
+    stick = hardware.get_stick()
+    # The snapshot is only taken once the Pi camera has started, by when the other objects all exist
+    pi_camera = PiCamera(folder=frame_folder,
+                         snapshot=lambda: sensor_snapshot(camera, payload, developing_tray))
+    payload = Payload()
+    camera = PolaroidCamera(screen=screen, pi_camera=pi_camera, planner=ShotPlanner(payload))
+    developing_tray = DevelopingTray()
+
+
+    # Set up the GPIO pins on the Board
+    GPIO.setmode(GPIO.BOARD)        # Defines the naming convention for the GPIO pins
+    GPIO.setup(r.GPIO_PIN_SHUTTER, GPIO.OUT)
+    GPIO.setup(r.GPIO_PIN_DEVELOP_TRAY, GPIO.OUT)
+    GPIO.setup(r.GPIO_PIN_EXTERNAL_THERMOMETER, GPIO.OUT)
+
+    camera.start_sampling()         # Keep a buffer of recent accelerometer readings for the stability checks
+    developing_tray.start_sampling()    # Keep the latest developing tray temperature for the thermostat
+    payload.start_sampling(camera.sampler.buffer)   # Keep estimating the altitude from the barometer and the IMU
+    pi_camera.start()               # Keep a ring of recent frames to pick a burst from for each polaroid
+
+    checkpoint = MissionCheckpoint(checkpoint_file)
+    state = checkpoint.load()
+    if checkpoint.is_resumable(state):
+        if discard_requested(screen, stick):
+            checkpoint.clear()
         else:
-            time.sleep(15)
+            logger.info("### Resuming interrupted mission in the %s phase ###", state['phase'])
+            restore_mission_state(state, payload=payload, camera=camera, developing_tray=developing_tray)
+            screen.write("Mission resumed", key='status')
+            fly_mission(developing_tray=developing_tray, payload=payload, camera=camera, screen=screen, stick=stick,
+                        pi_camera=pi_camera, checkpoint=checkpoint, resume_phase=state['phase'])
+            return
+
+    screen.display_splash(splash)   # Opening screen for the SenseHat
+
+    run_diagnostic_checks(screen=screen, developing_tray=developing_tray,payload=payload,camera=camera,
+                          pi_camera=pi_camera)
+
+    # Start the joystick
+    shutdown_check = 0
+    for event in stick:                                 # Presses in fast sequence are debounced by the stick
+
+        if event.state == stick.STATE_PRESS:
+
+            if shutdown_check ==1:                      # If the user has selected the shutdown command
+                if event.key == stick.KEY_DOWN:        # ToDo: Should the shutdown sequence be more robust?
+                    screen.write("System shutting down...")
+                    logger.info("Shutdown command confirmed by user, system shutting down")
+                    screen.flush()
+                    pi_camera.stop()                    # Write out the frames still queued
+                    timings.stop_logging()
+                    flight_recorder.close()
+                    shutdown_logger()                   # Write out the queued log records before powering off
+                    hardware.shutdown()
+                else:                                   # Reset the check for any other keypress
+                    screen.write("Cancelled", save_previous_screen=False)
+                    logger.info("Shutdown command cancelled by user")
+                    screen.flush()
+                    screen.restore_previous_screen()
+                    shutdown_check = 0
+
+            else:
+                if event.key == stick.KEY_ENTER:
+                    screen.write("Please confirm shutdown")
+                    logger.info("Shutdown command requested by user")
+                    screen.flush()
+                    shutdown_check =1                   # Set check to high state and display red warning screen
+                    screen.save_current_screen()
+                    red_array = [[255, 0, 0]] * 64
+                    screen.set_pixels(red_array)
+                    hardware.clock.sleep(1)
+
+                elif event.key == stick.KEY_UP: # Start the camera
+                    screen.write("Camera started", save_previous_screen=False)
+                    logger.info("Camera sequence started by user")
+                    payload.set_sea_level_pressure()
+                    fly_mission(developing_tray=developing_tray, payload=payload, camera=camera, screen=screen,
+                                stick=stick, pi_camera=pi_camera, checkpoint=checkpoint)
+                    break
+
+                elif event.key == stick.KEY_DOWN:
+                    run_diagnostic_checks(screen=screen, developing_tray=developing_tray, payload=payload, camera=camera,
+                                          pi_camera=pi_camera)
+
+                elif event.key == stick.KEY_RIGHT:
+                    show_timings(screen)
+
+                elif event.key == stick.KEY_LEFT:
+                    pass
 
 ### Main entry point ###
 
-screen = Screen()
-stick = SenseStick()
-camera = PolaroidCamera()
-developing_tray = DevelopingTray()
-payload = Payload()
-
-
-# Set up the GPIO pins on the Board
-GPIO.setmode(GPIO.BOARD)        # Defines the naming convention for the GPIO pins
-GPIO.setup(r.GPIO_PIN_SHUTTER, GPIO.OUT)
-GPIO.setup(r.GPIO_PIN_DEVELOP_TRAY, GPIO.OUT)
-GPIO.setup(r.GPIO_PIN_EXTERNAL_THERMOMETER, GPIO.OUT)
-
-screen.display_splash()         # Opening screen for the SenseHat
-
-run_diagnostic_checks(screen=screen, developing_tray=developing_tray,payload=payload,camera=camera)
-
-# Start the joystick
-shutdown_check = 0
-for event in stick:                                 # ToDo: Introduce a delay to stop button presses in fast sequence
-
-    if event.state == stick.STATE_PRESS:
-
-        if shutdown_check ==1:                      # If the user has selected the shutdown command
-            if event.key == stick.KEY_DOWN:        # ToDo: Should the shutdown sequence be more robust?
-                screen.write("System shutting down...")
-                logging.info("Shutdown command confirmed by user, system shutting down")
-                os.system("sudo shutdown -h now")
-            else:                                   # Reset the check for any other keypress
-                screen.write("Cancelled", save_previous_screen=False)
-                logging.info("Shutdown command cancelled by user")
-                screen.restore_previous_screen()
-                shutdown_check = 0
-
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="#PolaroidsInSpace payload controller")
+    parser.add_argument('--simulate', action='store_true',
+                        help="run against simulated hardware instead of the Raspberry Pi")
+    parser.add_argument('--time-warp', type=float, default=1.0,
+                        help="mission seconds that pass for every real second (e.g. 3600 flies an hour a second)")
+    parser.add_argument('--log-folder', default=r.CONFIG_LOGGING_FOLDER,
+                        help="directory that the *.log files are written to")
+    parser.add_argument('--splash', choices=('full', 'short', 'none'), default=r.SPLASH_MODE,
+                        help="splash screen shown at start-up ('short' shows just the fades, 'none' skips it)")
+    parser.add_argument('--record-folder', default=r.RECORDER_FOLDER,
+                        help="directory that the binary flight recording is written to")
+    parser.add_argument('--frame-folder', default=r.PICAMERA_FOLDER,
+                        help="directory that the frame store of the Pi camera is written to")
+    parser.add_argument('--checkpoint-file', default=r.CHECKPOINT_FILE,
+                        help="file that the checkpoint of the mission is saved to, and resumed from after a reboot")
+    parser.add_argument('--log-level', action='append', default=[], metavar='[SUBSYSTEM=]LEVEL',
+                        help="lowest level of the messages logged, for the whole payload or for one subsystem "
+                             "(e.g. --log-level INFO --log-level camera=DEBUG); may be repeated")
+    args = parser.parse_args()
+
+    logging_level = r.LOGGING_LEVEL
+    subsystem_levels = dict(r.LOGGING_SUBSYSTEM_LEVELS)
+    for setting in args.log_level:
+        subsystem, _, level = setting.rpartition('=')
+        if subsystem:
+            subsystem_levels[subsystem] = level
         else:
-            if event.key == stick.KEY_ENTER:
-                screen.write("Please confirm shutdown")
-                logging.info("Shutdown command requested by user")
-                shutdown_check =1                   # Set check to high state and display red warning screen
-                screen.save_current_screen()
-                red_array = [[255, 0, 0]] * 64
-                screen.sense.set_pixels(red_array)
-                time.sleep(1)
-
-            elif event.key == stick.KEY_UP: # Start the camera
-                screen.write("Camera started", save_previous_screen=False)
-                logging.info("Camera sequence started by user")
-                payload.set_sea_level_pressure()
-                take_photos_from_space(developing_tray=developing_tray, payload=payload, camera=camera)
-                break
-
-            elif event.key == stick.KEY_DOWN:
-                run_diagnostic_checks(screen=screen, developing_tray=developing_tray, payload=payload, camera=camera)
-
-            elif event.key == stick.KEY_RIGHT:
-                pass
-
-            elif event.key == stick.KEY_LEFT:
-                pass
+            logging_level = level
+
+    main(simulate=args.simulate, time_warp=args.time_warp, logging_folder=args.log_folder, splash=args.splash,
+         recorder_folder=args.record_folder, logging_level=logging_level, subsystem_levels=subsystem_levels,
+         frame_folder=args.frame_folder, checkpoint_file=args.checkpoint_file)
 
 # ToDo: ### April 2017 ToDo list ###
 # ToDo: Integrate non-Polaroid camera into payload
@@ -4,14 +4,21 @@
 ''' Controls the screen of the SenseHAT
 '''
 
+import collections
 import logging
-import time
 import random
-import datetime
+import threading
+import time
 
-from sense_hat import SenseHat
+import numpy
 
 import Polaroid_Reference as r
+from Polaroid_Altitude import AltitudeEstimator
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Timing import timings
+
+logger = logging.getLogger('polaroid.payload')
+
 
 class Payload(object):
     ''' Controls the payload capsule '''
@@ -19,23 +26,58 @@ class Payload(object):
     def __init__(self):
 
         self.current_pressure = 0
-        self.sense = SenseHat()
-        self.launch_time = datetime.datetime.now()
+        self.sense = hardware.get_sense_hat()
+        self.launch_time = hardware.clock.now()
         self.flight_duration = 0
         self.sea_level_pressure = 0
 
+        self.altitude = 0                   # Estimated altitude in metres
+        self.ascent_rate = 0                # Estimated ascent rate in metres per second (negative when descending)
+        self.burst_detected = False         # True once the balloon has burst
+        self.altitude_estimator = AltitudeEstimator(self.sense)
+
+    def start_sampling(self, imu_buffer=None):
+        ''' Starts estimating the altitude in the background from the barometer (and the IMU, if a buffer is given)
+
+        Once started, get_pressure takes the filtered pressure, altitude and ascent rate from the estimator rather than
+        a single reading of the barometer.
+
+        :param imu_buffer: RingBuffer of IMU samples (e.g. camera.sampler.buffer) to fuse into the estimate
+        :return:
+        '''
+
+        self.altitude_estimator.imu_buffer = imu_buffer
+        self.altitude_estimator.start()
+        logger.info("Altitude estimation started every %ss", self.altitude_estimator.period)
+
+    def stop_sampling(self):
+        ''' Stops estimating the altitude in the background '''
+
+        self.altitude_estimator.stop()
+        logger.info("Altitude estimation stopped (%s readings rejected)", self.altitude_estimator.rejected_readings)
+
+    @timings.timed('pressure')
     def get_pressure(self):
 
-        self.sense.clear()
+        if self.altitude_estimator.is_running():
+            estimate = self.altitude_estimator.latest()
+            if estimate is not None:
+                self.current_pressure = estimate.pressure
+                self.altitude = estimate.altitude
+                self.ascent_rate = estimate.ascent_rate
+                self.burst_detected = estimate.burst
+                logger.info("Current pressure: %s (altitude %.0fm, ascent rate %.1fm/s)",
+                            self.current_pressure, self.altitude, self.ascent_rate)
+                return
 
         try:
             self.current_pressure = self.sense.get_pressure()
         except Exception, e:
-            logging.error("Unable to determine atmospheric current_pressure")
-            logging.error("Error message: {}".format(e))
+            logger.error("Unable to determine atmospheric current_pressure")
+            logger.error("Error message: %s", e)
             raise e
         else:
-            logging.info("Current pressure: {}".format(self.current_pressure))
+            logger.info("Current pressure: %s", self.current_pressure)
 
     def set_sea_level_pressure(self):
         ''' Calibrates the payload by setting the current_pressure at sea level '''
@@ -43,15 +85,19 @@ class Payload(object):
         try:
             self.get_pressure()
         except:
-            logging.error("Unable to determine sea_level atmospheric current_pressure")
+            logger.error("Unable to determine sea_level atmospheric current_pressure")
             self.sea_level_pressure = r.DEFAULT_SEA_LEVEL_PRESSURE
         else:
-            logging.info("Sealevel pressure set as {}".format(r.DEFAULT_SEA_LEVEL_PRESSURE))
+            logger.info("Sealevel pressure set as %s", r.DEFAULT_SEA_LEVEL_PRESSURE)
             self.sea_level_pressure = r.DEFAULT_SEA_LEVEL_PRESSURE # (self.current_pressure * 1.0)
 
+        if self.sea_level_pressure != self.altitude_estimator.sea_level_pressure:
+            self.altitude_estimator.sea_level_pressure = self.sea_level_pressure
+            self.altitude_estimator.reset()
+
     def get_flight_time(self):
         ''' Measures the flight time of the payload in seconds'''
-        time_now = datetime.datetime.now()
+        time_now = hardware.clock.now()
         time_elapsed = (time_now - self.launch_time).total_seconds()
         self.flight_duration = time_elapsed
 
@@ -59,19 +105,51 @@ class Payload(object):
         ''' Runs test diagnostics on the payload object'''
         pass
 
+_ScreenMessage = collections.namedtuple('_ScreenMessage', ('priority', 'sequence', 'key', 'text', 'restore'))
+
+
 class Screen(object):
     ''' Controls the screen of the Sense HAT
+
+    Messages are scrolled across the screen by a render thread, so Screen.write returns immediately rather than taking
+    several seconds per message. Waiting messages are shown in order of priority (errors before status), a message
+    replaces any waiting message with the same key, and only one message scrolls at a time.
+
+    The screen keeps a shadow of the 8x8 pixels in memory, so saving and restoring the screen is a copy and only the
+    pixels that have changed are sent to the Sense HAT.
     '''
 
+    PRIORITY_ERROR = 0              # Shown before any waiting status messages
+    PRIORITY_STATUS = 1
+
+    SPLASH_FULL = 'full'
+    SPLASH_SHORT = 'short'
+    SPLASH_NONE = 'none'
+    SPLASH_SHORT_SECTIONS = ('fade_in', 'fade_out')
+    SPLASH_VERSION = 1              # Change whenever the splash animation changes, so cached frames are recompiled
+
     def __init__(self):
 
-        self.previous_state = []    # A list of the pixels on-screen used to revert to previous image
-        self.current_state = []     # The current array of pixels on the screen
-        self.sense = SenseHat()
+        self.previous_state = None  # A copy of the pixels on-screen used to revert to previous image
+        self.sense = hardware.get_sense_hat()
+        self.current_state = numpy.array(self.sense.get_pixels(), dtype=numpy.uint8)  # The 64 RGB pixels on the screen
+
+        self._pending = {}                          # Messages waiting to be shown, by key
+        self._sequence = 0                          # Number of messages written, to show messages in order
+        self._scrolling = False
+        self._closing = False
+        self._pending_changed = threading.Condition()
+        self._display_lock = threading.Lock()       # Held while a message or animation is on the screen
+        self._pixels_lock = threading.Lock()        # Guards current_state and the writes of pixels to the Sense HAT
+        self._message_showing = False               # While True, pixels are drawn to current_state only
+
+        self._render_thread = threading.Thread(target=self._render, name='screen')
+        self._render_thread.daemon = True
+        self._render_thread.start()
 
     def _fade_in_logo(self, fade_in_time = 1.0, number_of_fade_steps = 25, max_brightness = 255):
         '''
-        Fades in the e3 logo
+        Yields the frames that fade in the e3 logo, with the number of seconds each is shown for
 
         fade_in_time = duration of fade-in in seconds
 
@@ -93,14 +171,13 @@ class Screen(object):
                     w,w,b,b,b,b,b,b,
                     ]
 
-            self.sense.set_pixels(e3_logo)
-            time.sleep(fade_in_time / number_of_fade_steps)
+            yield e3_logo, float(fade_in_time) / number_of_fade_steps
 
     def _fade_out_logo(self, fade_out_time = 1.0, number_of_fade_steps = 25,initial_brightness=255):
         '''
-        Fades in the e3 logo
+        Yields the frames that fade out the e3 logo, with the number of seconds each is shown for
 
-        fade_in_time = duration of fade-in in seconds
+        fade_out_time = duration of fade-out in seconds
 
         '''
 
@@ -120,12 +197,11 @@ class Screen(object):
                     w,w,b,b,b,b,b,b,
                     ]
 
-            self.sense.set_pixels(e3_logo)
-            time.sleep(fade_out_time / number_of_fade_steps)
+            yield e3_logo, float(fade_out_time) / number_of_fade_steps
 
-    def _sweep_diagonal(self, dim_ratio=0.5):
+    def _sweep_diagonal(self, start_pixels, dim_ratio=0.5):
         '''
-        Sweeps diagnoally over the screen, dimming each pixel on the diagonal
+        Yields the frames that sweep diagonally over start_pixels, dimming each pixel on the diagonal
         '''
         diagonal_lines = [
                     [[0, 0]],
@@ -145,25 +221,26 @@ class Screen(object):
                     [[7, 7]]
                     ]
 
-        for i, pixel_row in enumerate(diagonal_lines):
+        diagonal_indices = [[y * 8 + x for x, y in pixel_row] for pixel_row in diagonal_lines]
+
+        pixels = numpy.array(start_pixels, dtype=numpy.uint8)
+
+        for i, pixel_row in enumerate(diagonal_indices):
+
+            pixels = pixels.copy()
 
             # Convert the leading diagonal row
-            for pixel in pixel_row:
-                old_colour = self.sense.get_pixel(pixel[0],pixel[1])
-                new_pixel_colour = [int(a*dim_ratio) for a in old_colour]
-                self.sense.set_pixel(pixel[0], pixel[1], new_pixel_colour)
+            pixels[pixel_row] = pixels[pixel_row] * dim_ratio
 
             # Convert the following diagonal row
             if i > 0:
-                for pixel in diagonal_lines[i-1]:
-                    old_colour = self.sense.get_pixel(pixel[0],pixel[1])
-                    new_pixel_colour = [int(a/dim_ratio) for a in old_colour]
-                    self.sense.set_pixel(pixel[0], pixel[1], new_pixel_colour)
-
+                previous_row = diagonal_indices[i-1]
+                pixels[previous_row] = numpy.minimum(pixels[previous_row] / dim_ratio, 255)
 
-            time.sleep(0.05)
+            yield pixels, 0.05
 
     def _flare_display(self):
+        ''' Yields the frames that dim and then brighten the e3 logo '''
 
         # Dim the pixels in the logo
         for i in range(200,150,-1):
@@ -181,7 +258,7 @@ class Screen(object):
                 w,b,b,b,b,b,b,b,
                 w,w,b,b,b,b,b,b,
                 ]
-            self.sense.set_pixels(e3_logo)
+            yield e3_logo, r.SPLASH_FLARE_FRAME_SECONDS
 
         # Increase the brightness of pixels in the logo
         for i in range(150,255,1):
@@ -199,19 +276,20 @@ class Screen(object):
                 w,b,b,b,b,b,b,b,
                 w,w,b,b,b,b,b,b,
                 ]
-            self.sense.set_pixels(e3_logo)
+            yield e3_logo, r.SPLASH_FLARE_FRAME_SECONDS
 
-    def _shimmer(self):
+    def _shimmer(self, rng=random):
+        ''' Yields the frames that shimmer the pixels of the e3 logo '''
 
         for t in range(0,50):
 
             black_max = 255
             black_min = 200
 
-            r1 = random.randint(black_min,black_max)
-            r2 = random.randint(black_min,black_max)
-            r3 = random.randint(black_min,black_max)
-            r4 = random.randint(black_min,black_max)
+            r1 = rng.randint(black_min,black_max)
+            r2 = rng.randint(black_min,black_max)
+            r3 = rng.randint(black_min,black_max)
+            r4 = rng.randint(black_min,black_max)
 
             a = [r1,r1,r1]
             b = [r2,r2,r2]
@@ -230,22 +308,96 @@ class Screen(object):
                         w,w,b,d,c,b,a,b,
                         ]
 
-            self.sense.set_pixels(e3_logo)
-            time.sleep(0.1)
+            yield e3_logo, 0.1
+
+    def _compile_splash(self):
+        ''' Renders every frame of the splash screen into packed RGB565 framebuffer bytes
+
+        :return: (list of frames, list of seconds each frame is shown for, list of the section each frame belongs to)
+        '''
+
+        frames, seconds, sections = [], [], []
+
+        def add(section, animation):
+            for pixels, duration in animation:
+                frames.append(hardware.pack_rgb565(pixels))
+                seconds.append(duration)
+                sections.append(section)
+            return pixels
+
+        # The fades last a second each, about as long as writing their frames one by one through set_pixels took
+        logo = add('fade_in', self._fade_in_logo(fade_in_time=1, number_of_fade_steps = 50, max_brightness=200))
+        add('sweep', self._sweep_diagonal(logo, 0.7))
+        seconds[-1] += 0.2
+        add('flare', self._flare_display())
+        add('shimmer', self._shimmer(random.Random(0)))
+        add('fade_out', self._fade_out_logo(fade_out_time=1, number_of_fade_steps = 50, initial_brightness=255))
+        add('fade_out', [(numpy.zeros((64, 3), dtype=numpy.uint8), 0)])
+
+        return frames, seconds, sections
+
+    def _load_splash(self, cache_file=r.SPLASH_CACHE_FILE):
+        ''' Returns the frames of the splash screen, from the cache file if it is up to date or compiled if not
+
+        :return: (list of frames, list of seconds each frame is shown for, list of the section each frame belongs to)
+        '''
+
+        try:
+            cache = numpy.load(cache_file)
+            if int(cache['version']) == self.SPLASH_VERSION:
+                frames = [frame.tobytes() for frame in cache['frames']]
+                return frames, cache['seconds'].tolist(), cache['sections'].tolist()
+        except Exception, e:
+            logger.info("Splash screen cache not loaded from %s: %s", cache_file, e)
+
+        frames, seconds, sections = self._compile_splash()
+
+        try:
+            with open(cache_file, 'wb') as f:
+                numpy.savez(f, version=self.SPLASH_VERSION, seconds=seconds, sections=sections,
+                            frames=numpy.frombuffer(b''.join(frames), dtype=numpy.uint8).reshape(len(frames), -1))
+        except Exception, e:
+            logger.warning("Unable to cache the splash screen in %s", cache_file)
+            logger.warning("Error message: %s", e)
+        else:
+            logger.info("Splash screen compiled and cached in %s", cache_file)
 
-    def display_splash(self):
+        return frames, seconds, sections
+
+    def display_splash(self, mode=r.SPLASH_MODE):
         ''' Displays a splash screen on the Sense HAT display
 
+        The frames are compiled once and played back straight into the Sense HAT framebuffer, falling back to
+        set_pixels if the framebuffer can't be mapped.
+
+        :param mode: Screen.SPLASH_FULL, Screen.SPLASH_SHORT (just the fades) or Screen.SPLASH_NONE to skip the splash
         :return:
         '''
 
-        self._fade_in_logo(fade_in_time=2, number_of_fade_steps = 50, max_brightness=200)
-        self._sweep_diagonal(0.7)
-        time.sleep(0.2)
-        self._flare_display()
-        self._shimmer()
-        self._fade_out_logo(fade_out_time=2, number_of_fade_steps = 50, initial_brightness=255)
-        self.sense.clear()
+        if mode == self.SPLASH_NONE:
+            logger.info("Splash screen skipped")
+            return
+
+        frames, seconds, sections = self._load_splash()
+        if mode == self.SPLASH_SHORT:
+            shown = [i for i, section in enumerate(sections) if section in self.SPLASH_SHORT_SECTIONS]
+            frames, seconds = [frames[i] for i in shown], [seconds[i] for i in shown]
+
+        framebuffer = hardware.get_framebuffer()
+
+        with self._display_lock:
+            # Pace the frames against fixed deadlines so the time taken to write them doesn't slow the animation
+            deadline = hardware.clock.time()
+            for frame, duration in zip(frames, seconds):
+                if framebuffer is not None:
+                    framebuffer.write(frame)
+                else:
+                    self.sense.set_pixels(hardware.unpack_rgb565(frame).tolist())
+                deadline += duration
+                hardware.clock.sleep(deadline - hardware.clock.time())
+
+            with self._pixels_lock:
+                self.current_state[:] = hardware.unpack_rgb565(frames[-1])
 
     def save_current_screen(self):
         ''' Saves the current screen to memory so that it can be restored later
@@ -253,12 +405,8 @@ class Screen(object):
         :return:
         '''
 
-        screen_pixels = []
-        for y in range(0,8):
-            for x in range(0,8):
-                pixel = self.sense.get_pixel(x,y)
-                screen_pixels.append(pixel)
-        self.previous_state = screen_pixels
+        with self._pixels_lock:
+            self.previous_state = self.current_state.copy()
 
     def restore_previous_screen(self):
         ''' Writes the stored previous screen to the screen
@@ -266,26 +414,142 @@ class Screen(object):
         :return:
         '''
 
-        if self.previous_state:
-            self.sense.set_pixels(self.previous_state)
+        if self.previous_state is not None:
+            self._draw(self.previous_state)
+
+    @timings.timed('screen_write')
+    def write(self, message, save_previous_screen=True, priority=PRIORITY_STATUS, key=None):
+        ''' Queues a message to be scrolled across the screen, returning without waiting for it to be shown
+
+        :param message: The text to show
+        :param save_previous_screen: True to put the screen back as it was once the message has scrolled past
+        :param priority: Screen.PRIORITY_ERROR or Screen.PRIORITY_STATUS
+        :param key: Identifies what the message is about; a waiting message with the same key is superseded and
+                    dropped (defaults to the text, so repeats of a waiting message are only shown once)
+        :return:
+        '''
+
+        if key is None:
+            key = message
+
+        with self._pending_changed:
+            if key in self._pending:
+                logger.debug("Screen message superseded: %s", self._pending[key].text)
+            self._sequence += 1
+            self._pending[key] = _ScreenMessage(priority, self._sequence, key, message, save_previous_screen)
+            self._pending_changed.notify_all()
+
+    def flush(self, timeout=None):
+        ''' Waits until every queued message has been shown
+
+        :param timeout: Maximum number of (real) seconds to wait, or None to wait indefinitely
+        :return: True if the queue was emptied, False if the wait timed out
+        '''
+
+        with self._pending_changed:
+            while self._pending or self._scrolling:
+                if timeout is not None and timeout <= 0:
+                    return False
+                started = time.time()
+                self._pending_changed.wait(timeout)
+                if timeout is not None:
+                    timeout -= time.time() - started
+        return True
+
+    def close(self, timeout=None):
+        ''' Shows any queued messages, then stops the render thread
+
+        :param timeout: Maximum number of (real) seconds to wait for the queued messages, or None to wait indefinitely
+        :return:
+        '''
 
-    def write(self, message, save_previous_screen=True):
-        ''' Outputs a message to the screen
+        with self._pending_changed:
+            self._closing = True
+            self._pending_changed.notify_all()
+        self._render_thread.join(timeout)
+
+    def _render(self):
+        # Scrolls the queued messages one at a time, most urgent first
+        while True:
+            with self._pending_changed:
+                while not self._pending and not self._closing:
+                    self._pending_changed.wait()
+                if not self._pending:
+                    return
+                message = min(self._pending.values(), key=lambda m: (m.priority, m.sequence))
+                del self._pending[message.key]
+                self._scrolling = True
+
+            try:
+                self._scroll(message)
+            except Exception, e:
+                logger.error("Unable to show message on screen: %s", message.text)
+                logger.error("Error message: %s", e)
+            finally:
+                with self._pending_changed:
+                    self._scrolling = False
+                    self._pending_changed.notify_all()
+
+    @timings.timed('screen_scroll')
+    def _scroll(self, message):
+
+        with self._display_lock:
+            # Pixels set while the message scrolls are drawn to current_state, which is shown once it has finished
+            with self._pixels_lock:
+                self._message_showing = True
+                if not message.restore:
+                    self.current_state[:] = 0
+            try:
+                self.sense.show_message(message.text, scroll_speed=r.SCREEN_SCROLL_SPEED)
+            finally:
+                with self._pixels_lock:
+                    self._message_showing = False
+                    self.sense.set_pixels(self.current_state.tolist())
+
+    def _draw(self, pixels):
+        ''' Changes the screen to a list of 64 pixels, sending only the pixels that have changed to the Sense HAT
 
         :return:
         '''
 
-        if save_previous_screen:
-            self.save_current_screen()
+        pixels = numpy.asarray(pixels).reshape(64, 3)
+
+        with self._pixels_lock:
+            changed = numpy.flatnonzero((pixels != self.current_state).any(axis=1))
+            self.current_state[:] = pixels
+            if self._message_showing or not len(changed):
+                return
+            if len(changed) > r.SCREEN_MAX_PIXEL_UPDATES:
+                self.sense.set_pixels(self.current_state.tolist())     # One write is quicker than many pixels
+            else:
+                for i in changed:
+                    self.sense.set_pixel(int(i % 8), int(i // 8), self.current_state[i].tolist())
 
-        self.sense.show_message(message, scroll_speed = 0.05)
+    def set_pixels(self, pixel_list):
+        ''' Sets all 64 pixels of the screen from a list of [r, g, b] colours
 
-        if save_previous_screen:
-            self.restore_previous_screen()
+        :return:
+        '''
 
-    def set_pixel(self, x=0, y=0, colour={255,255,255}):
+        self._draw(pixel_list)
 
-        self.sense.set_pixel(x,y,colour)
+    def set_pixel(self, x=0, y=0, colour=[255,255,255]):
 
+        with self._pixels_lock:
+            if (self.current_state[y * 8 + x] == colour).all():
+                return
+            self.current_state[y * 8 + x] = colour
+            if not self._message_showing:
+                self.sense.set_pixel(x,y,colour)
 
+    def show_mission_status(self, photos_taken=0, heater_on=False):
+        ''' Shows the progress of the mission on the bottom row of the screen
+
+        One green pixel is lit for each photo taken; the right-hand pixel of the top row shows the heater state.
+
+        :return:
+        '''
 
+        for x in range(0, 8):
+            self.set_pixel(x, 7, [0, 255, 0] if x < photos_taken else [0, 0, 0])
+        self.set_pixel(7, 0, [255, 80, 0] if heater_on else [0, 0, 80])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Plans when the polaroid photos are taken, spreading them over the time the payload spends in the altitude window
+'''
+
+import collections
+import logging
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Recorder import flight_recorder
+
+logger = logging.getLogger('polaroid.planner')
+
+PLAN_CHANNEL = flight_recorder.channel('plan', ('shots_remaining', 'window_remaining', 'interval', 'due', 'deadline'))
+
+ShotPlan = collections.namedtuple('ShotPlan', ('due', 'deadline', 'interval', 'window_remaining'))
+
+
+class ShotPlanner(object):
+    '''
+    Spreads the remaining photos over the time the payload is predicted to have left in the altitude window
+
+    The window runs from the altitude at which the photos were triggered up to the burst of the balloon, expected at
+    r.PLANNER_BURST_ALTITUDE, so the time left in it is predicted from the estimated altitude and ascent rate. After a
+    burst there's no time left, so the remaining photos are taken min_interval apart (the time the film needs to be
+    ejected) rather than spaced out over the descent.
+
+    Each photo is due one interval after the last, and must be taken by its deadline, part of the way to the next.
+    Between the two the stability thresholds are relaxed, up to r.PLANNER_MAX_RELAXATION times at the deadline, so a
+    photo isn't lost waiting for a perfectly still moment that never comes. The interval leaves a gap after the last
+    photo, so that it too can wait for a still moment before the window ends, and every photo (even after a burst) has
+    at least part of min_interval to wait in.
+    '''
+
+    def __init__(self, payload, burst_altitude=r.PLANNER_BURST_ALTITUDE,
+                 min_interval=r.PLANNER_MIN_INTERVAL_SECONDS, max_interval=r.PLANNER_MAX_INTERVAL_SECONDS,
+                 max_relaxation=r.PLANNER_MAX_RELAXATION):
+
+        self.payload = payload
+        self.burst_altitude = burst_altitude
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_relaxation = max_relaxation
+
+    def window_remaining(self):
+        ''' Predicts the seconds the payload has left in the altitude window
+
+        :return: Seconds, or None if there's no estimate of the ascent to predict from
+        '''
+
+        estimate = self.payload.altitude_estimator.latest()
+        if estimate is None:
+            return None
+        if estimate.burst:
+            return 0.0
+        if estimate.ascent_rate < r.PLANNER_MIN_ASCENT_RATE:     # Floating, or the estimate hasn't settled
+            return None
+        return max(self.burst_altitude - estimate.altitude, 0.0) / estimate.ascent_rate * r.PLANNER_WINDOW_MARGIN
+
+    def plan(self, shots_remaining, last_shot=None):
+        ''' Plans the next photo
+
+        :param shots_remaining: The number of photos left in the cartridge
+        :param last_shot: The clock time of the previous photo (None for the first, which is due at once)
+        :return: ShotPlan of the clock times the photo is due and must be taken by
+        '''
+
+        now = hardware.clock.time()
+        remaining = self.window_remaining()
+
+        if remaining is None:
+            interval = r.PHOTOS_INTERVAL_SECONDS
+        else:
+            interval = min(max(remaining / (max(shots_remaining, 1) + 1), self.min_interval), self.max_interval)
+
+        due = now if last_shot is None else max(last_shot + interval, now)
+        deadline = due + interval * r.PLANNER_DEADLINE_FRACTION
+        if remaining is not None:
+            # Don't wait beyond the end of the window, unless that would leave no time to wait for a still moment
+            deadline = max(min(deadline, now + remaining), due + self.min_interval * r.PLANNER_DEADLINE_FRACTION)
+
+        plan = ShotPlan(due, deadline, interval, remaining)
+        logger.info("Photo planned in %.0fs, to be taken within %.0fs of then (%s shots left, %s left in the "
+                    "window)", due - now, deadline - due, shots_remaining,
+                    'unknown time' if remaining is None else '{:.0f}s'.format(remaining))
+        flight_recorder.record(PLAN_CHANNEL, now, (shots_remaining, -1 if remaining is None else remaining, interval,
+                                                   due - now, deadline - now))
+        return plan
+
+    def relaxation(self, plan):
+        ''' Returns the factor the stability thresholds are multiplied by, from 1 when the photo is due up to
+        max_relaxation at its deadline
+        '''
+
+        if plan is None:
+            return 1.0
+
+        now = hardware.clock.time()
+        if plan.deadline <= plan.due:
+            progress = 1.0 if now >= plan.due else 0.0
+        else:
+            progress = min(max((now - plan.due) / (plan.deadline - plan.due), 0.0), 1.0)
+        return 1.0 + (self.max_relaxation - 1.0) * progress
@@ -22,23 +22,96 @@ PHOTOS_MAX_TIME_DELAY = 90*60               # Trigger the photos to take after 9
 MOVING_AVERAGE_EXP_CONSTANT = 0.95          # Percentage of t-1 moving average included in the average at t-0
 MOVING_AVERAGE_RATIO_THRESHOLD = 0.05       # The percentage of the exponential moving average the current acceleration must
                                             # be in order to consider the camera "stable"
+STABILITY_CHECK_SECONDS = 10                # Time in seconds that camera_is_stable waits for the camera to become stable
+
+STABILITY_WINDOW_SAMPLES = 20              # Number of recent IMU samples judged by the stability detector (0.2s at 100Hz)
+STABILITY_MAX_ACCELERATION_VARIANCE = 1e-4  # Max variance (g^2) of the acceleration magnitude over the window
+STABILITY_MAX_JERK = 0.1                    # Max rate of change (g/s) of the acceleration over the window
+STABILITY_MAX_ANGULAR_RATE = 0.05           # Max RMS angular rate (rad/s) from the gyroscope over the window
+
+PENDULUM_HISTORY_SECONDS = 12              # Seconds of IMU history used to estimate the swing of the payload
+PENDULUM_MIN_PERIOD = 0.5                   # Shortest swing period in seconds that the estimator looks for
+PENDULUM_MAX_PERIOD = 6.0                   # Longest swing period in seconds that the estimator looks for
+PENDULUM_MIN_CONFIDENCE = 0.3               # Min autocorrelation at the swing period for the estimate to be used
+PENDULUM_SHUTTER_LEAD_SECONDS = 0.02        # Seconds before the predicted turning point at which to check stability
+PENDULUM_CHECK_SECONDS = 0.5                # Time in seconds that the camera waits for stability at a turning point
+PENDULUM_RATE_WINDOW_SAMPLES = 5            # Number of samples the angular rate is judged over at a turning point
+
+PLANNER_BURST_ALTITUDE = 30000              # Altitude in metres at which the balloon is expected to burst
+PLANNER_WINDOW_MARGIN = 0.8                 # Fraction of the predicted time to burst that the photos are spread over
+PLANNER_MIN_ASCENT_RATE = 1.0               # Ascent rate in m/s below which the time to burst isn't predicted
+PLANNER_MIN_INTERVAL_SECONDS = 30           # Shortest time in seconds between photos (for the film to be ejected)
+PLANNER_MAX_INTERVAL_SECONDS = 600          # Longest time in seconds between photos
+PLANNER_DEADLINE_FRACTION = 0.5             # Fraction of the interval after a photo is due by which it must be taken
+PLANNER_MAX_RELAXATION = 3.0                # Factor the stability thresholds are relaxed by at a photo's deadline
+
+SAMPLER_RATE_HZ = 100                       # Rate at which the background sampler reads the accelerometer and gyroscope
+SAMPLER_BUFFER_SIZE = 2048                  # Number of IMU samples kept in the ring buffer (~20s at 100Hz)
+SAMPLER_CALIBRATION_SAMPLES = 100           # Number of recent samples used to calibrate the moving average
+SAMPLER_STALL_SECONDS = 1.0                 # Age in seconds after which the newest sample means the sampler has stalled
+
+#########################################
+# Constants used by the Pi camera module, which takes a digital burst alongside each polaroid photo
+#########################################
+PICAMERA_RESOLUTION = (640, 480)            # Width and height in pixels of the frames captured
+PICAMERA_FRAME_RATE = 5                     # Frames captured per second into the ring of recent frames
+PICAMERA_RING_FRAMES = 32                   # Number of recent frames kept in memory (~6s at 5fps, ~30MB at 640x480)
+PICAMERA_BURST_SECONDS = 2                  # Seconds of frames up to each polaroid photo that are saved
+PICAMERA_WRITE_QUEUE = 64                   # Most frames waiting to be written before new ones are dropped
+PICAMERA_FOLDER = '/home/pi/polaroid/Frames'  # The directory the frame store of the Pi camera is written to
+
+SHARPNESS_METRIC = 'laplacian'              # How frames are scored: 'laplacian' (variance) or 'gradient' (energy)
+SHARPNESS_WIDTH = 160                       # Width in pixels the luminance of a frame is downscaled to for scoring
+SHARPNESS_THREADS = 2                       # Number of frames scored at the same time
+SHARPNESS_KEEP_FRAMES = 3                   # Number of the sharpest frames of each burst that are written
+FRAMESTORE_FRAMES = PHOTOS_NUMBER_OF_SHOTS * SHARPNESS_KEEP_FRAMES  # Frames preallocated in each frame store file
+FRAMESTORE_RESERVE_BYTES = 256*1024*1024    # Space on the card left free by the frame store for the logs and recorder
+SHARPNESS_CONFIRMS_STABILITY = True         # Whether the polaroid also waits for a sharp frame before it is "stable"
+SHARPNESS_STABLE_RATIO = 1.0                # Fraction of the median score of recent frames a frame must reach to be sharp
+SHARPNESS_MAX_AGE_SECONDS = 0.5             # Age in seconds after which the newest score is too old to judge stability by
 
 #########################################
 # Constants used by the DevelopingTray object to control environment that film is ejected into once a photo is taken
 #########################################
-DEVELOP_TRAY_TEMP_MIN = 15                  # Temp in celsius below which the heater turns on
-DEVELOP_TRAY_TEMP_MAX = 20                  # Temp in celsius above which the heater turns off
+DEVELOP_TRAY_TEMP_MIN = 15                  # Temp in celsius below which the film is at risk (a warning is logged)
+DEVELOP_TRAY_TEMP_MAX = 20                  # Temp in celsius above which the heater is always turned off
+DEVELOP_TRAY_TEMP_SETPOINT = 16.5           # Temp in celsius that the heater controller holds the tray at
 GPIO_PIN_DEVELOP_TRAY = 33                  # The RPi GPIO pin that turns the heater on and off
 
+HEATER_PWM_FREQUENCY = 10                   # Frequency in Hz of the PWM signal driving the heater
+HEATER_PID_KP = 0.5                         # Duty cycle per degree celsius below the setpoint
+HEATER_PID_KI = 0.002                       # Duty cycle per degree celsius second below the setpoint
+HEATER_PID_KD = 0.0                         # Duty cycle per degree celsius per second that the tray is cooling
+
 GPIO_PIN_EXTERNAL_THERMOMETER = 7           # The one-wire pin that supports the DS18B20 external temperature sensor
 EXTERNAL_THERMOMETER_ID = '28-0115a4e9c0ff' # Device ID of the external thermometer used in the water bath
 
+THERMOMETER_CHANNELS = {                    # Names of the DS18B20 thermometers by device ID; any others found on the
+    EXTERNAL_THERMOMETER_ID: 'bath',        # 1-Wire bus are named by their device ID
+}
+THERMOMETER_BATH_CHANNEL = 'bath'           # Channel of the thermometer that controls the developing tray heater
+THERMOMETER_READ_THREADS = 4                # Number of thermometers read at the same time
+
+THERMOMETER_SAMPLE_PERIOD = 5               # Seconds between readings of the thermometer by the background sampler
+THERMOMETER_READ_ATTEMPTS = 3               # Number of attempts at a reading with a good CRC before giving up
+THERMOMETER_STALE_SECONDS = 60              # Age in seconds after which a reading is too old to control the heater
+
 
 #########################################
 # Constants used for atmospheric testing
 #########################################
 DEFAULT_SEA_LEVEL_PRESSURE = 1020
 
+ALTITUDE_SAMPLE_PERIOD = 0.1                # Seconds between readings of the barometer by the altitude estimator
+ALTITUDE_MEDIAN_WINDOW = 5                  # Number of barometer readings the median filter is taken over
+ALTITUDE_PRESSURE_NOISE = 0.1               # Standard deviation of the barometer readings in millibars
+ALTITUDE_ACCELERATION_NOISE = 0.5           # Standard deviation (m/s^2) of the vertical acceleration not measured by the IMU
+ALTITUDE_INITIAL_RATE_VARIANCE = 100.0      # Variance ((m/s)^2) of the ascent rate before the first estimate
+ALTITUDE_INITIAL_BIAS_VARIANCE = 1.0        # Variance ((m/s^2)^2) of the bias of the vertical acceleration at first
+ALTITUDE_BIAS_DRIFT = 0.01                  # Drift (m/s^2 per root second) of the bias as the swing of the payload changes
+ALTITUDE_BURST_DROP = 200                   # Metres below the highest altitude the payload must fall to detect a burst
+ALTITUDE_BURST_DESCENT_RATE = 3.0           # Descent rate in metres per second above which the payload is falling
+
 
 #########################################
 # Misc config of the payload
@@ -46,6 +119,73 @@ DEFAULT_SEA_LEVEL_PRESSURE = 1020
 
 CONFIG_LOGGING_FOLDER = '/home/pi/polaroid/Logs' #'/home/adam/Dropbox/PyCharm%20Projects'
 
+LOGGING_LEVEL = 'DEBUG'                     # Lowest level of the messages logged by the payload
+LOGGING_SUBSYSTEM_LEVELS = {}               # Levels that override LOGGING_LEVEL by subsystem, e.g. {'camera': 'INFO'}
+LOGGING_QUEUE_SIZE = 10000                  # Most log records waiting to be written before new ones are dropped
+LOGGING_BATCH_SIZE = 256                    # Most log records written to the card before the log files are flushed
+LOGGING_FSYNC_SECONDS = 10                  # Seconds between syncs of the log files to the card
+LOGGING_MAX_BYTES = 16 * 1024 * 1024        # Size in bytes at which a log file is rotated
+LOGGING_BACKUP_COUNT = 5                    # Number of rotated log files kept (output.log.1, output.log.2, ...)
+
+SCREEN_SCROLL_SPEED = 0.05                  # Seconds per column that messages take to scroll across the screen
+SCREEN_MAX_PIXEL_UPDATES = 8                # Most changed pixels sent one at a time before the whole screen is sent instead
+
+DIAGNOSTIC_TIMEOUT_SECONDS = 2              # Real seconds the start-up checks are given before any still running are failed
+
+STICK_DEBOUNCE_SECONDS = 0.3                # Seconds after a joystick press in which another press of the key is ignored
+
+SPLASH_MODE = 'full'                        # Splash screen shown at start-up: 'full', 'short' (just the fades) or 'none'
+SPLASH_CACHE_FILE = '/home/pi/polaroid/splash_frames.npz'  # Compiled frames of the splash screen
+SPLASH_FLARE_FRAME_SECONDS = 0.01           # Time in seconds each frame of the splash flare is shown for
+
+RECORDER_FOLDER = '/home/pi/polaroid/Flight'  # The directory the binary flight recordings are written to
+RECORDER_FILE_SIZE = 64 * 1024 * 1024       # Size in bytes preallocated for each file of a flight recording
+RECORDER_FLUSH_SECONDS = 5                  # Seconds between flushes of the flight recording to the card
+
+CHECKPOINT_FILE = '/home/pi/polaroid/mission_checkpoint.json'  # The checkpoint of the mission resumed after a reboot
+CHECKPOINT_SECONDS = 30                     # Seconds between checkpoints of the mission (and after every photo)
+CHECKPOINT_MAX_AGE_SECONDS = 4 * 60 * 60    # Age after which a checkpoint is ignored (a little over the longest flight)
+CHECKPOINT_MAX_CLOCK_SKEW_SECONDS = 60 * 60  # Most a checkpoint can be in the future and still be resumed, as the Pi
+                                            # has no real-time clock and fake-hwclock only saves the time hourly
+CHECKPOINT_DISCARD_SECONDS = 1              # Real seconds at boot in which pressing left discards the checkpoint
+
+TIMING_ENABLED = True                       # Whether the hot paths are timed by Utils.Polaroid_Timing
+TIMING_BUCKETS_MS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000)  # Upper edges in ms of the latency histogram buckets
+TIMING_LOG_SECONDS = 300                    # Seconds between summaries of the timings in the log
+
+
+#########################################
+# Rates of the periodic tasks run during the mission by Utils.Polaroid_Scheduler
+#########################################
+SCHEDULER_THERMOSTAT_PERIOD = 5             # Seconds between updates of the developing tray heater controller
+SCHEDULER_ALTITUDE_PERIOD = 5               # Seconds between readings of the pressure and flight time
+SCHEDULER_STABILITY_PERIOD = 1              # Seconds between updates of the acceleration moving average
+SCHEDULER_DISPLAY_PERIOD = 5                # Seconds between updates of the mission status on the LED matrix
+
+
+#########################################
+# Constants used by the simulated hardware backend (Utils.Polaroid_Simulator)
+#########################################
+SIM_ASCENT_RATE = 5.0                       # Ascent rate of the balloon in metres per second
+SIM_DESCENT_RATE = 8.0                      # Descent rate under the parachute in metres per second
+SIM_BURST_ALTITUDE = 30000                  # Altitude in metres at which the balloon bursts
+SIM_SWING_PERIOD = 4.0                      # Period in seconds of the payload swinging under the balloon
+SIM_SWING_AMPLITUDE = 0.15                  # Amplitude in radians of the swing of the payload
+SIM_ACCELEROMETER_NOISE = 0.005             # Standard deviation of the accelerometer noise in g
+SIM_BATH_START_TEMP = 18.0                  # Temp in celsius of the developing tray at launch
+SIM_BATH_HEAT_CAPACITY = 480.0              # Heat capacity of the glycerine bath in J/K
+SIM_BATH_TIME_CONSTANT = 1800.0             # Time constant in seconds of the bath cooling towards ambient
+SIM_HEATER_POWER = 25.0                     # Power of the heating coil in watts
+SIM_JOYSTICK_START_DELAY = 5.0              # Seconds after boot before the simulated user presses "up" to launch
+SIM_PRESSURE_NOISE = 0.05                   # Standard deviation of the barometer noise in millibars
+SIM_PRESSURE_GLITCH_PROBABILITY = 0.001     # Chance of a barometer reading being spurious
+SIM_W1_CONVERSION_SECONDS = 0.75            # Time in seconds a simulated DS18B20 takes to convert a reading
+SIM_W1_DEVICES = (EXTERNAL_THERMOMETER_ID,  # Device IDs of the simulated DS18B20 thermometers
+                  '28-000000000f11', '28-00000000ba77', '28-00000000a1b1')
+SIM_CAMERA_RESOLUTION = (160, 120)          # Width and height in pixels of the frames of the simulated Pi camera
+SIM_CAMERA_FIELD_OF_VIEW = 0.9              # Horizontal field of view in radians of the simulated Pi camera
+SIM_CAMERA_EXPOSURE = 0.1                   # Exposure in seconds of each frame (long, so the swing blurs the small frames)
+
 
 # /etc/init.d/polaroidstartup
 #http://www.stuffaboutcode.com/2012/06/raspberry-pi-run-program-at-start-up.html
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Decides whether the payload is still enough to take a photo, using a window of recent IMU samples
+'''
+
+import collections
+import math
+
+import numpy
+
+import Polaroid_Reference as r
+
+StabilityMetrics = collections.namedtuple('StabilityMetrics', ('variance', 'jerk', 'angular_rate'))
+PendulumEstimate = collections.namedtuple('PendulumEstimate', ('period', 'amplitude', 'confidence',
+                                                               'next_turning_point'))
+
+
+class StabilityDetector(object):
+    '''
+    Judges the stability of the camera over a window of IMU samples rather than from a single reading
+
+    Three measures are computed over the window in one pass:
+
+        variance        variance of the acceleration magnitude (g^2), i.e. how much the payload is being shaken
+        jerk            rate of change of the acceleration vector (g/s), from a least-squares fit over the window so
+                        that sensor noise on individual samples doesn't dominate
+        angular_rate    RMS of the gyroscope magnitude (rad/s), i.e. how fast the payload is swinging or spinning
+
+    The camera is stable when all three are within their thresholds.
+    '''
+
+    def __init__(self, window=r.STABILITY_WINDOW_SAMPLES, max_variance=r.STABILITY_MAX_ACCELERATION_VARIANCE,
+                 max_jerk=r.STABILITY_MAX_JERK, max_angular_rate=r.STABILITY_MAX_ANGULAR_RATE):
+
+        self.window = window
+        self.max_variance = max_variance
+        self.max_jerk = max_jerk
+        self.max_angular_rate = max_angular_rate
+
+    def measure(self, samples, rate_window=None):
+        ''' Computes the stability metrics of a window of IMU samples
+
+        :param samples: Array of (timestamp, ax, ay, az, gx, gy, gz) rows, oldest first
+        :param rate_window: Number of the most recent samples to measure the angular rate over (all if None)
+        :return: StabilityMetrics for the window
+        '''
+
+        times = samples[:, 0] - samples[0, 0]
+        acceleration = samples[:, 1:4]
+        angular_rate = samples[-rate_window:, 4:7] if rate_window else samples[:, 4:7]
+
+        variance = numpy.sqrt((acceleration ** 2).sum(axis=1)).var()
+        jerk = numpy.sqrt((numpy.polyfit(times, acceleration, 1)[0] ** 2).sum()) if times[-1] > 0 else 0.0
+        rate = numpy.sqrt((angular_rate ** 2).sum(axis=1).mean())
+
+        return StabilityMetrics(float(variance), float(jerk), float(rate))
+
+    def is_stable(self, samples, rate_window=None, relaxation=1.0):
+        ''' Decides whether a window of IMU samples shows the camera to be still enough to take a photo
+
+        :param samples: Array of (timestamp, ax, ay, az, gx, gy, gz) rows, oldest first
+        :param rate_window: Number of the most recent samples to judge the angular rate over (the whole window if
+                            None). Used at a predicted turning point of the swing, where a short window reacts without
+                            lag; the jerk isn't judged then, as it reflects the swing reversing rather than shaking.
+        :param relaxation: Factor the thresholds are multiplied by, e.g. as the deadline for a photo approaches
+        :return: (True/False on whether the camera is stable, StabilityMetrics or None if there are too few samples)
+        '''
+
+        if len(samples) < self.window:
+            return False, None
+
+        metrics = self.measure(samples[-self.window:], rate_window)
+        stable = (metrics.variance < self.max_variance * relaxation and
+                  (rate_window or metrics.jerk < self.max_jerk * relaxation) and
+                  metrics.angular_rate < self.max_angular_rate * relaxation)
+        return stable, metrics
+
+
+class PendulumEstimator(object):
+    '''
+    Estimates the swing of the payload under the balloon so the shutter can be timed for a still moment
+
+    The payload swings like a pendulum, and is momentarily still at each end of its swing (the turning points, where
+    the angular rate passes through zero). The period of the swing is found from the autocorrelation of the gyroscope
+    history, and its phase from a least-squares sinusoid fitted to the last two periods, which together predict when
+    the next turning point will be.
+    '''
+
+    def __init__(self, sample_rate=r.SAMPLER_RATE_HZ, min_period=r.PENDULUM_MIN_PERIOD,
+                 max_period=r.PENDULUM_MAX_PERIOD, min_confidence=r.PENDULUM_MIN_CONFIDENCE):
+
+        self.sample_rate = sample_rate
+        self.min_period = min_period
+        self.max_period = max_period
+        self.min_confidence = min_confidence
+
+    def estimate(self, samples, now):
+        ''' Estimates the swing from a history of IMU samples
+
+        :param samples: Array of (timestamp, ax, ay, az, gx, gy, gz) rows, oldest first
+        :param now: The current time, on the same clock as the sample timestamps
+        :return: PendulumEstimate, or None if no regular swing can be found
+        '''
+
+        if len(samples) < 3:
+            return None
+
+        # Project the angular rate onto the axis the payload swings about (its principal component), then resample
+        # onto an even grid as samples can arrive irregularly
+        times = samples[:, 0]
+        rates = samples[:, 4:7] - samples[:, 4:7].mean(axis=0)
+        axis = numpy.linalg.svd(rates, full_matrices=False)[2][0]
+        grid = numpy.arange(times[0], times[-1], 1.0 / self.sample_rate)
+        signal = numpy.interp(grid, times, rates.dot(axis))
+
+        # At least two full swings are needed to measure the period
+        n = len(signal)
+        lowest_lag = int(self.min_period * self.sample_rate)
+        highest_lag = min(int(self.max_period * self.sample_rate), n // 2)
+        if highest_lag <= lowest_lag + 1:
+            return None
+
+        # Autocorrelation by FFT, scaled by the number of overlapping samples at each lag so longer lags aren't
+        # penalised (which would bias the period short)
+        spectrum = numpy.fft.rfft(signal, 2 * n)
+        autocorrelation = numpy.fft.irfft(spectrum * numpy.conj(spectrum))[:n] / numpy.arange(n, 0, -1)
+        if autocorrelation[0] <= 0:
+            return None
+        autocorrelation /= autocorrelation[0]
+
+        # The period is the first peak that is nearly as strong as the strongest, rather than one of its multiples
+        candidates = autocorrelation[lowest_lag - 1:highest_lag + 1]
+        peaks = numpy.nonzero((candidates[1:-1] > candidates[:-2]) & (candidates[1:-1] >= candidates[2:]))[0]
+        if not len(peaks):
+            return None                     # No peak inside the range, so no regular swing
+        strongest = candidates[1:-1][peaks].max()
+        lag = lowest_lag + int(peaks[candidates[1:-1][peaks] >= 0.9 * strongest][0])
+        confidence = float(autocorrelation[lag])
+        if confidence < self.min_confidence:
+            return None
+
+        # Refine the period between samples with a parabola through the peak
+        before, peak, after = autocorrelation[lag - 1:lag + 2]
+        curvature = before - 2 * peak + after
+        offset = 0.5 * (before - after) / curvature if curvature != 0 else 0.0
+        period = (lag + offset) / self.sample_rate
+
+        # Fit rate(t) = a.cos(w(t - now)) + b.sin(w(t - now)) + c over the last two periods
+        omega = 2 * math.pi / period
+        recent = grid >= grid[-1] - 2 * period
+        phase_times = omega * (grid[recent] - now)
+        design = numpy.column_stack((numpy.cos(phase_times), numpy.sin(phase_times), numpy.ones(len(phase_times))))
+        a, b, _ = numpy.linalg.lstsq(design, signal[recent], rcond=-1)[0]
+
+        # rate(t) = R.cos(w(t - now) - phase) passes through zero when w(t - now) = phase + pi/2 + k.pi
+        phase = math.atan2(b, a)
+        next_turning_point = now + ((phase + math.pi / 2) % math.pi) / omega
+
+        return PendulumEstimate(period, math.hypot(a, b), confidence, next_turning_point)
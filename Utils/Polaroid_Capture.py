@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Burst capture from the Pi camera module
+
+Frames are captured continuously on a background thread into a preallocated ring of frames in memory, so there is
+always a burst of the last few seconds to choose from when a photo is wanted. Each frame is scored for sharpness by a
+small pool of threads as soon as it is captured, so only the sharpest frames of a burst need to be written. Choosing
+frames only queues their numbers; a second thread copies the chosen frames straight from the ring into storage (a
+Utils.Polaroid_FrameStore.FrameStore).
+None of these threads is waited on by the Polaroid shutter sequence.
+
+A frame source is anything with a resolution (width, height) and a capture(output) method that writes an RGB frame
+into a (height, width, 3) uint8 array, such as the camera returned by Utils.Polaroid_Hardware.get_camera (the real
+picamera, or the SimulatedCamera of the simulated backend).
+'''
+
+import Queue
+import collections
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Scheduler import PeriodicTask
+
+logger = logging.getLogger('polaroid.capture')
+
+SHARPNESS_CHANNEL = flight_recorder.channel('sharpness', ('frame', 'score'))
+
+LUMINANCE_WEIGHTS = numpy.array([0.299, 0.587, 0.114])     # ITU-R BT.601 weights of the red, green and blue
+
+Frame = collections.namedtuple('Frame', ('number', 'timestamp', 'image', 'snapshot'))
+
+
+class FrameRing(object):
+    '''
+    Fixed number of frames, allocated once and overwritten oldest first
+
+    Frames are numbered from 1 in the order they were captured. A frame can be read back until the capture that
+    overwrites it starts, capacity frames later.
+    '''
+
+    def __init__(self, capacity, resolution, snapshot=None):
+        '''
+        :param snapshot: Called as each frame is captured for the sensor readings to keep with it (e.g. a dict of
+                         readings by name)
+        '''
+
+        width, height = resolution
+        self.capacity = capacity
+        self.count = 0                  # Total number of frames ever captured
+        self.first = 1                  # Number of the oldest frame that can still be read
+        self.snapshot = snapshot
+
+        self._images = numpy.zeros((capacity, height, width, 3), dtype=numpy.uint8)
+        self._timestamps = numpy.zeros(capacity)
+        self._snapshots = [None] * capacity
+        self._lock = threading.Lock()
+        self._captured = threading.Condition(self._lock)    # Notified each time a frame is captured
+
+    def capture(self, source, timestamp=None):
+        ''' Captures the next frame from source straight into the ring
+
+        The frame in the slot about to be written is retired before the camera starts exposing into it, and the new
+        frame isn't readable until the capture is complete, so a reader never sees a partly written frame and is only
+        held up by the lock while the frame is committed, not while the camera is exposing it.
+
+        :return: The number of the frame
+        '''
+
+        with self._lock:
+            slot = self.count % self.capacity
+            self.first = max(self.count + 2 - self.capacity, 1)
+        source.capture(self._images[slot])
+        readings = None
+        if self.snapshot is not None:
+            try:
+                readings = self.snapshot()
+            except Exception, e:            # The frame is still worth keeping without them
+                logger.error("Unable to take the sensor readings for a frame")
+                logger.error("Error message: %s", e)
+        with self._lock:
+            self._timestamps[slot] = hardware.clock.time() if timestamp is None else timestamp
+            self._snapshots[slot] = readings
+            self.count += 1
+            self._captured.notify_all()
+            return self.count
+
+    def wait(self, number, timeout):
+        ''' Waits for a frame to be captured
+
+        :param number: The number of the frame
+        :param timeout: Real seconds to wait, as for the camera itself
+        :return: True if the frame has been captured, False if the wait timed out
+        '''
+
+        deadline = time.time() + timeout
+        with self._lock:
+            while self.count < number and time.time() < deadline:
+                self._captured.wait(deadline - time.time())
+            return self.count >= number
+
+    def get(self, number):
+        ''' Returns a copy of a frame, or None if it hasn't been captured yet or has been overwritten '''
+
+        with self._lock:
+            if not self.first <= number <= self.count:
+                return None
+            slot = (number - 1) % self.capacity
+            return Frame(number, float(self._timestamps[slot]), self._images[slot].copy(), self._snapshots[slot])
+
+    def view(self, number):
+        ''' Returns a frame without copying it, or None if it hasn't been captured yet or has been overwritten
+
+        The image is the ring's own memory and will be overwritten capacity frames later, so anything worked out from
+        it should be checked with is_current(number) afterwards.
+        '''
+
+        with self._lock:
+            if not self.first <= number <= self.count:
+                return None
+            slot = (number - 1) % self.capacity
+            return Frame(number, float(self._timestamps[slot]), self._images[slot], self._snapshots[slot])
+
+    def is_current(self, number):
+        ''' Whether a frame that has been captured is still in the ring (and isn't being overwritten) '''
+
+        return number >= self.first
+
+    def numbers_since(self, timestamp):
+        ''' Returns the numbers of the frames still in the ring that were captured at or after timestamp '''
+
+        with self._lock:
+            return [number for number in range(self.first, self.count + 1)
+                    if self._timestamps[(number - 1) % self.capacity] >= timestamp]
+
+
+class BurstCapture(object):
+    '''
+    Captures frames from a source into a FrameRing at a fixed rate on a background thread
+    '''
+
+    def __init__(self, source, ring, rate=r.PICAMERA_FRAME_RATE, on_capture=None):
+        '''
+        :param on_capture: Called with the number of each frame once it has been captured, e.g. FrameScorer.submit
+        '''
+
+        self.source = source
+        self.ring = ring
+        self.period = 1.0 / rate
+        self.on_capture = on_capture
+        self._task = None
+
+    def _capture(self):
+        number = self.ring.capture(self.source)
+        if self.on_capture is not None:
+            self.on_capture(number)
+
+    def start(self):
+        if self._task is None:
+            self._task = PeriodicTask('picamera', self._capture, self.period)
+            self._task.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task.join()
+            self._task = None
+
+    def is_running(self):
+        return self._task is not None
+
+
+def luminance(image, width=r.SHARPNESS_WIDTH):
+    ''' Returns the luminance of an RGB image, downscaled by averaging blocks of pixels to about the given width
+
+    :param image: (height, width, 3) array
+    :param width: Width in pixels to downscale to (the image isn't scaled up if it is already narrower)
+    :return: 2D float array
+    '''
+
+    block = max(image.shape[1] // width, 1)
+    if block > 1:
+        height, width = image.shape[0] // block * block, image.shape[1] // block * block
+        image = image[:height, :width].reshape(height // block, block, width // block, block, 3).mean(axis=(1, 3))
+    return image.dot(LUMINANCE_WEIGHTS)
+
+
+def laplacian_variance(luma):
+    ''' Returns the variance of the Laplacian of an image, which falls as the image is blurred '''
+
+    laplacian = luma[1:-1, :-2] + luma[1:-1, 2:] + luma[:-2, 1:-1] + luma[2:, 1:-1] - 4 * luma[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+def gradient_energy(luma):
+    ''' Returns the mean squared gradient of an image, which falls as the image is blurred '''
+
+    return float((numpy.diff(luma, axis=1) ** 2).mean() + (numpy.diff(luma, axis=0) ** 2).mean())
+
+
+SHARPNESS_METRICS = {
+    'laplacian': laplacian_variance,
+    'gradient': gradient_energy,
+}
+
+
+def sharpness(image, metric=r.SHARPNESS_METRIC, width=r.SHARPNESS_WIDTH):
+    ''' Scores the sharpness of an RGB image; only scores of the same scene and metric can be compared
+
+    :param metric: 'laplacian' (variance of the Laplacian) or 'gradient' (gradient energy)
+    :param width: Width in pixels the luminance is downscaled to before scoring
+    '''
+
+    return SHARPNESS_METRICS[metric](luminance(image, width))
+
+
+class FrameScorer(object):
+    '''
+    Scores the sharpness of frames in a FrameRing on a small pool of threads, as they are captured
+
+    Frames are scored in place in the ring, without being copied. If the pool falls behind, new frames are skipped
+    rather than queued, so the scores never lag far behind the camera.
+    '''
+
+    def __init__(self, ring, threads=r.SHARPNESS_THREADS, metric=r.SHARPNESS_METRIC, width=r.SHARPNESS_WIDTH):
+
+        if metric not in SHARPNESS_METRICS:
+            raise ValueError("Unknown sharpness metric: {}".format(metric))
+
+        self.ring = ring
+        self.threads = threads
+        self.metric = metric
+        self.width = width
+        self.frames_scored = 0
+        self.frames_skipped = 0
+
+        self._scores = numpy.zeros(ring.capacity)
+        self._numbers = numpy.zeros(ring.capacity, dtype=numpy.int64)  # The frame each score is for (0 if none)
+        self._timestamps = numpy.zeros(ring.capacity)
+        self._latest = 0                    # Number of the newest frame scored
+        self._pending = 0                   # Number of frames submitted but not yet scored
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ThreadPool(max(self.threads, 1))
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def submit(self, number):
+        ''' Queues a frame to be scored, or skips it if the pool is busy with the frames before it '''
+
+        with self._lock:
+            if self._pool is None or self._pending >= 2 * self.threads:
+                self.frames_skipped += 1
+                return
+            self._pending += 1
+        self._pool.apply_async(self._score, (number,))
+
+    def _score(self, number):
+        try:
+            frame = self.ring.view(number)
+            if frame is None:
+                return
+            score = sharpness(frame.image, self.metric, self.width)
+            if not self.ring.is_current(number):        # Overwritten while it was being scored
+                return
+            with self._lock:
+                slot = (number - 1) % self.ring.capacity
+                self._scores[slot] = score
+                self._numbers[slot] = number
+                self._timestamps[slot] = frame.timestamp
+                self._latest = max(self._latest, number)
+                self.frames_scored += 1
+            flight_recorder.record(SHARPNESS_CHANNEL, frame.timestamp, (number, score))
+        except Exception, e:
+            logger.error("Unable to score the sharpness of frame %s", number)
+            logger.error("Error message: %s", e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def score(self, number):
+        ''' Returns the sharpness of a frame, or None if it hasn't been scored or has left the ring '''
+
+        with self._lock:
+            slot = (number - 1) % self.ring.capacity
+            return float(self._scores[slot]) if self._numbers[slot] == number else None
+
+    def best(self, numbers, count):
+        ''' Returns the numbers of the sharpest scored frames among numbers, in the order they were captured
+
+        :param numbers: The numbers of the frames to choose from (frames not scored are left out)
+        :param count: Most frames to return
+        '''
+
+        scored = [(score, number) for score, number in ((self.score(number), number) for number in numbers)
+                  if score is not None]
+        return sorted(number for score, number in sorted(scored, reverse=True)[:count])
+
+    def latest(self):
+        ''' Returns the (timestamp, score) of the newest frame scored, or None if no frame has been scored '''
+
+        with self._lock:
+            if not self._latest:
+                return None
+            slot = (self._latest - 1) % self.ring.capacity
+            return float(self._timestamps[slot]), float(self._scores[slot])
+
+    def median(self):
+        ''' Returns the median score of the frames in the ring, or None if none have been scored '''
+
+        with self._lock:
+            scores = self._scores[self._numbers >= self.ring.first]
+            return float(numpy.median(scores)) if len(scores) else None
+
+
+def write_ppm(path, image):
+    ''' Writes an RGB image as a binary PPM file, which needs no image library to write or view '''
+
+    height, width, _ = image.shape
+    with open(path, 'wb') as f:
+        f.write('P6\n{} {}\n255\n'.format(width, height))
+        f.write(numpy.ascontiguousarray(image, dtype=numpy.uint8).tostring())
+
+
+class FrameWriter(object):
+    '''
+    Writes chosen frames from a FrameRing to storage on a background thread
+
+    Frames are chosen by number and copied from the ring into storage when the writer gets to them, with no copy in
+    between, so a frame is lost (and counted in missed_frames) if the ring wraps round before it has been copied.
+
+    The storage needs write(frame, sharpness), which returns where the frame was written, remove(location) and close().
+    '''
+
+    _STOP = None                        # Put on the queue to stop the writer
+
+    def __init__(self, ring, storage, scorer=None, queue_size=r.PICAMERA_WRITE_QUEUE):
+        '''
+        :param scorer: FrameScorer whose sharpness scores are stored with the frames, if any
+        '''
+
+        self.ring = ring
+        self.storage = storage
+        self.scorer = scorer
+        self.frames_written = 0
+        self.missed_frames = 0
+        self.last_location = None       # Where the most recent frame was written
+
+        self._queue = Queue.Queue(queue_size)
+        self._thread = None
+
+    def select(self, numbers):
+        ''' Queues frames to be written, without waiting
+
+        :param numbers: The numbers of the frames
+        :return: The number of frames queued (frames are dropped if the queue is full)
+        '''
+
+        queued = 0
+        for number in numbers:
+            try:
+                self._queue.put_nowait(number)
+                queued += 1
+            except Queue.Full:
+                self.missed_frames += 1
+        return queued
+
+    def _run(self):
+        while True:
+            number = self._queue.get()
+            try:
+                if number is self._STOP:
+                    return
+                frame = self.ring.view(number)
+                if frame is not None:
+                    location = self.storage.write(frame, self.scorer.score(number) if self.scorer else None)
+                    if not self.ring.is_current(number):    # Overwritten while it was being copied
+                        self.storage.remove(location)
+                        frame = None
+                if frame is None:
+                    self.missed_frames += 1
+                    logger.warning("Frame %s was overwritten before it could be written", number)
+                    continue
+                self.last_location = location
+                self.frames_written += 1
+            except Exception, e:
+                self.missed_frames += 1
+                logger.error("Unable to write frame %s", number)
+                logger.error("Error message: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        ''' Waits until every frame queued so far has been written '''
+
+        self._queue.join()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='frame_writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        ''' Writes the frames still queued, then stops the writer '''
+
+        if self._thread is not None:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+        self.storage.close()
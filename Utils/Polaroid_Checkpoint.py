@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Checkpoint of the state of the mission, so that the payload can carry on where it left off after a reboot
+
+A brownout in the cold of the upper atmosphere can restart the Pi mid-flight. Without a checkpoint the payload would
+start again from the splash screen and wait at the joystick, with the mission clock reset and a full cartridge of
+photos still to take. Instead the phase of the mission, the launch time, the photos taken, the time of the last photo
+and the state of the heater are saved as a small JSON file, written to a temporary file and renamed over the previous
+checkpoint, so that a power cut part way through a save leaves the previous checkpoint intact.
+
+Only a recent checkpoint is resumed, so one left behind by a rehearsal or a test on the bench doesn't start the
+photos on the ground, and the checkpoint is removed once the mission is complete.
+'''
+
+import json
+import logging
+import os
+import threading
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+
+logger = logging.getLogger('polaroid.checkpoint')
+
+PHASE_ASCENT = 'ascent'             # Launched, waiting for the altitude at which the photos are taken
+PHASE_PHOTOS = 'photos'             # Taking the photos
+PHASE_COMPLETE = 'complete'         # Every photo has been taken
+
+VERSION = 1
+
+
+class MissionCheckpoint(object):
+    '''
+    Saves and loads the checkpoint of the mission
+    '''
+
+    def __init__(self, path=r.CHECKPOINT_FILE):
+
+        self.path = path
+        self.saves = 0
+        self._lock = threading.Lock()       # The mission loop and the periodic checkpoint task both save
+
+    def save(self, phase, **state):
+        ''' Replaces the checkpoint with the given phase and state
+
+        :param phase: PHASE_ASCENT, PHASE_PHOTOS or PHASE_COMPLETE
+        :param state: Values to save with the phase, e.g. photos_taken=3 (must be JSON serialisable)
+        :return: True/False on whether the checkpoint was saved (a failed save doesn't stop the mission)
+        '''
+
+        state.update(version=VERSION, phase=phase, saved_at=hardware.clock.time())
+        temporary = self.path + '.tmp'
+
+        with self._lock:
+            try:
+                folder = os.path.dirname(os.path.abspath(self.path))
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                with open(temporary, 'w') as f:
+                    json.dump(state, f, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())            # The new checkpoint is on the card before it replaces the old one
+                os.rename(temporary, self.path)
+                descriptor = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(descriptor)            # So is the rename
+                finally:
+                    os.close(descriptor)
+            except (IOError, OSError), e:
+                logger.error("Unable to save the mission checkpoint to %s", self.path)
+                logger.error("Error message: %s", e)
+                return False
+
+            self.saves += 1
+        logger.debug("Mission checkpoint saved: %s", state)
+        return True
+
+    def load(self):
+        ''' Returns the saved state as a dict, or None if there's no checkpoint or it can't be read '''
+
+        if not os.path.exists(self.path):
+            return None
+
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError), e:
+            logger.error("Unable to load the mission checkpoint from %s", self.path)
+            logger.error("Error message: %s", e)
+            return None
+
+        if not isinstance(state, dict) or state.get('version') != VERSION or 'phase' not in state:
+            logger.error("Mission checkpoint %s isn't a version %s checkpoint, ignoring it", self.path, VERSION)
+            return None
+        state['phase'] = str(state['phase'])    # json gives unicode, which the log files can't mix with their format
+        return state
+
+    def clear(self):
+        ''' Removes the checkpoint, e.g. once the mission is complete, so it isn't resumed at the next boot '''
+
+        with self._lock:
+            try:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                    logger.info("Mission checkpoint %s removed", self.path)
+            except OSError, e:
+                logger.error("Unable to remove the mission checkpoint %s", self.path)
+                logger.error("Error message: %s", e)
+                return False
+        return True
+
+    @staticmethod
+    def is_in_progress(state):
+        ''' Whether a loaded state is of a mission that was interrupted before every photo had been taken '''
+
+        return state is not None and state.get('phase') in (PHASE_ASCENT, PHASE_PHOTOS)
+
+    def is_resumable(self, state, max_age=r.CHECKPOINT_MAX_AGE_SECONDS, max_skew=r.CHECKPOINT_MAX_CLOCK_SKEW_SECONDS):
+        ''' Whether a loaded state is of an interrupted mission recent enough to resume
+
+        :param max_age: Seconds after which a checkpoint is too old to be of the current flight
+        :param max_skew: Seconds a checkpoint can be in the future of the clock (which may be behind after a reboot)
+        :return: True/False, logging why a checkpoint of an interrupted mission isn't resumed
+        '''
+
+        if not self.is_in_progress(state):
+            return False
+
+        age = hardware.clock.time() - state.get('saved_at', 0)
+        if age > max_age:
+            logger.warning("Mission checkpoint %s is %.0fs old, ignoring it", self.path, age)
+            return False
+        if age < -max_skew:
+            logger.warning("Mission checkpoint %s was saved %.0fs in the future, ignoring it", self.path, -age)
+            return False
+        return True
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Frame store for the Pi camera: every frame of a flight in one preallocated, memory-mapped file
+
+Writing each frame to its own file fragments the SD card and stalls on the filesystem's metadata. Instead the frames
+are written to fixed-size slots of one file whose disk space is reserved when it is created, so saving a frame is a
+single copy from the ring of frames in memory into the mapped file, with nothing for the filesystem to update.
+
+The file starts with a header and the names of the sensor readings stored with each frame, followed by an index with
+an entry for every slot and then the slots themselves (each a raw (height, width, 3) RGB frame):
+
+    Header          Magic, version, frame width and height, number of slots, number of sensor fields
+    Field names     Names of the sensor fields, as text padded to FIELD_NAMES_SIZE bytes
+    Index           For each slot: frame number (0 if the slot is empty), CRC32 of the frame, clock time,
+                    sharpness and the sensor fields, as 32 bit floats
+    Slots           The frames, starting on a page boundary
+
+An index entry is written once its frame is in its slot, and includes a checksum of the frame, so after a crash or
+power cut every frame whose entry and data both reached the card can be told apart from one that was cut short.
+Each file has a slot for every frame the cartridge's bursts keep, so little more than a flight's worth of the card is
+reserved at each boot, and fewer if the card is short of space. When a file is full the frames carry on in a new file
+with the next part number.
+
+Stores are read back with FrameStoreReader, or frames extracted from the command line, e.g.
+
+    python -m Utils.Polaroid_FrameStore /home/pi/polaroid/Frames/frames_20170401_093000_000.pfst --extract /tmp/frames
+'''
+
+import argparse
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import numpy
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Capture import write_ppm
+
+logger = logging.getLogger('polaroid.framestore')
+
+MAGIC = 'PFST'
+VERSION = 1
+FILE_EXTENSION = '.pfst'
+
+HEADER = struct.Struct('<4sHHHII')          # Magic, version, width, height, number of slots, number of sensor fields
+FIELD_NAMES_SIZE = 1024                     # Bytes reserved for the names of the sensor fields
+
+SNAPSHOT_FIELDS = ('pressure', 'altitude', 'ascent_rate', 'accel_x', 'accel_y', 'accel_z', 'gyro_x', 'gyro_y',
+                   'gyro_z', 'tray_temperature')
+
+
+def index_dtype(fields):
+    ''' Returns the numpy dtype of an index entry with the given sensor fields '''
+
+    return numpy.dtype([('number', '<u4'), ('crc', '<u4'), ('time', '<f8'), ('sharpness', '<f4')] +
+                       [(field, '<f4') for field in fields])
+
+
+def _layout(width, height, frames, fields):
+    # Returns the offset of the index, the offset of the first slot and the size of the file
+    index_offset = HEADER.size + FIELD_NAMES_SIZE
+    slots_offset = index_offset + frames * index_dtype(fields).itemsize
+    slots_offset = (slots_offset + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+    return index_offset, slots_offset, slots_offset + frames * width * height * 3
+
+
+class FrameStore(object):
+    '''
+    Writes frames, with the sensor readings at the time they were captured, to a memory-mapped frame store
+
+    Used as the storage of a Utils.Polaroid_Capture.FrameWriter, so frames are written on the writer's thread.
+    '''
+
+    def __init__(self, folder, resolution, frames=r.FRAMESTORE_FRAMES, fields=SNAPSHOT_FIELDS):
+        '''
+        :param folder: The directory the store is written to (created if needed)
+        :param resolution: Width and height in pixels of the frames
+        :param frames: Number of frames each file of the store holds (fewer if the card doesn't have room)
+        :param fields: Names of the sensor readings stored with each frame
+        '''
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self.width, self.height = resolution
+        self.frames = frames
+        self.folder = folder
+        self.fields = tuple(fields)
+        self.path = None                    # The file currently being written to
+        self.frames_written = 0
+
+        self._base_path = os.path.join(folder, hardware.clock.now().strftime('frames_%Y%m%d_%H%M%S'))
+        self._part = 0
+        self._next_slot = 0
+        self._part_frames = None            # Number of slots in the current file
+        self._file = None
+        self._map = None
+        self._index = None
+        self._slots = None
+        self._index_offset = None
+        self._slots_offset = None
+        self._lock = threading.Lock()
+
+        self._open_part()
+        logger.info("Frame store writing to %s (%s frames per file)", self.path, self._part_frames)
+
+    def _frames_with_room(self):
+        # Returns the number of slots the next file can have, leaving r.FRAMESTORE_RESERVE_BYTES of the card free
+        stats = os.statvfs(self.folder)
+        free = stats.f_bavail * stats.f_frsize - r.FRAMESTORE_RESERVE_BYTES
+        frames = self.frames
+        while frames > 0 and _layout(self.width, self.height, frames, self.fields)[2] > free:
+            frames //= 2
+        if frames == 0:
+            raise IOError("No room on the card for the frame store in {}".format(self.folder))
+        if frames < self.frames:
+            logger.warning("Only room on the card for %s of %s frames in the frame store", frames, self.frames)
+        return frames
+
+    def _open_part(self):
+        # Creates, preallocates and maps the next file of the store
+        frames = self._frames_with_room()
+        index_offset, slots_offset, size = _layout(self.width, self.height, frames, self.fields)
+
+        self.path = '{}_{:03d}{}'.format(self._base_path, self._part, FILE_EXTENSION)
+        self._file = open(self.path, 'w+b')
+        hardware.preallocate_file(self._file, size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.width, self.height, frames, len(self.fields))
+        names = ' '.join(self.fields)
+        if len(names) > FIELD_NAMES_SIZE:
+            raise ValueError("Too many sensor fields to store: {}".format(names))
+        self._map[HEADER.size:HEADER.size + len(names)] = names
+        self._flush_range(0, HEADER.size + FIELD_NAMES_SIZE)
+
+        self._index_offset = index_offset
+        self._slots_offset = slots_offset
+        self._index = numpy.ndarray((frames,), dtype=index_dtype(self.fields), buffer=self._map,
+                                    offset=index_offset)
+        self._slots = numpy.ndarray((frames, self.height, self.width, 3), dtype=numpy.uint8, buffer=self._map,
+                                    offset=slots_offset)
+        self._part_frames = frames
+        self._next_slot = 0
+
+    def _flush_range(self, offset, length):
+        # Writes part of the mapping to the card; msync needs the start to be on a page boundary
+        start = offset // mmap.PAGESIZE * mmap.PAGESIZE
+        self._map.flush(start, offset + length - start)
+
+    def _close_part(self):
+        self._map.flush()
+        self._index = None
+        self._slots = None
+        self._map.close()
+        self._file.close()
+        self._map = None
+        self._file = None
+
+    def write(self, frame, sharpness=None):
+        ''' Copies a frame into the next slot and indexes it
+
+        :param frame: Utils.Polaroid_Capture.Frame, whose snapshot is a dict of sensor readings by field name
+        :param sharpness: The sharpness score of the frame, if known
+        :return: (path, slot) of where the frame was written
+        '''
+
+        with self._lock:
+            if self._map is None:
+                raise IOError("Frame store is closed")
+            if self._next_slot == self._part_frames:
+                self._close_part()
+                self._part += 1
+                self._open_part()
+                logger.info("Frame store continuing in %s", self.path)
+
+            slot = self._next_slot
+            image = self._slots[slot]
+            image[...] = frame.image                                # The one copy, from the ring into the file
+            self._flush_range(self._slots_offset + slot * image.nbytes, image.nbytes)
+
+            snapshot = frame.snapshot or {}
+            self._index[slot] = ((frame.number, zlib.crc32(image) & 0xffffffff, frame.timestamp,
+                                  numpy.nan if sharpness is None else sharpness) +
+                                 tuple(snapshot.get(field, numpy.nan) for field in self.fields))
+            self._flush_index_entry(slot)                           # Only once the frame is on the card
+            self._next_slot += 1
+            self.frames_written += 1
+            return self.path, slot
+
+    def _flush_index_entry(self, slot):
+        entry_size = self._index.dtype.itemsize
+        self._flush_range(self._index_offset + slot * entry_size, entry_size)
+
+    def remove(self, location):
+        ''' Marks a frame as not written, e.g. if it was overwritten in the ring while it was being copied '''
+
+        path, slot = location
+        with self._lock:
+            if path == self.path and self._index is not None:
+                self._index[slot]['number'] = 0
+                self._flush_index_entry(slot)       # So the entry can't outlive a crash pointing at a torn frame
+                self.frames_written -= 1
+
+    def close(self):
+        ''' Flushes the store and closes it (the file keeps its full size, so readers find every slot) '''
+
+        with self._lock:
+            if self._map is not None:
+                self._close_part()
+                logger.info("Frame store closed after %s frames", self.frames_written)
+
+
+class FrameStoreReader(object):
+    '''
+    Reads a frame store file back, without copying the frames out of the file
+
+    Only the frames whose checksum matches are listed, so a store left by a crash or power cut can be read up to its
+    last complete frame.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.width, self.height, frames, field_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a frame store".format(path))
+        if version != VERSION:
+            raise ValueError("{} is a version {} frame store, expected version {}".format(path, version, VERSION))
+        self.fields = tuple(self._map[HEADER.size:HEADER.size + FIELD_NAMES_SIZE].rstrip('\0').split())
+        if len(self.fields) != field_count:
+            raise ValueError("{} has a damaged header".format(path))
+
+        index_offset, slots_offset, size = _layout(self.width, self.height, frames, self.fields)
+        if len(self._map) < size:
+            raise ValueError("{} is truncated ({} of {} bytes)".format(path, len(self._map), size))
+        self._all = numpy.frombuffer(self._map, dtype=index_dtype(self.fields), count=frames, offset=index_offset)
+        self._slots = numpy.frombuffer(self._map, dtype=numpy.uint8, count=frames * self.height * self.width * 3,
+                                       offset=slots_offset).reshape(frames, self.height, self.width, 3)
+
+        used = numpy.flatnonzero(self._all['number'])
+        valid = [slot for slot in used if zlib.crc32(self._slots[slot]) & 0xffffffff == self._all['crc'][slot]]
+        self.damaged_frames = len(used) - len(valid)
+        self.slots = numpy.array(valid, dtype=numpy.int64)  # The slots holding complete frames, in the order written
+        self.index = self._all[self.slots]                  # Their index entries (a copy, unlike the frames)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def frame(self, i):
+        ''' Returns the i-th complete frame as a read-only (height, width, 3) array backed by the file '''
+
+        return self._slots[self.slots[i]]
+
+    def extract(self, folder):
+        ''' Writes each complete frame as a PPM file named after its number and time
+
+        :return: List of the paths written
+        '''
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        paths = []
+        for i, entry in enumerate(self.index):
+            path = os.path.join(folder, 'frame_{:06d}_{:.3f}.ppm'.format(entry['number'], entry['time']))
+            write_ppm(path, self.frame(i))
+            paths.append(path)
+        return paths
+
+    def export_numpy(self, path):
+        ''' Writes the complete frames and their index entries to a compressed .npz file '''
+
+        numpy.savez_compressed(path, frames=self._slots[self.slots], index=self.index)
+
+    def close(self):
+        self.index = self._slots = self._all = None         # Frames returned earlier are invalid once closed
+        self._map.close()
+        self._file.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Extract the frames of a #PolaroidsInSpace frame store")
+    parser.add_argument('store', nargs='+', help="frame store files")
+    parser.add_argument('--extract', metavar='FOLDER', help="write each frame to a PPM file in FOLDER")
+    parser.add_argument('--npz', metavar='FILE', help="write the frames and their index to a NumPy .npz file "
+                                                     "(one file per store, numbered if there are several)")
+    args = parser.parse_args()
+
+    for number, path in enumerate(args.store):
+        reader = FrameStoreReader(path)
+        print("{}: {} frames ({} damaged) of {}x{}".format(path, len(reader), reader.damaged_frames, reader.width,
+                                                           reader.height))
+        for entry in reader.index:
+            print("    frame {:>6}  {}  sharpness {:>8.1f}  {}".format(
+                entry['number'], datetime.datetime.fromtimestamp(entry['time']), entry['sharpness'],
+                ' '.join('{}={:.4g}'.format(field, entry[field]) for field in reader.fields)))
+
+        if args.extract:
+            print("Written {} frames to {}".format(len(reader.extract(args.extract)), args.extract))
+        if args.npz:
+            npz = args.npz if len(args.store) == 1 else '{}_{:03d}.npz'.format(os.path.splitext(args.npz)[0], number)
+            reader.export_numpy(npz)
+            print("Written {}".format(npz))
+        reader.close()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Hardware abstraction layer for the payload
+
+All of the devices used by the payload (the SenseHAT and its LED matrix, the GPIO pins, the 1-Wire thermometer, the
+joystick and the Pi camera module) are reached through this module, as is the clock used to pace the mission. The default backend drives the real
+Raspberry Pi hardware. The simulated backend swaps in the models from Utils.Polaroid_Simulator so that a full flight
+can be rehearsed on a desktop machine, with the clock optionally running many times faster than real time.
+
+Each device is created the first time it is asked for and then shared by every part of the payload, so importing a
+module never touches the hardware and the SenseHAT is only initialised once.
+'''
+
+import ctypes
+import ctypes.util
+import datetime
+import glob
+import logging
+import mmap
+import os
+import threading
+import time
+
+import numpy
+
+logger = logging.getLogger('polaroid.hardware')
+
+BACKEND_HARDWARE = 'hardware'
+BACKEND_SIMULATED = 'simulated'
+
+W1_BASE_DIR = '/sys/bus/w1/devices/'
+
+FRAMEBUFFER_NAME = 'RPi-Sense FB'       # Name the Sense HAT LED matrix driver gives its framebuffer
+FRAMEBUFFER_SIZE = 8 * 8 * 2            # 64 pixels of 16 bit RGB565
+
+
+class Clock(object):
+    ''' Clock used by the payload to measure and pace the mission
+
+    With a time warp of 1 the clock follows real time. With a time warp of N, mission time passes N times faster than
+    real time: sleeping for one mission second takes 1/N real seconds and now() advances accordingly.
+    '''
+
+    def __init__(self, time_warp=1.0):
+
+        self._lock = threading.Lock()
+        self._real_origin = time.time()         # Real time at which the current time warp was applied
+        self._mission_origin = self._real_origin  # Mission time at which the current time warp was applied
+        self.time_warp = float(time_warp)
+
+    def set_time_warp(self, time_warp):
+        ''' Changes the speed of the clock without making mission time jump
+
+        :param time_warp: Number of mission seconds that pass for every real second
+        :return:
+        '''
+
+        if time_warp <= 0:
+            raise ValueError("Time warp must be positive, got {}".format(time_warp))
+
+        with self._lock:
+            real_now = time.time()
+            self._mission_origin += (real_now - self._real_origin) * self.time_warp
+            self._real_origin = real_now
+            self.time_warp = float(time_warp)
+
+    def time(self):
+        ''' Returns the mission time as seconds since the epoch '''
+
+        with self._lock:
+            return self._mission_origin + (time.time() - self._real_origin) * self.time_warp
+
+    def now(self):
+        ''' Returns the mission time as a datetime '''
+
+        return datetime.datetime.fromtimestamp(self.time())
+
+    def sleep(self, seconds):
+        ''' Sleeps for the given number of mission seconds '''
+
+        if seconds > 0:
+            time.sleep(seconds / self.time_warp)
+
+    def wait(self, event, seconds):
+        ''' Waits up to the given number of mission seconds for a threading.Event to be set
+
+        :return: True if the event was set, False if the wait timed out
+        '''
+
+        event.wait(max(seconds, 0) / self.time_warp)
+        return event.is_set()
+
+
+clock = Clock()             # The clock used by every part of the payload
+
+_backend = BACKEND_HARDWARE
+_simulation = None          # The SimulatedFlight providing the devices when the simulated backend is in use
+
+_devices = {}               # The devices of the hardware backend created so far, by name
+_devices_lock = threading.Lock()
+
+
+def use_backend(backend, time_warp=1.0, simulation=None):
+    ''' Selects the backend used to reach the payload devices
+
+    Must be called before any of the payload objects are created.
+
+    :param backend: BACKEND_HARDWARE or BACKEND_SIMULATED
+    :param time_warp: Speed of the mission clock relative to real time
+    :param simulation: SimulatedFlight to use with the simulated backend (a default flight is created if None)
+    :return:
+    '''
+
+    global _backend, _simulation
+
+    with _devices_lock:
+        _devices.clear()
+
+    if backend == BACKEND_SIMULATED:
+        if simulation is None:
+            from Utils.Polaroid_Simulator import SimulatedFlight
+            simulation = SimulatedFlight()
+        clock.set_time_warp(time_warp)
+        simulation.start(clock)
+        _simulation = simulation
+    elif backend == BACKEND_HARDWARE:
+        clock.set_time_warp(time_warp)
+        _simulation = None
+    else:
+        raise ValueError("Unknown hardware backend: {}".format(backend))
+
+    _backend = backend
+    logger.info("Hardware backend set to '%s' (time warp %s)", backend, time_warp)
+
+
+def get_backend():
+    ''' Returns the name of the backend currently in use '''
+
+    return _backend
+
+
+def get_simulation():
+    ''' Returns the SimulatedFlight in use, or None when running on the real hardware '''
+
+    return _simulation
+
+
+def _device(name, create):
+    ''' Returns a device of the hardware backend, calling create() to make it the first time it is asked for
+
+    Creation is done once even if several threads ask for the device at the same time. If create() returns None (the
+    device isn't available) nothing is stored, so it will be tried again next time.
+    '''
+
+    device = _devices.get(name)
+    if device is None:
+        with _devices_lock:
+            device = _devices.get(name)
+            if device is None:
+                device = create()
+                if device is not None:
+                    _devices[name] = device
+                    logger.info("Device '%s' initialised", name)
+    return device
+
+
+class _SharedSenseHat(object):
+    ''' Shares one SenseHat between threads
+
+    The sensors are read over I2C through the RTIMU library, which isn't thread-safe, so calls that read or configure
+    them take a lock. The LED matrix is written through its framebuffer and isn't locked, so a message scrolling
+    across the screen doesn't hold up the IMU sampler or the barometer.
+    '''
+
+    SENSOR_METHODS = frozenset(['get_humidity', 'get_temperature', 'get_temperature_from_humidity',
+                                'get_temperature_from_pressure', 'get_pressure', 'get_orientation',
+                                'get_orientation_radians', 'get_orientation_degrees', 'get_compass',
+                                'get_compass_raw', 'get_gyroscope', 'get_gyroscope_raw', 'get_accelerometer',
+                                'get_accelerometer_raw', 'set_imu_config'])
+
+    def __init__(self, sense):
+
+        self._sense = sense
+        self._sensor_lock = threading.RLock()
+
+    def __getattr__(self, name):
+
+        attribute = getattr(self._sense, name)
+        if name not in self.SENSOR_METHODS:
+            return attribute
+
+        def locked(*args, **kwargs):
+            with self._sensor_lock:
+                return attribute(*args, **kwargs)
+
+        setattr(self, name, locked)         # Found directly from now on, without coming through __getattr__
+        return locked
+
+
+def _create_sense_hat():
+    from sense_hat import SenseHat
+    return _SharedSenseHat(SenseHat())
+
+
+def get_sense_hat():
+    ''' Returns the SenseHAT shared by the payload '''
+
+    if _simulation is not None:
+        return _simulation.sense_hat
+
+    return _device('sense_hat', _create_sense_hat)
+
+
+def get_gpio():
+    ''' Returns the GPIO module for the backend in use '''
+
+    if _simulation is not None:
+        return _simulation.gpio
+
+    import RPi.GPIO
+    return RPi.GPIO
+
+
+class _GPIOProxy(object):
+    ''' Stands in for the RPi.GPIO module, forwarding to the GPIO of the backend in use '''
+
+    def __getattr__(self, name):
+        return getattr(get_gpio(), name)
+
+
+GPIO = _GPIOProxy()
+
+
+def _create_stick():
+    import Polaroid_Reference as r
+    from Utils.Sensehat_Stick import SenseStick
+    return SenseStick(debounce=r.STICK_DEBOUNCE_SECONDS)
+
+
+def get_stick():
+    ''' Returns the SenseHAT joystick '''
+
+    if _simulation is not None:
+        return _simulation.stick
+
+    return _device('stick', _create_stick)
+
+
+class _PiCameraSource(object):
+    ''' Captures frames from the Pi camera module straight into numpy arrays
+
+    Frames are taken through the video port, which is much quicker than the still port as the camera doesn't have to
+    change mode (and meter the scene again) for every frame.
+    '''
+
+    def __init__(self, camera):
+
+        self._camera = camera
+        self.resolution = tuple(camera.resolution)
+
+    def capture(self, output):
+        ''' Captures a frame into a (height, width, 3) uint8 array '''
+
+        self._camera.capture(output, 'rgb', use_video_port=True)
+
+    def close(self):
+        self._camera.close()
+
+
+def _create_camera():
+    import Polaroid_Reference as r
+    try:
+        import picamera
+        camera = picamera.PiCamera(resolution=r.PICAMERA_RESOLUTION, framerate=r.PICAMERA_FRAME_RATE)
+    except Exception, e:
+        logger.warning("Pi camera module not available")
+        logger.warning("Error message: %s", e)
+        return None
+    return _PiCameraSource(camera)
+
+
+def get_camera():
+    ''' Returns the Pi camera module as a frame source (see Utils.Polaroid_Capture), or None if it isn't available '''
+
+    if _simulation is not None:
+        return _simulation.camera
+
+    return _device('camera', _create_camera)
+
+
+def pack_rgb565(pixels):
+    ''' Packs a list of 64 [r, g, b] pixels into the 16 bit RGB565 bytes used by the Sense HAT framebuffer
+
+    :param pixels: List or array of 64 [r, g, b] colours with components from 0 to 255
+    :return: The packed pixels as a byte string
+    '''
+
+    pixels = numpy.asarray(pixels, dtype=numpy.uint16).reshape(64, 3)
+    packed = ((pixels[:, 0] >> 3) << 11) | ((pixels[:, 1] >> 2) << 5) | (pixels[:, 2] >> 3)
+    return packed.astype('<u2').tobytes()
+
+
+def unpack_rgb565(frame):
+    ''' Unpacks RGB565 framebuffer bytes into an array of 64 [r, g, b] pixels
+
+    The low bits of each component are lost by the packing, so colours come back rounded down.
+    '''
+
+    packed = numpy.frombuffer(frame, dtype='<u2')
+    pixels = numpy.column_stack(((packed >> 11) << 3, ((packed >> 5) & 0x3F) << 2, (packed & 0x1F) << 3))
+    return pixels.astype(numpy.uint8)
+
+
+class Framebuffer(object):
+    ''' The Sense HAT LED matrix framebuffer, memory-mapped so a whole frame is shown with one copy '''
+
+    def __init__(self, device):
+
+        self.device = device
+        self._file = open(device, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), FRAMEBUFFER_SIZE)
+
+    def write(self, frame):
+        ''' Shows a frame of packed RGB565 pixels (see pack_rgb565) '''
+
+        self._map[:FRAMEBUFFER_SIZE] = frame
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def _find_framebuffer_device():
+    # The Sense HAT driver registers a framebuffer device named FRAMEBUFFER_NAME, which isn't always /dev/fb0 (e.g.
+    # when a display is attached to the HDMI port)
+    for name_file in sorted(glob.glob('/sys/class/graphics/fb*/name')):
+        with open(name_file) as f:
+            if f.read().strip() == FRAMEBUFFER_NAME:
+                return os.path.join('/dev', os.path.basename(os.path.dirname(name_file)))
+    return None
+
+
+def _open_framebuffer():
+    device = _find_framebuffer_device()
+    if device is None:
+        logger.warning("Sense HAT framebuffer not found")
+        return None
+
+    try:
+        return Framebuffer(device)
+    except (IOError, OSError, mmap.error), e:
+        logger.warning("Unable to map the Sense HAT framebuffer %s", device)
+        logger.warning("Error message: %s", e)
+        return None
+
+
+def get_framebuffer():
+    ''' Returns the Framebuffer of the Sense HAT LED matrix, or None if it can't be found or opened '''
+
+    if _simulation is not None:
+        return _simulation.framebuffer
+
+    return _device('framebuffer', _open_framebuffer)
+
+
+def _load_w1_modules():
+    # From https://learn.adafruit.com/downloads/pdf/adafruits-raspberry-pi-lesson-11-ds18b20-temperature-sensing.pdf
+    os.system('modprobe w1-gpio')
+    os.system('modprobe w1-therm')
+    return True
+
+
+def load_w1_modules():
+    ''' Loads the kernel modules needed to read the 1-Wire thermometers, the first time it is called '''
+
+    if _simulation is None:
+        _device('w1_modules', _load_w1_modules)
+
+
+def w1_device_file(device_id):
+    ''' Returns the path of the w1_slave file for a 1-Wire device '''
+
+    return os.path.join(W1_BASE_DIR, device_id, 'w1_slave')
+
+
+def discover_w1_devices(family):
+    ''' Returns the IDs of the 1-Wire devices of a family found on the bus
+
+    :param family: The family code that starts the device IDs, e.g. '28-' for DS18B20 thermometers
+    :return: Sorted list of device IDs
+    '''
+
+    if _simulation is not None:
+        return sorted(device_id for device_id in _simulation.w1_devices if device_id.startswith(family))
+
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(W1_BASE_DIR, family + '*')))
+
+
+def open_w1_slave(device_id):
+    ''' Opens the w1_slave file of a 1-Wire device for repeated reads
+
+    Each read from the start of the file (after seek(0)) takes a new reading from the device, so the handle can be
+    kept open rather than reopening the file every time.
+
+    :param device_id: The 1-Wire ID of the device, e.g. '28-0115a4e9c0ff'
+    :return: A file-like object
+    '''
+
+    if _simulation is not None:
+        return _simulation.open_w1_slave(device_id)
+
+    return open(w1_device_file(device_id), 'rb', 0)
+
+
+def read_w1_slave(device_id):
+    ''' Reads the raw output of a 1-Wire device
+
+    :param device_id: The 1-Wire ID of the device, e.g. '28-0115a4e9c0ff'
+    :return: The text of the w1_slave file
+    '''
+
+    handle = open_w1_slave(device_id)
+    try:
+        return handle.read()
+    finally:
+        handle.close()
+
+
+def preallocate_file(f, size):
+    ''' Sizes a file and reserves its disk space up front, so writing to it later never has to allocate blocks on the
+    card. Falls back to a sparse file where posix_fallocate isn't available.
+
+    :param f: The file, open for writing
+    :param size: Size in bytes
+    '''
+
+    f.truncate(size)
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = getattr(libc, 'posix_fallocate64', None) or libc.posix_fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        error = fallocate(f.fileno(), 0, size)
+        if error:
+            raise OSError(error, os.strerror(error))
+    except (OSError, AttributeError), e:
+        logger.warning("Unable to preallocate %s bytes for %s, the file will be sparse", size, f.name)
+        logger.warning("Error message: %s", e)
+
+
+def shutdown():
+    ''' Shuts down the Raspberry Pi '''
+
+    if _simulation is not None:
+        logger.info("Simulated shutdown, nothing to do")
+        return
+
+    os.system("sudo shutdown -h now")
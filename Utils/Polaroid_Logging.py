@@ -3,50 +3,288 @@
 
 # from https://aykutakin.wordpress.com/2013/08/06/logging-to-console-and-file-in-python/
 
+'''
+Logging to disk and console for the payload
+
+Each part of the payload logs through its own logger under 'polaroid' (e.g. 'polaroid.camera'), so the level of each
+subsystem can be set separately. By default records are passed to a background listener through a queue: logging a
+message from the IMU sampler or the shutter sequence only puts the record on the queue, and the message is formatted
+and written to the SD card later, in batches, by the listener's thread.
+'''
+
+import Queue
+import atexit
 import logging
+import os
 import os.path
+import sys
+import threading
+import time
+
+import Polaroid_Reference as r
+
+LOG_FORMAT = '%(asctime)s ｜ %(levelname)s ｜ %(message)s'
+SUBSYSTEM_LOGGER = 'polaroid'           # Parent of the loggers of every subsystem, e.g. 'polaroid.camera'
+
+_listener = None                        # The QueueListener started by initialize_logger, if any
+_queue_handler = None                   # The QueueHandler feeding it
+
+
+def parse_level(level):
+    ''' Converts a level name such as "INFO" (or a level number) to the logging level number
+
+    :raises ValueError: If the name isn't a logging level
+    '''
+
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError("Unknown logging level: {}".format(level))
+    return number
+
+
+class BatchFileHandler(logging.Handler):
+    '''
+    Writes log records to a file, optionally leaving them in the file's buffer until the next flush
+
+    When buffered, a batch of records costs one write to the card at the next flush rather than one each. The file is
+    synced to the card at most every fsync_interval seconds, and rotated once it grows past max_bytes (the previous
+    files are kept as path.1, path.2, ... up to backup_count). A file left by a previous run is rotated out of the way
+    rather than overwritten.
+    '''
+
+    def __init__(self, path, level=logging.NOTSET, buffered=False, max_bytes=0, backup_count=0, fsync_interval=None,
+                 delay=False):
+
+        logging.Handler.__init__(self, level)
+
+        self.path = os.path.abspath(path)
+        self.buffered = buffered
+        self.max_bytes = max_bytes              # Size at which the file is rotated (never if 0)
+        self.backup_count = backup_count
+        self.fsync_interval = fsync_interval    # Real seconds between syncs to the card (never if None)
+
+        self._stream = None
+        self._size = 0
+        self._last_fsync = time.time()
+        if not delay:
+            self._open()
+
+    def _open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            self._rotate_files()
+        self._stream = open(self.path, 'w')
+        self._size = 0
+
+    def _rotate_files(self):
+        if self.backup_count <= 0:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '{}.{}'.format(self.path, i + 1))
+        os.rename(self.path, self.path + '.1')
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + '\n'
+            if isinstance(message, unicode):
+                message = message.encode('utf-8')
+            if self._stream is None:
+                self._open()
+            self._stream.write(message)
+            self._size += len(message)
+            if self.max_bytes and self._size >= self.max_bytes:
+                self._stream.close()
+                self._stream = None
+                self._open()
+            elif not self.buffered:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._stream is None:
+                return
+            self._stream.flush()
+            if self.fsync_interval is not None and time.time() - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._stream.fileno())
+                self._last_fsync = time.time()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._stream is not None:
+                self._stream.flush()
+                os.fsync(self._stream.fileno())
+                self._stream.close()
+                self._stream = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Passes log records to a QueueListener without formatting or writing them
+
+    The message isn't formatted here, so its arguments are only turned into text on the listener's thread. Anything
+    logged as an argument should therefore not be changed afterwards (pass a copy of a buffer, not the buffer). If the
+    queue is full (e.g. the card has stalled) the record is dropped rather than holding up the caller.
+    '''
+
+    def __init__(self, queue):
+
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped_records = 0
 
-def initialize_logger(output_dir, logging_level="DEBUG"):
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped_records += 1
+
+
+class QueueListener(object):
+    '''
+    Writes the records from a QueueHandler to a set of handlers on a background thread, in batches
+
+    Each batch is the records waiting on the queue (up to batch_size), which are handled before the handlers are
+    flushed once.
+    '''
+
+    _STOP = None                            # Put on the queue to stop the listener
+
+    def __init__(self, queue, handlers, batch_size=r.LOGGING_BATCH_SIZE):
+
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.batch_count = 0
+
+        self._thread = threading.Thread(target=self._run, name='logging')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        ''' Writes out the records already queued, then stops the listener and closes its handlers
+
+        The handlers are only closed once the listener has exited, so a listener still writing after the timeout
+        (e.g. to a stalled card) isn't raced; it is a daemon thread, so it doesn't keep the payload from exiting.
+
+        :param timeout: Real seconds to wait for the listener to write out the queue
+        :return: True if the listener stopped and its handlers were closed
+        '''
+
+        if self._thread.is_alive():
+            try:
+                self.queue.put(self._STOP, timeout=timeout)
+            except Queue.Full:
+                return False
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return False
+        for handler in self.handlers:
+            handler.close()
+        return True
+
+    def _run(self):
+
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            for record in batch:
+                if record is self._STOP:
+                    stopping = True
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+            for handler in self.handlers:
+                handler.flush()
+            self.batch_count += 1
+
+
+def initialize_logger(output_dir, logging_level=r.LOGGING_LEVEL, subsystem_levels=None, queued=True):
     ''' Initiatlises logging that writes to disk and console when run from the command line
 
     :param output_dir: The directory that the *.log files are written to
     :param logging_level: The logging level that the user wants to capture messages for
+    :param subsystem_levels: Dict of logging levels by subsystem (e.g. {'camera': 'INFO'}) that override
+                             logging_level for that part of the payload (r.LOGGING_SUBSYSTEM_LEVELS if None)
+    :param queued: True to write the logs from a background listener, False to write each record as it is logged
     :return: Outputs to output.log and error_log.log
     '''
+
+    global _listener, _queue_handler
+
+    if subsystem_levels is None:
+        subsystem_levels = r.LOGGING_SUBSYSTEM_LEVELS
+
     logger = logging.getLogger()
+    logger.setLevel(parse_level(logging_level))
+    for subsystem, level in subsystem_levels.items():
+        logging.getLogger('{}.{}'.format(SUBSYSTEM_LOGGER, subsystem)).setLevel(parse_level(level))
 
-    # ToDo: Check that the logging level selection actually works
-
-    # Set the logging level depending on the user-passed value
-    if logging_level == "INFO":
-        logger.setLevel(logging.INFO)
-    elif logging_level == "WARNING":
-        logger.setLevel(logging.WARNING)
-    elif logging_level == "ERROR":
-        logger.setLevel(logging.ERROR)
-    elif logging_level == "CRITICAL":
-        logger.setLevel(logging.CRITICAL)
-    else:
-        logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(LOG_FORMAT)
 
     # create console handler and set level to info
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s ｜ %(levelname)s ｜ %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
 
     # create error file handler and set level to error
-    handler = logging.FileHandler(os.path.join(output_dir, "error_log.log"),"w", encoding=None, delay="true")
-    handler.setLevel(logging.ERROR)
-    formatter = logging.Formatter('%(asctime)s ｜ %(levelname)s ｜ %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    error_handler = BatchFileHandler(os.path.join(output_dir, "error_log.log"), logging.ERROR, buffered=queued,
+                                     max_bytes=r.LOGGING_MAX_BYTES, backup_count=r.LOGGING_BACKUP_COUNT,
+                                     fsync_interval=r.LOGGING_FSYNC_SECONDS, delay=True)
 
     # create debug file handler and set level to debug
-    handler = logging.FileHandler(os.path.join(output_dir, "output.log"),"w")
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s ｜ %(levelname)s ｜ %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    output_handler = BatchFileHandler(os.path.join(output_dir, "output.log"), logging.DEBUG, buffered=queued,
+                                      max_bytes=r.LOGGING_MAX_BYTES, backup_count=r.LOGGING_BACKUP_COUNT,
+                                      fsync_interval=r.LOGGING_FSYNC_SECONDS)
+
+    handlers = [console_handler, error_handler, output_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    if queued:
+        queue = Queue.Queue(r.LOGGING_QUEUE_SIZE)
+        _listener = QueueListener(queue, handlers)
+        _listener.start()
+        atexit.register(shutdown_logger)        # So the records still queued at exit aren't lost
+        _queue_handler = QueueHandler(queue)
+        logger.addHandler(_queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+
+def shutdown_logger():
+    ''' Writes out any queued log records and stops the background listener started by initialize_logger '''
+
+    global _listener, _queue_handler
 
+    if _listener is not None:
+        # Logged while the queue handler is still attached, so the listener writes it out with the rest
+        if _queue_handler.dropped_records:
+            logging.getLogger(SUBSYSTEM_LOGGER).warning("%s log records were dropped while the queue was full",
+                                                        _queue_handler.dropped_records)
+        logging.getLogger().removeHandler(_queue_handler)
+        if not _listener.stop():
+            sys.stderr.write("Logging listener didn't finish writing out the queued records\n")
+        _listener = None
+        _queue_handler = None
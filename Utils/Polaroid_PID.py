@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Proportional-integral-derivative controller used to hold the developing tray at its setpoint
+'''
+
+
+class PIDController(object):
+    '''
+    Computes a bounded control output (e.g. the duty cycle of a heater) from a measured value and a setpoint
+
+    The integral only accumulates while the output isn't saturated, or while the error is bringing it back from
+    saturation, so a long spell at full power (e.g. while the bath warms up) doesn't wind the integral up and overshoot
+    the setpoint afterwards. The derivative is taken on the measurement rather than the error, so changing the
+    setpoint doesn't kick the output.
+    '''
+
+    def __init__(self, kp, ki, kd, setpoint, output_min=0.0, output_max=1.0):
+
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.setpoint = setpoint
+        self.output_min = output_min
+        self.output_max = output_max
+
+        self.integral = 0.0                 # Accumulated ki * error * dt
+        self.output = output_min            # The most recent output
+        self._last_measurement = None
+        self._last_time = None
+
+    def reset(self):
+        ''' Clears the integral and derivative history, e.g. after the controller has been switched off '''
+
+        self.integral = 0.0
+        self.output = self.output_min
+        self._last_measurement = None
+        self._last_time = None
+
+    def update(self, measurement, now):
+        ''' Computes the output for a new measurement
+
+        :param measurement: The measured value, e.g. the temperature of the bath
+        :param now: The time of the measurement in seconds
+        :return: The control output, between output_min and output_max
+        '''
+
+        error = self.setpoint - measurement
+
+        if self._last_time is None or now <= self._last_time:
+            dt = 0.0
+            derivative = 0.0
+        else:
+            dt = now - self._last_time
+            derivative = -(measurement - self._last_measurement) / dt
+
+        integral = self.integral + self.ki * error * dt
+        output = self.kp * error + integral + self.kd * derivative
+
+        # Anti-windup: keep the new integral only if it doesn't push a saturated output further into saturation
+        if output > self.output_max:
+            if error < 0:
+                self.integral = integral
+            output = self.output_max
+        elif output < self.output_min:
+            if error > 0:
+                self.integral = integral
+            output = self.output_min
+        else:
+            self.integral = integral
+
+        self.output = output
+        self._last_measurement = measurement
+        self._last_time = now
+        return output
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Binary flight data recorder for the sensor streams of the payload
+
+Every reading (IMU, barometer, thermometers, heater and shutter) is appended to a preallocated, memory-mapped file as
+a fixed-size record, so recording a sample is a single struct.pack_into with no formatting and no system call. The
+IMU can then be kept at its full rate for the whole flight: at 100Hz a three hour flight is ~36MB.
+
+The file starts with a header, followed by records that each begin with a one byte type:
+
+    0               Unused space (the file is preallocated with zeros), i.e. the end of the recording
+    1               Channel definition: channel ID, length and the channel name and field names as text
+    2               Flush marker: the clock time at which everything before it was flushed to the card
+    3 and above     A reading on the channel with that ID: the clock time followed by its fields as 32 bit floats
+
+A flush marker is written every r.RECORDER_FLUSH_SECONDS, just before the file is synced to the card. As the file is
+preallocated with zeros, a reader stops at the first record that didn't reach the card, so it can only get as far as
+a marker if everything before it was written, and after a crash or power cut everything up to the last marker it
+reaches can be trusted. The syncs are made without holding the recorder's lock, so the samplers carry on recording
+while the card is written to. When a file is full the recording carries on in a new file with the next part number,
+preallocated in the background once the current file is half full, while the full file is synced and closed in the
+background.
+
+Recordings are read back with read_recording, or exported from the command line, e.g.
+
+    python -m Utils.Polaroid_Recorder /home/pi/polaroid/Flight/flight_20170401_093000_000.pfdr --csv /tmp/flight
+'''
+
+import argparse
+import datetime
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import numpy
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Scheduler import PeriodicTask
+
+logger = logging.getLogger('polaroid.recorder')
+
+MAGIC = 'PFDR'
+VERSION = 1
+FILE_EXTENSION = '.pfdr'
+
+RECORD_END = 0
+RECORD_DEFINITION = 1
+RECORD_FLUSH = 2
+FIRST_CHANNEL_ID = 3
+LAST_CHANNEL_ID = 255
+
+HEADER = struct.Struct('<4sHH')             # Magic, version, reserved
+DEFINITION = struct.Struct('<BBH')          # Record type, channel ID, length of the text that follows
+FLUSH_MARKER = struct.Struct('<Bd')         # Record type, clock time
+
+
+class Channel(object):
+    '''
+    A stream of readings, each recorded as the clock time and a fixed number of floats
+    '''
+
+    def __init__(self, channel_id, name, fields):
+
+        self.id = channel_id
+        self.name = name
+        self.fields = tuple(fields)
+        self.record = struct.Struct('<Bd{}f'.format(len(self.fields)))
+
+    def definition(self):
+        ''' Returns the text that describes the channel in a definition record '''
+
+        return ' '.join((self.name,) + self.fields)
+
+
+class FlightRecorder(object):
+    '''
+    Appends the readings of a set of channels to a memory-mapped file
+
+    Channels can be defined at any time, before or after the recorder is opened. Readings recorded while the recorder
+    isn't open are dropped, so the payload runs the same with or without it.
+    '''
+
+    def __init__(self):
+
+        self.path = None                    # The file currently being recorded to
+        self.records_written = 0
+        self.dropped_records = 0            # Readings lost because a new file couldn't be started
+
+        self._channels = []
+        self._channels_by_name = {}
+        self._file = None
+        self._map = None
+        self._offset = 0                    # Position in the file that the next record is written to
+        self._part = 0
+        self._base_path = None              # Path of the recording without the part number and extension
+        self._size = None
+        self._preparing = None              # (part, thread, list to hold the file) of the next file being preallocated
+        self._closing = []                  # Threads syncing and closing full files
+        self._lock = threading.Lock()
+        self._task = None
+
+    def channel(self, name, fields):
+        ''' Returns the channel with the given name, defining it the first time it is asked for
+
+        :param name: Name of the channel, e.g. 'imu'
+        :param fields: Names of the values recorded with each reading, e.g. ('ax', 'ay', 'az')
+        :return: Channel to pass to record
+        '''
+
+        with self._lock:
+            channel = self._channels_by_name.get(name)
+            if channel is not None:
+                if channel.fields != tuple(fields):
+                    raise ValueError("Channel '{}' is already defined with fields {}".format(name, channel.fields))
+                return channel
+
+            channel_id = FIRST_CHANNEL_ID + len(self._channels)
+            if channel_id > LAST_CHANNEL_ID:
+                raise ValueError("Too many channels to define '{}'".format(name))
+            channel = Channel(channel_id, name, fields)
+            self._channels.append(channel)
+            self._channels_by_name[name] = channel
+            if self._map is not None:
+                self._write_definition(channel)
+            return channel
+
+    def open(self, folder, size=None, flush_period=None):
+        ''' Starts recording to a new file in folder, named after the clock time
+
+        :param folder: The directory the recording is written to (created if needed)
+        :param size: Size in bytes of each file (r.RECORDER_FILE_SIZE if None)
+        :param flush_period: Seconds between flush markers (r.RECORDER_FLUSH_SECONDS if None)
+        :return: The path of the file
+        '''
+
+        if size is None:
+            size = r.RECORDER_FILE_SIZE
+        if flush_period is None:
+            flush_period = r.RECORDER_FLUSH_SECONDS
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with self._lock:
+            if self._map is not None:
+                raise ValueError("Flight recorder is already recording to {}".format(self.path))
+            self._size = size
+            self._part = 0
+            self._preparing = None
+            self._base_path = os.path.join(folder, hardware.clock.now().strftime('flight_%Y%m%d_%H%M%S'))
+            self._open_part()
+
+        self._task = PeriodicTask('recorder', self.flush, flush_period)
+        self._task.start()
+        logger.info("Flight recorder writing to %s (flushed every %ss)", self.path, flush_period)
+        return self.path
+
+    def _part_path(self, part):
+        return '{}_{:03d}{}'.format(self._base_path, part, FILE_EXTENSION)
+
+    def _open_part(self):
+        # Maps the next file of the recording, using the one preallocated in the background if it's ready, and writes
+        # its header and channel definitions (the lock must be held)
+        self.path = self._part_path(self._part)
+        self._file = self._take_prepared_file()
+        if self._file is None:
+            self._file = open(self.path, 'w+b')
+            hardware.preallocate_file(self._file, self._size)  # Reserved now, so records never wait on allocation
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, 0)
+        self._offset = HEADER.size
+        for channel in self._channels:
+            self._write_definition(channel)
+
+    def _start_preparing(self):
+        # Starts preallocating the next file on a background thread (the lock must be held)
+        part = self._part + 1
+        prepared = []
+        thread = threading.Thread(target=self._prepare_file, args=(self._part_path(part), self._size, prepared),
+                                  name='recorder_prepare')
+        thread.daemon = True
+        thread.start()
+        self._preparing = (part, thread, prepared)
+
+    @staticmethod
+    def _prepare_file(path, size, prepared):
+        # Creates and preallocates a file with an empty recording, adding it to prepared (runs on its own thread)
+        try:
+            f = open(path, 'w+b')
+            hardware.preallocate_file(f, size)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, 0))     # So a file left unused by a crash reads as an empty recording
+            f.flush()
+        except (IOError, OSError), e:
+            logger.error("Unable to preallocate flight recorder file %s", path)
+            logger.error("Error message: %s", e)
+            return
+        prepared.append(f)
+
+    def _take_prepared_file(self):
+        # Returns the file preallocated for the current part, or None if there isn't one (the lock must be held)
+        if self._preparing is None:
+            return None
+        part, thread, prepared = self._preparing
+        self._preparing = None
+        thread.join()               # Normally long finished, having been started when the last file was half full
+        if not prepared:
+            return None
+        if part != self._part:
+            prepared[0].close()
+            return None
+        return prepared[0]
+
+    def _write_definition(self, channel):
+        # The lock must be held
+        text = channel.definition()
+        if not self._reserve(DEFINITION.size + len(text)):
+            return
+        DEFINITION.pack_into(self._map, self._offset, RECORD_DEFINITION, channel.id, len(text))
+        start = self._offset + DEFINITION.size
+        self._map[start:start + len(text)] = text
+        self._offset = start + len(text)
+
+    def _reserve(self, size):
+        # Makes sure there's room for a record of size bytes, moving on to a new file if this one is full (the lock
+        # must be held). Room is always left for the flush marker that ends the file, and a record of type 0 after
+        # it so readers know where the recording stops.
+        if self._offset + size + FLUSH_MARKER.size < self._size:
+            if self._preparing is None and self._offset > self._size // 2:
+                self._start_preparing()
+            return True
+
+        closer = threading.Thread(target=self._sync_and_close, args=self._end_part(), name='recorder_close')
+        closer.start()
+        self._closing = [thread for thread in self._closing if thread.is_alive()] + [closer]
+        self._part += 1
+        try:
+            self._open_part()
+        except (IOError, OSError, mmap.error), e:
+            logger.error("Unable to start flight recorder file %s", self.path)
+            logger.error("Error message: %s", e)
+            self._map = None
+            return False
+        logger.info("Flight recorder continuing in %s", self.path)
+        return True
+
+    def record(self, channel, timestamp, values):
+        ''' Records a reading
+
+        :param channel: The Channel the reading is on
+        :param timestamp: The clock time of the reading
+        :param values: The values of the channel's fields, in order
+        :return:
+        '''
+
+        if self._map is None:
+            return
+
+        with self._lock:
+            if self._map is None or not self._reserve(channel.record.size):
+                self.dropped_records += 1
+                return
+            channel.record.pack_into(self._map, self._offset, channel.id, timestamp, *values)
+            self._offset += channel.record.size
+            self.records_written += 1
+
+    def flush(self):
+        ''' Marks the records so far with a flush marker, then writes them to the card '''
+
+        with self._lock:
+            if self._map is None or not self._reserve(FLUSH_MARKER.size):
+                return
+            FLUSH_MARKER.pack_into(self._map, self._offset, RECORD_FLUSH, hardware.clock.time())
+            self._offset += FLUSH_MARKER.size
+            descriptor = self._file.fileno()
+
+        # fsync writes the pages changed through the map too, and unlike mmap.flush lets other threads run meanwhile
+        try:
+            os.fsync(descriptor)
+        except OSError, e:             # The file has just been closed, which syncs it anyway
+            logger.debug("Flight recorder file closed while it was flushed: %s", e)
+
+    def _end_part(self):
+        # Writes the last flush marker of the current file, leaving the unused space as zeros, and detaches it,
+        # returning its (map, file) to be synced and closed (the lock must be held)
+        FLUSH_MARKER.pack_into(self._map, self._offset, RECORD_FLUSH, hardware.clock.time())
+        self._offset += FLUSH_MARKER.size
+        mapping, f = self._map, self._file
+        self._map = None
+        self._file = None
+        return mapping, f
+
+    @staticmethod
+    def _sync_and_close(mapping, f):
+        os.fsync(f.fileno())
+        mapping.close()
+        f.close()
+
+    def close(self):
+        ''' Flushes the recording and stops recording '''
+
+        if self._task is not None:
+            self._task.stop()
+            self._task.join()
+            self._task = None
+
+        with self._lock:
+            preparing, self._preparing = self._preparing, None
+            closing, self._closing = self._closing, []
+            recording = self._map is not None
+            if recording:
+                self._sync_and_close(*self._end_part())
+                # Trim the unused space so the file is no bigger than the recording
+                with open(self.path, 'r+b') as f:
+                    f.truncate(self._offset + 1)
+
+        for thread in closing:
+            thread.join()
+        if preparing is not None:           # The next file wasn't needed
+            part, thread, prepared = preparing
+            thread.join()
+            if prepared:
+                prepared[0].close()
+                os.remove(self._part_path(part))
+        if not recording:
+            return
+        logger.info("Flight recorder closed after %s records (%s dropped)", self.records_written, self.dropped_records)
+
+    def is_recording(self):
+        return self._map is not None
+
+
+flight_recorder = FlightRecorder()      # The recorder used by every part of the payload
+
+
+def read_recording(path, include_unflushed=False):
+    ''' Reads the readings of every channel from a recording
+
+    :param path: Path of a recording file
+    :param include_unflushed: True to include the readings after the last flush marker, which may be incomplete if
+                              the recording didn't end cleanly
+    :return: Dict of numpy record arrays by channel name, with a 'time' field followed by the channel's fields
+    '''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("{} is not a flight recording".format(path))
+    if version != VERSION:
+        raise ValueError("{} is a version {} flight recording, expected version {}".format(path, version, VERSION))
+
+    channels = {}                           # Channel by ID
+    rows = {}                               # Readings by channel ID
+    flushed = {}                            # Number of readings of each channel before the last flush marker
+    offset = HEADER.size
+    end = len(data)
+
+    while offset < end:
+        record_type = ord(data[offset])
+        if record_type == RECORD_END:
+            break
+
+        elif record_type == RECORD_DEFINITION:
+            if offset + DEFINITION.size > end:
+                break
+            _, channel_id, length = DEFINITION.unpack_from(data, offset)
+            start = offset + DEFINITION.size
+            words = data[start:start + length].split()
+            if len(words) < 1 or start + length > end:
+                break
+            channels[channel_id] = Channel(channel_id, words[0], words[1:])
+            rows.setdefault(channel_id, [])
+            offset = start + length
+
+        elif record_type == RECORD_FLUSH:
+            offset += FLUSH_MARKER.size
+            flushed = dict((channel_id, len(readings)) for channel_id, readings in rows.items())
+
+        elif record_type in channels:
+            record = channels[record_type].record
+            if offset + record.size > end:
+                break
+            rows[record_type].append(record.unpack_from(data, offset)[1:])
+            offset += record.size
+
+        else:
+            logger.warning("Unknown record type %s at offset %s of %s", record_type, offset, path)
+            break
+
+    recording = {}
+    for channel_id, channel in channels.items():
+        readings = rows[channel_id] if include_unflushed else rows[channel_id][:flushed.get(channel_id, 0)]
+        dtype = [('time', '<f8')] + [(field, '<f4') for field in channel.fields]
+        recording[channel.name] = numpy.array(readings, dtype=dtype)
+    return recording
+
+
+def read_recordings(paths, include_unflushed=False):
+    ''' Reads the parts of a recording (or several recordings) into one set of channels, in the order given
+
+    :return: Dict of numpy record arrays by channel name (see read_recording)
+    '''
+
+    parts = {}
+    for path in paths:
+        for name, readings in read_recording(path, include_unflushed).items():
+            parts.setdefault(name, []).append(readings)
+    return dict((name, numpy.concatenate(readings)) for name, readings in parts.items())
+
+
+def export_csv(recording, folder):
+    ''' Writes each channel of a recording to its own CSV file, e.g. imu.csv
+
+    :param recording: Dict of channels from read_recording
+    :param folder: The directory the files are written to (created if needed)
+    :return: List of the paths written
+    '''
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    paths = []
+    for name, readings in sorted(recording.items()):
+        path = os.path.join(folder, '{}.csv'.format(name))
+        columns = numpy.column_stack([readings[field] for field in readings.dtype.names]) if len(readings) else []
+        numpy.savetxt(path, columns, fmt=['%.6f'] + ['%.9g'] * (len(readings.dtype.names) - 1), delimiter=',',
+                      header=','.join(readings.dtype.names), comments='')
+        paths.append(path)
+    return paths
+
+
+def export_numpy(recording, path):
+    ''' Writes every channel of a recording to a compressed .npz file, as one record array per channel '''
+
+    numpy.savez_compressed(path, **recording)
+
+
+def _recording_paths(paths):
+    # Expands a recording given without its part number into all of its parts
+    expanded = []
+    for path in paths:
+        if os.path.exists(path):
+            expanded.append(path)
+        else:
+            expanded.extend(sorted(glob.glob('{}_[0-9][0-9][0-9]{}'.format(path, FILE_EXTENSION))))
+    return expanded
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Export a #PolaroidsInSpace flight recording")
+    parser.add_argument('recording', nargs='+',
+                        help="recording files, or a recording without its part number to read all of its parts")
+    parser.add_argument('--csv', metavar='FOLDER', help="write each channel to a CSV file in FOLDER")
+    parser.add_argument('--npz', metavar='FILE', help="write every channel to a NumPy .npz file")
+    parser.add_argument('--include-unflushed', action='store_true',
+                        help="include the readings after the last flush marker")
+    args = parser.parse_args()
+
+    recording = read_recordings(_recording_paths(args.recording), args.include_unflushed)
+
+    for name, readings in sorted(recording.items()):
+        if len(readings):
+            print("{:<32} {:>9} readings  {} to {}".format(
+                name, len(readings), datetime.datetime.fromtimestamp(readings['time'][0]),
+                datetime.datetime.fromtimestamp(readings['time'][-1])))
+        else:
+            print("{:<32} {:>9} readings".format(name, 0))
+
+    if args.csv:
+        for path in export_csv(recording, args.csv):
+            print("Written {}".format(path))
+    if args.npz:
+        export_numpy(recording, args.npz)
+        print("Written {}".format(args.npz))
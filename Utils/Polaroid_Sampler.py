@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Background sampling of the SenseHAT inertial measurement unit
+
+The sampler reads the accelerometer and gyroscope at a steady rate on its own thread and stores the timestamped
+readings in a preallocated ring buffer, so the camera can look at the recent motion of the payload immediately instead
+of having to read the sensors (and sleep between reads) while it decides whether to take a photo.
+'''
+
+import threading
+
+import numpy
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Scheduler import PeriodicTask
+
+IMU_CHANNEL = flight_recorder.channel('imu', ('ax', 'ay', 'az', 'gx', 'gy', 'gz'))
+
+
+class RingBuffer(object):
+    '''
+    Fixed-size buffer of timestamped samples, allocated once so that sampling never allocates memory
+
+    Each row holds the timestamp followed by the sample values. Samples are numbered from 1 in the order they were
+    written, which lets readers pick up exactly the samples they haven't seen yet.
+    '''
+
+    def __init__(self, capacity, columns):
+
+        self.capacity = capacity
+        self.count = 0                  # Total number of samples ever written
+
+        self._data = numpy.zeros((capacity, columns + 1))
+        self._index = 0                 # Row that the next sample is written to
+        self._lock = threading.Lock()
+
+    def append(self, timestamp, values):
+        ''' Writes a sample, overwriting the oldest one once the buffer is full '''
+
+        with self._lock:
+            row = self._data[self._index]
+            row[0] = timestamp
+            row[1:] = values
+            self._index = (self._index + 1) % self.capacity
+            self.count += 1
+
+    def _rows(self, n):
+        # Copies the n most recent rows, oldest first (the lock must be held)
+        n = min(n, self.count, self.capacity)
+        start = self._index - n
+        if start >= 0:
+            return self._data[start:self._index].copy()
+        return numpy.concatenate((self._data[start:], self._data[:self._index]))
+
+    def latest(self, n):
+        ''' Returns a copy of the n most recent samples, oldest first '''
+
+        with self._lock:
+            return self._rows(n)
+
+    def since(self, count):
+        ''' Returns the samples written after sample number count, oldest first, and the number of the newest sample
+
+        :param count: The number of the last sample already read (0 to read everything still in the buffer)
+        :return: (array of samples, number of the newest sample)
+        '''
+
+        with self._lock:
+            return self._rows(self.count - count), self.count
+
+
+class IMUSampler(object):
+    '''
+    Reads the IMU at a fixed rate into a RingBuffer of (timestamp, ax, ay, az, gx, gy, gz) rows
+
+    Acceleration is in g and angular rate in radians per second.
+    '''
+
+    def __init__(self, sense, rate=r.SAMPLER_RATE_HZ, capacity=r.SAMPLER_BUFFER_SIZE):
+
+        self.sense = sense
+        self.period = 1.0 / rate
+        self.buffer = RingBuffer(capacity, 6)
+        self._task = None
+
+    def _sample(self):
+        accel = self.sense.get_accelerometer_raw()
+        gyro = self.sense.get_gyroscope_raw()
+        now = hardware.clock.time()
+        values = (accel['x'], accel['y'], accel['z'], gyro['x'], gyro['y'], gyro['z'])
+        self.buffer.append(now, values)
+        flight_recorder.record(IMU_CHANNEL, now, values)
+
+    def start(self):
+        if self._task is None:
+            self._task = PeriodicTask('imu', self._sample, self.period)
+            self._task.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task.join()
+            self._task = None
+
+    def is_running(self):
+        return self._task is not None
+
+    def age(self):
+        ''' Returns the number of seconds since the newest sample was taken, or None if there are no samples '''
+
+        newest = self.buffer.latest(1)
+        if not len(newest):
+            return None
+        return hardware.clock.time() - newest[0, 0]
+
+    def is_stalled(self, max_age=r.SAMPLER_STALL_SECONDS):
+        ''' Returns True if the sampler hasn't produced a reading for max_age seconds
+
+        The age is judged in real time: under a large time warp the thread can't keep up with the nominal rate, which
+        shouldn't be mistaken for a failed sensor.
+        '''
+
+        age = self.age()
+        return age is None or age > max_age * hardware.clock.time_warp
+
+
+def exponential_moving_average(values, initial_average, constant=None):
+    ''' Applies a run of values to an exponential moving average in one vectorised step
+
+    Equivalent to repeating average = value * (1 - constant) + constant * average for each value in turn.
+
+    :param values: The new values, oldest first
+    :param initial_average: The moving average before the first value
+    :param constant: Weight of the previous average (r.MOVING_AVERAGE_EXP_CONSTANT if None)
+    :return: The moving average after the last value
+    '''
+
+    if constant is None:
+        constant = r.MOVING_AVERAGE_EXP_CONSTANT
+
+    n = len(values)
+    weights = (1 - constant) * constant ** numpy.arange(n - 1, -1, -1)
+    return float(constant ** n * initial_average + numpy.dot(weights, values))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Runs the periodic jobs of the mission (thermostat, altitude sampling, stability monitoring, display and joystick)
+
+Each task runs on its own thread at its own rate, so a slow sensor read or a long wait for the camera to settle in one
+task doesn't delay any of the others. Tasks are paced by the mission clock so they follow the time warp of the
+simulated backend.
+'''
+
+import logging
+import threading
+
+from Utils import Polaroid_Hardware as hardware
+
+logger = logging.getLogger('polaroid.scheduler')
+
+
+class PeriodicTask(object):
+    '''
+    Calls an action at a fixed rate on a dedicated thread
+    '''
+
+    def __init__(self, name, action, period):
+
+        self.name = name
+        self.action = action
+        self.period = period            # Seconds between the start of each call to the action
+
+        self.run_count = 0
+        self.error_count = 0
+        self.overrun_count = 0          # Number of times the action took longer than the period
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+
+        clock = hardware.clock
+        next_run = clock.time()
+
+        while not self._stop.is_set():
+            try:
+                self.action()
+            except Exception, e:
+                self.error_count += 1
+                logger.error("Error in scheduled task '%s'", self.name)
+                logger.error("Error message: %s", e)
+            self.run_count += 1
+
+            # Schedule against fixed deadlines so the rate doesn't drift, skipping any that have already been missed
+            next_run += self.period
+            now = clock.time()
+            if now > next_run:
+                self.overrun_count += 1
+                next_run = now
+
+            clock.wait(self._stop, next_run - now)
+
+
+class MissionScheduler(object):
+    '''
+    Starts and stops the periodic tasks of the mission
+    '''
+
+    def __init__(self):
+
+        self.tasks = []
+
+    def add_task(self, name, action, period):
+        ''' Adds a task that calls action every period seconds once the scheduler is started
+
+        :return: The PeriodicTask
+        '''
+
+        task = PeriodicTask(name, action, period)
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        for task in self.tasks:
+            task.start()
+        logger.info("Mission scheduler started: %s",
+                    ", ".join("{} every {}s".format(task.name, task.period) for task in self.tasks))
+
+    def stop(self, timeout=5.0):
+        ''' Stops every task and waits up to timeout (real) seconds for each to finish its current call '''
+
+        for task in self.tasks:
+            task.stop()
+        for task in self.tasks:
+            task.join(timeout)
+            logger.info("Scheduled task '%s' stopped after %s runs (%s errors, %s overruns)",
+                        task.name, task.run_count, task.error_count, task.overrun_count)
@@ -0,0 +1,560 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Simulated payload hardware, used to rehearse a flight without the Raspberry Pi, the SenseHAT or any Polaroid film
+
+A SimulatedFlight models the ascent of the balloon, the swinging of the payload beneath it and the temperature of the
+developing tray, and exposes the same devices as the real payload: a SenseHAT, the GPIO pins, the 1-Wire thermometer,
+the joystick and the Pi camera module. It is installed with Utils.Polaroid_Hardware.use_backend(BACKEND_SIMULATED).
+'''
+
+import bisect
+import csv
+import logging
+import math
+import random
+import threading
+import time
+
+import numpy
+
+import Polaroid_Reference as r
+from Polaroid_Altitude import ISA_TROPOPAUSE_ALTITUDE, altitude_at_pressure, pressure_at_altitude
+from Utils.Polaroid_Hardware import unpack_rgb565
+from Utils.Sensehat_Stick import SenseStick, InputEvent
+
+logger = logging.getLogger('polaroid.simulator')
+
+
+def temperature_at_altitude(altitude):
+    ''' Returns the air temperature (in celsius) at an altitude using the International Standard Atmosphere '''
+
+    return 15.0 - 6.5 * min(max(altitude, 0.0), ISA_TROPOPAUSE_ALTITUDE) / 1000.0
+
+
+class SimulatedFlight(object):
+    '''
+    Models a balloon flight and provides simulated versions of the payload devices
+    '''
+
+    def __init__(self, ascent_rate=r.SIM_ASCENT_RATE, descent_rate=r.SIM_DESCENT_RATE,
+                 burst_altitude=r.SIM_BURST_ALTITUDE, swing_period=r.SIM_SWING_PERIOD,
+                 swing_amplitude=r.SIM_SWING_AMPLITUDE, joystick_script=None, seed=None):
+
+        self.ascent_rate = ascent_rate
+        self.descent_rate = descent_rate
+        self.burst_altitude = burst_altitude
+        self.swing_period = swing_period
+        self.swing_amplitude = swing_amplitude
+
+        self.random = random.Random(seed)
+        self.clock = None
+        self.launch_time = None             # Clock time at which the simulated flight started
+
+        self.bath_temperature = r.SIM_BATH_START_TEMP
+        self._bath_updated = None           # Flight time at which the bath temperature was last integrated
+        self._lock = threading.Lock()
+
+        if joystick_script is None:
+            joystick_script = [(r.SIM_JOYSTICK_START_DELAY, SenseStick.KEY_UP)]
+
+        self.w1_devices = list(r.SIM_W1_DEVICES)
+        self.gpio = SimulatedGPIO(self)
+        self.sense_hat = SimulatedSenseHat(self)
+        self.framebuffer = SimulatedFramebuffer(self.sense_hat)
+        self.stick = SimulatedSenseStick(self, joystick_script)
+        self.camera = SimulatedCamera(self)
+
+    def start(self, clock):
+        ''' Starts the flight clock, called by Utils.Polaroid_Hardware.use_backend '''
+
+        self.clock = clock
+        self.launch_time = clock.time()
+        self._bath_updated = 0.0
+
+    def flight_time(self):
+        ''' Returns the number of seconds since the start of the simulated flight '''
+
+        return self.clock.time() - self.launch_time
+
+    def altitude(self, t=None):
+        ''' Returns the altitude of the payload in metres '''
+
+        if t is None:
+            t = self.flight_time()
+
+        burst_time = self.burst_altitude / self.ascent_rate
+        if t <= burst_time:
+            return self.ascent_rate * t
+        return max(self.burst_altitude - self.descent_rate * (t - burst_time), 0.0)
+
+    def pressure(self, t=None):
+        ''' Returns the atmospheric pressure in millibars '''
+
+        return pressure_at_altitude(self.altitude(t))
+
+    def swing_angle(self, t=None):
+        ''' Returns the angle (in radians) and angular rate (in radians per second) of the swinging payload '''
+
+        if t is None:
+            t = self.flight_time()
+
+        # The swing grows and dies away as gusts pass, giving still moments to take a photo in
+        amplitude = self.swing_amplitude * (0.6 + 0.4 * math.sin(2 * math.pi * t / 97.0))
+        omega = 2 * math.pi / self.swing_period
+        return amplitude * math.sin(omega * t), amplitude * omega * math.cos(omega * t)
+
+    def acceleration(self, t=None):
+        ''' Returns the x, y, z acceleration of the payload in g '''
+
+        angle, rate = self.swing_angle(t)
+        pendulum_length = 9.81 * (self.swing_period / (2 * math.pi)) ** 2
+        centripetal = pendulum_length * rate ** 2 / 9.81
+
+        noise = r.SIM_ACCELEROMETER_NOISE
+        return (math.sin(angle) + self.random.gauss(0, noise),
+                self.random.gauss(0, noise),
+                math.cos(angle) + centripetal + self.random.gauss(0, noise))
+
+    def angular_rate(self, t=None):
+        ''' Returns the x, y, z angular rate of the payload in radians per second '''
+
+        angle, rate = self.swing_angle(t)
+        return (self.random.gauss(0, 0.002), rate + self.random.gauss(0, 0.002), self.random.gauss(0, 0.002))
+
+    def get_bath_temperature(self):
+        ''' Integrates the temperature of the developing tray up to the current flight time '''
+
+        with self._lock:
+            t = self.flight_time()
+            while self._bath_updated < t:
+                step = min(1.0, t - self._bath_updated)
+                ambient = temperature_at_altitude(self.altitude(self._bath_updated))
+                heating = r.SIM_HEATER_POWER * self.gpio.duty(r.GPIO_PIN_DEVELOP_TRAY) / r.SIM_BATH_HEAT_CAPACITY
+                cooling = (self.bath_temperature - ambient) / r.SIM_BATH_TIME_CONSTANT
+                self.bath_temperature += (heating - cooling) * step
+                self._bath_updated += step
+            return self.bath_temperature
+
+    def read_w1_slave(self, device_id):
+        ''' Returns the contents of the w1_slave file of a simulated DS18B20
+
+        The thermometer in the developing tray reads the bath temperature and any other reads the outside air.
+        '''
+
+        if device_id not in self.w1_devices:
+            raise IOError("No such file or directory: '{}'".format(device_id))
+
+        if device_id == r.EXTERNAL_THERMOMETER_ID:
+            temperature = self.get_bath_temperature()
+        else:
+            temperature = temperature_at_altitude(self.altitude())
+
+        millidegrees = int(round(temperature * 1000))
+        raw = millidegrees * 16 // 1000 & 0xffff
+        data = '{:02x} {:02x} 4b 46 7f ff 0c 10 1c'.format(raw & 0xff, raw >> 8)
+        return '{} : crc=1c YES\n{} t={}\n'.format(data, data, millidegrees)
+
+    def open_w1_slave(self, device_id):
+        ''' Returns a handle to the w1_slave file of a simulated DS18B20 '''
+
+        return SimulatedW1Slave(self, device_id)
+
+
+TRACE_COLUMNS = ('flight_time', 'pressure', 'accel_x', 'accel_y', 'accel_z', 'gyro_x', 'gyro_y', 'gyro_z',
+                 'tray_temperature')
+
+
+class TraceFlight(SimulatedFlight):
+    '''
+    Replays the sensor readings recorded during a flight
+
+    The trace is a CSV file with a header row. 'flight_time' (seconds since launch) and 'pressure' (millibars) are
+    required; the accelerometer (g), gyroscope (radians per second) and developing tray temperature (celsius) columns
+    are optional and fall back to the SimulatedFlight model when missing. Readings are interpolated linearly between
+    samples and hold their last value once the trace ends.
+    '''
+
+    def __init__(self, trace_file, joystick_script=None, seed=None):
+
+        super(TraceFlight, self).__init__(joystick_script=joystick_script, seed=seed)
+
+        self.trace_file = trace_file
+        self.trace = load_trace(trace_file)
+        self.times = self.trace['flight_time']
+
+    def duration(self):
+        ''' Returns the flight time at the end of the trace '''
+
+        return self.times[-1]
+
+    def _interpolate(self, column, t):
+        values = self.trace[column]
+        i = bisect.bisect_right(self.times, t)
+        if i == 0:
+            return values[0]
+        if i == len(self.times):
+            return values[-1]
+        t0, t1 = self.times[i - 1], self.times[i]
+        return values[i - 1] + (values[i] - values[i - 1]) * (t - t0) / (t1 - t0)
+
+    def pressure(self, t=None):
+        if t is None:
+            t = self.flight_time()
+        return self._interpolate('pressure', t)
+
+    def altitude(self, t=None):
+        return altitude_at_pressure(self.pressure(t))
+
+    def acceleration(self, t=None):
+        if 'accel_x' not in self.trace:
+            return super(TraceFlight, self).acceleration(t)
+        if t is None:
+            t = self.flight_time()
+        return tuple(self._interpolate(column, t) for column in ('accel_x', 'accel_y', 'accel_z'))
+
+    def angular_rate(self, t=None):
+        if 'gyro_x' not in self.trace:
+            return super(TraceFlight, self).angular_rate(t)
+        if t is None:
+            t = self.flight_time()
+        return tuple(self._interpolate(column, t) for column in ('gyro_x', 'gyro_y', 'gyro_z'))
+
+    def get_bath_temperature(self):
+        if 'tray_temperature' not in self.trace:
+            return super(TraceFlight, self).get_bath_temperature()
+        return self._interpolate('tray_temperature', self.flight_time())
+
+
+def load_trace(trace_file):
+    ''' Reads a recorded sensor trace into a dictionary of columns, sorted by flight time '''
+
+    with open(trace_file, 'r') as f:
+        rows = [row for row in csv.DictReader(f)]
+
+    if not rows or 'flight_time' not in rows[0] or 'pressure' not in rows[0]:
+        raise ValueError("Trace {} needs at least 'flight_time' and 'pressure' columns".format(trace_file))
+
+    rows.sort(key=lambda row: float(row['flight_time']))
+    return dict((column, [float(row[column]) for row in rows]) for column in TRACE_COLUMNS if column in rows[0])
+
+
+def record_trace(trace_file, flight=None, duration=3 * 60 * 60, interval=0.5):
+    ''' Writes the readings of a simulated flight to a trace file that TraceFlight can replay
+
+    :param trace_file: The CSV file to write
+    :param flight: The SimulatedFlight to sample (a default flight is used if None)
+    :param duration: Length of the trace in seconds of flight time
+    :param interval: Seconds of flight time between samples
+    :return:
+    '''
+
+    if flight is None:
+        flight = SimulatedFlight(seed=0)
+
+    with open(trace_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(TRACE_COLUMNS)
+        for i in range(int(duration / interval) + 1):
+            t = i * interval
+            accel = flight.acceleration(t)
+            gyro = flight.angular_rate(t)
+            ambient = temperature_at_altitude(flight.altitude(t))
+            tray = ambient + (r.SIM_BATH_START_TEMP - ambient) * math.exp(-t / r.SIM_BATH_TIME_CONSTANT)
+            writer.writerow(['{:.2f}'.format(t), '{:.3f}'.format(flight.pressure(t))] +
+                            ['{:.5f}'.format(v) for v in accel + gyro] + ['{:.3f}'.format(tray)])
+
+
+class SimulatedGPIO(object):
+    '''
+    Stands in for the RPi.GPIO module and records every change to the output pins
+    '''
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self, flight):
+
+        self.flight = flight
+        self.mode = None
+        self.pins = {}          # The current state of each output pin
+        self.history = []       # (flight time, pin, state) for every output change
+        self.pwm = {}           # The SimulatedPWM driving each pin that has one
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=LOW):
+        self.pins[pin] = bool(initial)
+
+    def output(self, pin, state):
+        if pin not in self.pins:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        state = bool(state)
+        if self.pins[pin] != state:
+            self.flight.get_bath_temperature()          # Bring the thermal model up to date before the change
+            self.history.append((self.flight.flight_time(), pin, state))
+        self.pins[pin] = state
+
+    def input(self, pin):
+        return self.pins.get(pin, False)
+
+    def PWM(self, pin, frequency):
+        pwm = SimulatedPWM(self, pin, frequency)
+        self.pwm[pin] = pwm
+        return pwm
+
+    def duty(self, pin):
+        ''' Returns the fraction of time the pin is driven high '''
+
+        pwm = self.pwm.get(pin)
+        if pwm is not None and pwm.running:
+            return pwm.duty_cycle / 100.0
+        return 1.0 if self.pins.get(pin, False) else 0.0
+
+    def cleanup(self):
+        self.pins = {}
+        self.pwm = {}
+
+
+class SimulatedPWM(object):
+    '''
+    Stands in for RPi.GPIO.PWM, recording the duty cycle (in percent) that a pin is driven at
+    '''
+
+    def __init__(self, gpio, pin, frequency):
+
+        if pin not in gpio.pins:
+            raise RuntimeError("You must setup() the GPIO channel as an output first")
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0.0
+        self.running = False
+
+    def _change(self, running, duty_cycle):
+        if not 0.0 <= duty_cycle <= 100.0:
+            raise ValueError("dutycycle must have a value from 0.0 to 100.0")
+        self.gpio.flight.get_bath_temperature()         # Bring the thermal model up to date before the change
+        self.running = running
+        self.duty_cycle = float(duty_cycle)
+
+    def start(self, duty_cycle):
+        self._change(True, duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self._change(self.running, duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self._change(False, self.duty_cycle)
+
+
+class SimulatedSenseHat(object):
+    '''
+    Stands in for sense_hat.SenseHat, reading its sensors from the simulated flight
+    '''
+
+    def __init__(self, flight):
+
+        self.flight = flight
+        self._pixels = [[0, 0, 0] for _ in range(64)]
+
+    def get_pressure(self):
+        # The barometer is noisy and now and then gives a spurious reading
+        if self.flight.random.random() < r.SIM_PRESSURE_GLITCH_PROBABILITY:
+            return self.flight.random.uniform(0, r.PHOTOS_MIN_ATMOSPHERIC_PRESSURE)
+        return self.flight.pressure() + self.flight.random.gauss(0, r.SIM_PRESSURE_NOISE)
+
+    def get_temperature(self):
+        return temperature_at_altitude(self.flight.altitude())
+
+    def get_accelerometer_raw(self):
+        x, y, z = self.flight.acceleration()
+        return {'x': x, 'y': y, 'z': z}
+
+    def get_gyroscope_raw(self):
+        x, y, z = self.flight.angular_rate()
+        return {'x': x, 'y': y, 'z': z}
+
+    def set_pixels(self, pixel_list):
+        if len(pixel_list) != 64:
+            raise ValueError('Pixel lists must have 64 elements')
+        self._pixels = [list(pixel) for pixel in pixel_list]
+
+    def get_pixels(self):
+        return [list(pixel) for pixel in self._pixels]
+
+    def set_pixel(self, x, y, *args):
+        pixel = args[0] if len(args) == 1 else args
+        self._pixels[y * 8 + x] = list(pixel)
+
+    def get_pixel(self, x, y):
+        return list(self._pixels[y * 8 + x])
+
+    def clear(self, *args):
+        colour = (args[0] if len(args) == 1 else args) if args else [0, 0, 0]
+        self._pixels = [list(colour) for _ in range(64)]
+
+    def show_message(self, text_string, scroll_speed=.1, text_colour=[255, 255, 255], back_colour=[0, 0, 0]):
+        # Each character is 5 columns wide plus a column of spacing, and the message scrolls on and off the screen
+        self.flight.clock.sleep((len(text_string) * 6 + 8) * scroll_speed)
+        self.clear(back_colour)
+
+
+class SimulatedW1Slave(object):
+    '''
+    Stands in for an open w1_slave file, taking a new reading (and the time of a conversion) each time it is read
+    '''
+
+    def __init__(self, flight, device_id):
+
+        self.flight = flight
+        self.device_id = device_id
+        self._position = 0
+
+    def seek(self, offset):
+        self._position = offset
+
+    def read(self):
+        if self._position:
+            return ''
+        self.flight.clock.sleep(r.SIM_W1_CONVERSION_SECONDS)
+        data = self.flight.read_w1_slave(self.device_id)
+        self._position = len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class SimulatedFramebuffer(object):
+    '''
+    Stands in for the memory-mapped Sense HAT framebuffer, showing the frames written to it on the simulated SenseHAT
+    '''
+
+    def __init__(self, sense_hat):
+
+        self.sense_hat = sense_hat
+        self.frames_written = 0
+
+    def write(self, frame):
+        self.sense_hat.set_pixels(unpack_rgb565(frame).tolist())
+        self.frames_written += 1
+
+    def close(self):
+        pass
+
+
+class SimulatedCamera(object):
+    '''
+    Stands in for the Pi camera module, looking out at a horizon that moves and blurs as the payload swings
+
+    The scene is drawn once; each frame is the part of it in view at the current swing angle, smeared vertically by
+    the distance the view moves during the exposure, so frames taken near the end of a swing are the sharpest.
+    '''
+
+    def __init__(self, flight, resolution=r.SIM_CAMERA_RESOLUTION, seed=0):
+
+        self.flight = flight
+        self.resolution = tuple(resolution)
+        self.frames_captured = 0
+
+        width, height = self.resolution
+        self._pixels_per_radian = width / r.SIM_CAMERA_FIELD_OF_VIEW
+        self._margin = height // 2          # Rows of the scene above and below the view at rest
+        self._scene = self._draw_scene(width, height + 2 * self._margin, numpy.random.RandomState(seed))
+
+    @staticmethod
+    def _draw_scene(width, height, rng):
+        # Cloudy sky above the horizon and mottled ground below, with texture at two scales so blur is easy to see
+        coarse = numpy.kron(rng.rand(height // 8 + 1, width // 8 + 1), numpy.ones((8, 8)))[:height, :width]
+        texture = 0.7 * coarse + 0.3 * rng.rand(height, width)
+        sky = numpy.arange(height) < height // 2
+
+        scene = numpy.empty((height, width, 3), dtype=numpy.float32)
+        scene[sky] = numpy.array([90, 140, 230]) * (0.5 + 0.5 * texture[sky])[:, :, numpy.newaxis]
+        scene[~sky] = numpy.array([70, 100, 60]) * (0.3 + 0.7 * texture[~sky])[:, :, numpy.newaxis]
+        return scene
+
+    def capture(self, output):
+        ''' Captures a frame into a (height, width, 3) uint8 array '''
+
+        height = self.resolution[1]
+        angle, rate = self.flight.swing_angle()
+        blur = int(round(abs(rate) * r.SIM_CAMERA_EXPOSURE * self._pixels_per_radian))
+        top = int(round(self._margin + angle * self._pixels_per_radian))
+        top = min(max(top, 0), len(self._scene) - height - blur)
+
+        if blur > 1:
+            # Average each pixel over the rows that pass it during the exposure
+            rows = numpy.cumsum(self._scene[top:top + height + blur], axis=0)
+            output[...] = (rows[blur:] - rows[:-blur]) / blur
+        else:
+            output[...] = self._scene[top:top + height]
+        self.frames_captured += 1
+
+    def close(self):
+        pass
+
+
+class SimulatedSenseStick(SenseStick):
+    '''
+    Stands in for the SenseHAT joystick, playing back a scripted series of key presses
+    '''
+
+    def __init__(self, flight, script, debounce=r.STICK_DEBOUNCE_SECONDS):
+
+        self.flight = flight
+        self.script = list(script)      # (delay in seconds, key) for each key press
+        self._next_press = None         # Clock time of the next press of the script, once it has started
+        self._init_events(debounce)
+
+    def close(self):
+        self.stop()
+
+    def __iter__(self):
+        while self.script or self._pending:
+            yield self.read()
+
+    def read(self):
+        if not self.script and not self._pending:
+            raise StopIteration
+        return super(SimulatedSenseStick, self).read()
+
+    def _poll(self, timeout):
+        # The timeout is in real seconds, as it is for the real device; the script is played back on the flight clock
+        if not self.script:
+            if timeout is not None:
+                time.sleep(timeout)
+            return False
+        clock = self.flight.clock
+        if self._next_press is None:
+            self._next_press = clock.time() + self.script[0][0]
+        wait = (self._next_press - clock.time()) / clock.time_warp
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(wait, 0))
+        return True
+
+    def _latency(self, event):
+        clock = self.flight.clock
+        return (clock.time() - event.timestamp) / clock.time_warp
+
+    def _read_pending(self):
+        _, key = self.script.pop(0)
+        self._next_press = None
+        logger.debug("Simulated joystick press: %s", key)
+        now = self.flight.clock.time()
+        return [InputEvent(now, key, self.STATE_PRESS), InputEvent(now, key, self.STATE_RELEASE)]
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Background reading of the DS18B20 1-Wire thermometers (developing tray, film cartridge, battery and ambient)
+
+A DS18B20 takes ~750ms to convert each reading, during which a read of its w1_slave file blocks. The sampler reads the
+thermometers on a background thread through handles that are kept open, and publishes the latest timestamped
+temperature of each named channel so that the thermostat never has to wait for a sensor.
+'''
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Recorder import flight_recorder
+from Utils.Polaroid_Scheduler import PeriodicTask
+from Utils.Polaroid_Timing import timings
+
+logger = logging.getLogger('polaroid.thermometer')
+
+DS18B20_FAMILY = '28-'                  # 1-Wire family code that the IDs of DS18B20 thermometers start with
+POWER_ON_RESET_MILLIDEGREES = 85000     # Reported by a DS18B20 that has been reset rather than taken a reading
+
+
+def parse_w1_slave(data):
+    ''' Extracts the temperature from the output of a DS18B20 w1_slave file
+
+    The output is two lines, the first ending 'YES' if the CRC of the reading is good and the second ending 't='
+    followed by the temperature in thousandths of a degree, e.g.
+
+        72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        72 01 4b 46 7f ff 0e 10 57 t=23125
+
+    :param data: The text of the w1_slave file
+    :return: The temperature in celsius, or None if the reading is bad
+    '''
+
+    end_of_crc_line = data.find('\n')
+    if end_of_crc_line < 3 or data[end_of_crc_line - 3:end_of_crc_line] != 'YES':
+        return None
+
+    start = data.find('t=', end_of_crc_line)
+    if start == -1:
+        return None
+    end = data.find('\n', start)
+
+    try:
+        millidegrees = int(data[start + 2:end if end != -1 else len(data)])
+    except ValueError:
+        return None
+
+    if millidegrees == POWER_ON_RESET_MILLIDEGREES:
+        return None
+    return millidegrees / 1000.0
+
+
+class Thermometer(object):
+    '''
+    A DS18B20 on the 1-Wire bus, read through a handle that is kept open between readings
+    '''
+
+    def __init__(self, device_id, name=None):
+
+        self.device_id = device_id
+        self.name = name or device_id   # The channel the thermometer's readings are published under
+        self.latest = None              # (timestamp, temperature) of the most recent good reading
+        self.error_count = 0            # Number of reads that failed after every attempt
+
+        self._channel = flight_recorder.channel('temperature_' + self.name, ('celsius',))
+        self._handle = None
+        self._handle_lock = threading.Lock()
+
+    @timings.timed('thermometer_read')
+    def read(self):
+        ''' Takes a reading from the thermometer, blocking while the sensor converts it
+
+        A reading with a bad CRC is retried up to r.THERMOMETER_READ_ATTEMPTS times.
+
+        :return: The temperature in celsius
+        '''
+
+        error = None
+        with self._handle_lock:
+            for _ in range(r.THERMOMETER_READ_ATTEMPTS):
+                try:
+                    if self._handle is None:
+                        self._handle = hardware.open_w1_slave(self.device_id)
+                    self._handle.seek(0)
+                    data = self._handle.read()
+                except (IOError, OSError), e:
+                    self._close_handle()        # The device may have dropped off the bus, so reopen it next time
+                    error = e
+                    continue
+
+                temperature = parse_w1_slave(data)
+                if temperature is not None:
+                    self.latest = (hardware.clock.time(), temperature)
+                    flight_recorder.record(self._channel, self.latest[0], (temperature,))
+                    return temperature
+                error = "bad reading: {!r}".format(data)
+
+        self.error_count += 1
+        raise IOError("Unable to read thermometer {} ({})".format(self.device_id, error))
+
+    def close(self):
+        with self._handle_lock:
+            self._close_handle()
+
+    def _close_handle(self):
+        if self._handle is not None:
+            try:
+                self._handle.close()
+            except (IOError, OSError):
+                pass
+            self._handle = None
+
+
+def discover_thermometers(channels=None):
+    ''' Finds the DS18B20 thermometers on the 1-Wire bus
+
+    :param channels: Dict of channel names by device ID (r.THERMOMETER_CHANNELS if None); thermometers that aren't
+                     listed are named by their device ID
+    :return: List of Thermometer
+    '''
+
+    if channels is None:
+        channels = r.THERMOMETER_CHANNELS
+
+    device_ids = hardware.discover_w1_devices(DS18B20_FAMILY)
+    for device_id, name in sorted(channels.items()):
+        if device_id not in device_ids:
+            logger.warning("Thermometer '%s' (%s) not found on the 1-Wire bus", name, device_id)
+
+    thermometers = [Thermometer(device_id, channels.get(device_id)) for device_id in device_ids]
+    logger.info("Thermometers found: %s",
+                ", ".join("{} ({})".format(t.name, t.device_id) for t in thermometers) or "none")
+    return thermometers
+
+
+class ThermometerSampler(object):
+    '''
+    Reads a set of thermometers at a fixed rate on a background thread, keeping the latest reading of each channel
+
+    The thermometers are read concurrently by a small pool of threads, so that each pass takes about as long as one
+    conversion however many probes are fitted.
+    '''
+
+    def __init__(self, thermometers, period=r.THERMOMETER_SAMPLE_PERIOD, threads=r.THERMOMETER_READ_THREADS):
+
+        self.thermometers = list(thermometers)
+        self.channels = dict((thermometer.name, thermometer) for thermometer in self.thermometers)
+        self.period = period
+        self.threads = threads
+
+        self._pool = None
+        self._task = None
+        self._open_pool()           # So the first read_all, before the sampler is started, is in parallel too
+
+    def _open_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(max(min(self.threads, len(self.thermometers)), 1))
+
+    def read(self, channel):
+        ''' Takes a reading from one channel, blocking while the sensor converts it
+
+        :return: The temperature in celsius
+        '''
+
+        thermometer = self.channels.get(channel)
+        if thermometer is None:
+            raise IOError("No thermometer on channel '{}'".format(channel))
+        return thermometer.read()
+
+    def read_all(self):
+        ''' Takes a reading from every channel at once
+
+        :return: Dict of the temperature in celsius (or None if the read failed) by channel
+        '''
+
+        if self._pool is not None:
+            temperatures = self._pool.map(self._read_quietly, self.thermometers)
+        else:
+            temperatures = [self._read_quietly(thermometer) for thermometer in self.thermometers]
+
+        readings = dict((t.name, temperature) for t, temperature in zip(self.thermometers, temperatures))
+        logger.info("Temperatures: %s", ", ".join("{}={}".format(name, readings[name]) for name in sorted(readings)))
+        return readings
+
+    @staticmethod
+    def _read_quietly(thermometer):
+        try:
+            return thermometer.read()
+        except IOError, e:
+            logger.error("Error message: %s", e)
+            return None
+
+    def start(self):
+        if self._task is None:
+            self._open_pool()
+            self._task = PeriodicTask('thermometers', self.read_all, self.period)
+            self._task.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.stop()
+            self._task.join()
+            self._task = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for thermometer in self.thermometers:
+            thermometer.close()
+
+    def is_running(self):
+        return self._task is not None
+
+    @property
+    def error_count(self):
+        return sum(thermometer.error_count for thermometer in self.thermometers)
+
+    def latest(self, channel):
+        ''' Returns the latest (timestamp, temperature) reading of a channel, or None if there hasn't been one '''
+
+        thermometer = self.channels.get(channel)
+        return thermometer.latest if thermometer is not None else None
+
+    def age(self, channel):
+        ''' Returns the seconds since the latest good reading of a channel, or None if there hasn't been one '''
+
+        latest = self.latest(channel)
+        if latest is None:
+            return None
+        return hardware.clock.time() - latest[0]
+
+    def is_stale(self, channel, max_age=r.THERMOMETER_STALE_SECONDS):
+        ''' Returns True if there hasn't been a good reading of a channel for max_age seconds
+
+        As with the IMU sampler, the age is judged in real time so that a large time warp isn't mistaken for a failed
+        sensor.
+        '''
+
+        age = self.age(channel)
+        return age is None or age > max_age * hardware.clock.time_warp
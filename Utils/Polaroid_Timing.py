@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Timing of the hot paths of the payload (sensor reads, the screen and the shutter)
+
+Each instrumented method counts its calls and errors, and adds how long each call took to a histogram with fixed
+bucket edges (r.TIMING_BUCKETS_MS), so timing a call costs two reads of the time and a bisect into a short list, and
+the memory used doesn't grow over the flight. Methods are instrumented with the timed decorator, e.g.
+
+    @timings.timed('pressure')
+    def get_pressure(self):
+
+Times are in real seconds, so under the time warp of the simulated backend the sleeps of the mission clock (such as
+the shutter pulse) are shortened by the warp.
+'''
+
+import bisect
+import functools
+import logging
+import threading
+import time
+
+import Polaroid_Reference as r
+from Utils.Polaroid_Scheduler import PeriodicTask
+
+logger = logging.getLogger('polaroid.timing')
+
+
+def _format_ms(ms):
+    return '{:.0f}ms'.format(ms) if ms >= 10 else '{:.2g}ms'.format(ms)
+
+
+class LatencyHistogram(object):
+    '''
+    Counts the calls of one method by how long they took, in buckets with fixed edges
+    '''
+
+    def __init__(self, name, buckets=r.TIMING_BUCKETS_MS):
+
+        self.name = name
+        self.edges = tuple(buckets)                 # Upper edge in milliseconds of each bucket but the last
+        self.counts = [0] * (len(self.edges) + 1)   # The last bucket counts the calls longer than every edge
+        self.calls = 0
+        self.errors = 0                             # Number of calls that raised an exception
+        self.total = 0.0                            # Milliseconds spent in the calls
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, ms, error=False):
+        ''' Adds a call that took ms milliseconds '''
+
+        bucket = bisect.bisect_left(self.edges, ms)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.calls += 1
+            self.total += ms
+            if ms > self.max:
+                self.max = ms
+            if error:
+                self.errors += 1
+
+    def percentile(self, percentile):
+        ''' Returns the upper edge of the bucket holding the given percentile of the calls (the slowest call if it's
+        beyond every edge), or None if there have been no calls
+        '''
+
+        with self._lock:
+            counts, calls, longest = list(self.counts), self.calls, self.max
+        if not calls:
+            return None
+
+        target = calls * percentile / 100.0
+        cumulative = 0
+        for edge, count in zip(self.edges, counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(edge, longest)
+        return longest
+
+    def mean(self):
+        return self.total / self.calls if self.calls else None
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.edges) + 1)
+            self.calls = self.errors = 0
+            self.total = self.max = 0.0
+
+    def summary(self):
+        ''' Returns a line of text of the calls, errors and latencies '''
+
+        if not self.calls:
+            return '{}: no calls'.format(self.name)
+        return '{}: {} calls, {} errors, mean {}, p50 {}, p95 {}, max {}'.format(
+            self.name, self.calls, self.errors, _format_ms(self.mean()), _format_ms(self.percentile(50)),
+            _format_ms(self.percentile(95)), _format_ms(self.max))
+
+
+class Timings(object):
+    '''
+    The latency histograms of the payload by name, which can be logged periodically
+    '''
+
+    def __init__(self):
+
+        self.enabled = r.TIMING_ENABLED
+        self._histograms = {}
+        self._order = []                    # Names in the order the histograms were created
+        self._lock = threading.Lock()
+        self._task = None
+
+    def histogram(self, name):
+        ''' Returns the histogram with the given name, creating it the first time it is asked for '''
+
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = LatencyHistogram(name)
+                    self._histograms[name] = histogram
+                    self._order.append(name)
+        return histogram
+
+    def timed(self, name):
+        ''' Decorator that times each call of a function into the histogram with the given name '''
+
+        def decorator(function):
+            histogram = self.histogram(name)
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                started = time.time()
+                error = True
+                try:
+                    result = function(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    histogram.add((time.time() - started) * 1000, error)
+            return timed_function
+        return decorator
+
+    def histograms(self):
+        ''' Returns the histograms in the order they were created '''
+
+        return [self._histograms[name] for name in list(self._order)]
+
+    def log(self):
+        ''' Logs a summary of every histogram that has had a call '''
+
+        for histogram in self.histograms():
+            if histogram.calls:
+                logger.info("Timing %s", histogram.summary())
+
+    def short_summary(self):
+        ''' Returns the 95th percentile of each histogram that has had a call, short enough to scroll on the screen '''
+
+        return ' '.join('{} {}'.format(histogram.name, _format_ms(histogram.percentile(95)))
+                        for histogram in self.histograms() if histogram.calls) or 'No timings'
+
+    def reset(self):
+        for histogram in self.histograms():
+            histogram.reset()
+
+    def start_logging(self, period=r.TIMING_LOG_SECONDS):
+        ''' Logs the summary every period seconds of the mission clock until stop_logging '''
+
+        if self._task is None:
+            self._task = PeriodicTask('timings', self.log, period)
+            self._task.start()
+
+    def stop_logging(self):
+        ''' Stops the periodic logging and logs the summary one last time '''
+
+        if self._task is not None:
+            self._task.stop()
+            self._task.join()
+            self._task = None
+        self.log()
+
+
+timings = Timings()             # The timings of every part of the payload
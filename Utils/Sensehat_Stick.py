@@ -9,6 +9,11 @@ Also works when VNC'd into the RPi
 Code taken from:                https://github.com/waveform80/pisense/blob/master/pisense/Sensehat_Stick.py
 Implementation example from :   https://github.com/RPi-Distro/python-sense-hat/issues/11
 
+Events are read in bulk: once epoll reports the device readable, everything pending is drained with one read and
+decoded in a single pass over the buffer. Presses of a key that come within the debounce time of the previous press of
+the same key are ignored. Callbacks can be registered for keys and run by a listener thread (see start), which records
+the latency from each event to its handlers being called.
+
 '''
 
 from __future__ import (
@@ -23,19 +28,24 @@ str = type('')
 import io
 import os
 import glob
+import time
 import errno
 import struct
 import select
-from collections import namedtuple
-#from threading import Thread, Event
+import logging
+import threading
+from collections import deque, namedtuple
 
 InputEvent = namedtuple('InputEvent', ('timestamp', 'key', 'state'))
 
+logger = logging.getLogger('polaroid.stick')
+
 class SenseStick(object):
 
     SENSE_HAT_EVDEV_NAME = 'Raspberry Pi Sense HAT Joystick'
     EVENT_FORMAT = native_str('llHHI')
     EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+    EVENT_STRUCT = struct.Struct(EVENT_FORMAT)
 
     EV_KEY = 0x01
 
@@ -49,10 +59,29 @@ class SenseStick(object):
     KEY_DOWN = 108
     KEY_ENTER = 28
 
-    def __init__(self):
-        self._stick_file = io.open(self._stick_device(), 'rb')
+    MAX_EVENTS = 64             # Most events drained by one read of the device
+    LISTENER_TIMEOUT = 0.1      # Seconds the listener waits for events before checking whether it has been stopped
+    LATENCY_HISTORY = 256       # Number of recent event-to-handler latencies kept
+
+    def __init__(self, debounce=0.0):
+        self._stick_file = io.open(self._stick_device(), 'rb', buffering=0)
+        self._epoll = select.epoll()
+        self._epoll.register(self._stick_file.fileno(), select.EPOLLIN)
+        self._init_events(debounce)
+
+    def _init_events(self, debounce):
+        self.debounce = debounce            # Seconds after a press in which another press of the key is ignored
+        self.ignored_presses = 0
+        self.latencies = deque(maxlen=self.LATENCY_HISTORY)    # Seconds from each event to its handlers being called
+        self._pending = deque()             # Events read from the device but not yet returned
+        self._last_press = {}               # Timestamp of the last press of each key that wasn't ignored
+        self._callbacks = []
+        self._listener = None
+        self._listener_stop = threading.Event()
 
     def close(self):
+        self.stop()
+        self._epoll.close()
         self._stick_file.close()
 
     def __enter__(self):
@@ -63,10 +92,7 @@ class SenseStick(object):
 
     def __iter__(self):
         while True:
-            event = self._stick_file.read(self.EVENT_SIZE)
-            (tv_sec, tv_usec, type, code, value) = struct.unpack(self.EVENT_FORMAT, event)
-            if type == self.EV_KEY:
-                yield InputEvent(tv_sec + (tv_usec / 1000000), code, value)
+            yield self.read()
 
     def _stick_device(self):
         for evdev in glob.glob('/sys/class/input/event*'):
@@ -79,10 +105,112 @@ class SenseStick(object):
                     raise
         raise RuntimeError('unable to locate SenseHAT joystick device')
 
+    def _poll(self, timeout):
+        # Waits up to timeout seconds (forever if None) for the device to have events to read
+        while True:
+            try:
+                return bool(self._epoll.poll(-1 if timeout is None else timeout))
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    def _read_pending(self):
+        # Drains the events waiting on the device, decoding the whole read in one pass
+        data = os.read(self._stick_file.fileno(), self.EVENT_SIZE * self.MAX_EVENTS)
+        return self._decode(data)
+
+    def _decode(self, data):
+        view = memoryview(data)
+        unpack_from = self.EVENT_STRUCT.unpack_from
+        events = []
+        for offset in range(0, len(data) - self.EVENT_SIZE + 1, self.EVENT_SIZE):
+            (tv_sec, tv_usec, type, code, value) = unpack_from(view, offset)
+            if type == self.EV_KEY:
+                events.append(InputEvent(tv_sec + (tv_usec / 1000000), code, value))
+        return events
+
+    def _accept(self, event):
+        # Debounces presses, which would otherwise come through twice when the stick is pressed quickly or bounces
+        if event.state != self.STATE_PRESS:
+            return True
+        last = self._last_press.get(event.key)
+        if last is not None and event.timestamp - last < self.debounce:
+            self.ignored_presses += 1
+            return False
+        self._last_press[event.key] = event.timestamp
+        return True
+
+    def read_events(self, timeout=None):
+        ''' Returns every event waiting, after waiting up to timeout seconds (forever if None) for there to be one
+
+        :return: List of InputEvent, oldest first (empty if the timeout expired)
+        '''
+
+        self.wait(timeout)
+        events = list(self._pending)
+        self._pending.clear()
+        return events
+
     def read(self):
-        return next(iter(self))
+        while not self.wait():
+            pass
+        return self._pending.popleft()
 
     def wait(self, timeout=None):
-        # XXX Use poll() instead?
-        r, w, x = select.select([self._stick_file], [], [], timeout)
-        return bool(r)
\ No newline at end of file
+        if not self._pending and self._poll(timeout):
+            self._pending.extend(event for event in self._read_pending() if self._accept(event))
+        return bool(self._pending)
+
+    def add_callback(self, callback, key=None, state=STATE_PRESS):
+        ''' Calls callback(event) from the listener thread for each event of a key and state
+
+        :param callback: Function taking the InputEvent
+        :param key: The key to call it for (every key if None)
+        :param state: The state to call it for (every state if None)
+        '''
+
+        self._callbacks.append((key, state, callback))
+
+    def clear_callbacks(self):
+        del self._callbacks[:]
+
+    def _latency(self, event):
+        # Real seconds since the event; the kernel timestamps events with the time of day
+        return time.time() - event.timestamp
+
+    def _dispatch(self, event):
+        self.latencies.append(self._latency(event))
+        for key, state, callback in list(self._callbacks):
+            if (key is None or key == event.key) and (state is None or state == event.state):
+                try:
+                    callback(event)
+                except Exception as e:
+                    logger.error(native_str("Error handling joystick event %s"), event)
+                    logger.error(native_str("Error message: %s"), e)
+
+    def _listen(self):
+        while not self._listener_stop.is_set():
+            for event in self.read_events(self.LISTENER_TIMEOUT):
+                self._dispatch(event)
+
+    def start(self):
+        ''' Starts calling the registered callbacks for each event, from a background thread
+
+        The events are no longer returned by read or iteration while the listener is running.
+        '''
+
+        if self._listener is None:
+            self._listener_stop.clear()
+            self._listener = threading.Thread(target=self._listen, name='joystick')
+            self._listener.daemon = True
+            self._listener.start()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener_stop.set()
+            self._listener.join()
+            self._listener = None
+            if self.latencies:
+                logger.info(native_str("Joystick listener stopped (latency mean %.1fms, max %.1fms over %s events, "
+                                       "%s presses debounced)"), 1000 * sum(self.latencies) / len(self.latencies),
+                            1000 * max(self.latencies), len(self.latencies), self.ignored_presses)
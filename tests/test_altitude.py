@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the estimate of the altitude and ascent rate
+'''
+
+import math
+import unittest
+
+import numpy
+
+from Polaroid_Altitude import AltitudeEstimator, pressure_at_altitude
+from Utils.Polaroid_Sampler import RingBuffer
+
+ASCENT_RATE = 5.0           # Metres per second
+UPDATE_PERIOD = 0.1         # Seconds between barometer readings
+IMU_SAMPLES = 10            # IMU samples between barometer readings
+SWING_AMPLITUDE = 0.5       # Radians either side of the vertical
+SWING_PERIOD = 3.0          # Seconds
+SCALE_ERROR = 1.02          # Factor the accelerometer over-reads by
+
+
+def swinging_payload(seconds, start_altitude=5000.0, seed=1):
+    ''' Yields (time, pressure, IMU rows) of a payload ascending steadily while it swings under the balloon
+
+    Hanging from the balloon, the accelerometer only feels the pull of the line, which is g (3 cos θ - 2 cos θ0) for
+    a swing of amplitude θ0, so the magnitude it measures is more than 1g on average even though the payload isn't
+    accelerating vertically.
+    '''
+
+    random = numpy.random.RandomState(seed)
+    for step in range(int(seconds / UPDATE_PERIOD)):
+        now = step * UPDATE_PERIOD
+        rows = []
+        for sample in range(IMU_SAMPLES):
+            t = now - UPDATE_PERIOD + (sample + 1) * UPDATE_PERIOD / IMU_SAMPLES
+            angle = SWING_AMPLITUDE * math.cos(2 * math.pi * t / SWING_PERIOD)
+            pull = (3 * math.cos(angle) - 2 * math.cos(SWING_AMPLITUDE)) * SCALE_ERROR + random.normal(0, 0.02)
+            rows.append((t, pull * math.sin(angle), 0.0, pull * math.cos(angle), 0.0, 0.0, 0.0))
+        pressure = pressure_at_altitude(start_altitude + ASCENT_RATE * now) + random.normal(0, 0.1)
+        yield now, pressure, rows
+
+
+class AltitudeEstimatorTest(unittest.TestCase):
+
+    def test_swinging_payload_does_not_drift_the_ascent_rate(self):
+        imu = RingBuffer(100, 6)
+        estimator = AltitudeEstimator(None, imu_buffer=imu)
+
+        rates = []
+        for now, pressure, rows in swinging_payload(900):
+            for row in rows:
+                imu.append(row[0], row[1:])
+            estimate = estimator.update(pressure, now)
+            if now >= 600:
+                rates.append(estimate.ascent_rate)
+
+        self.assertAlmostEqual(numpy.mean(rates), ASCENT_RATE, delta=0.5)
+        self.assertLess(numpy.std(rates), 1.0)
+        self.assertFalse(estimate.burst)
+
+
+if __name__ == '__main__':
+    unittest.main()
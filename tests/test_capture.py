@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the ring of frames captured from the Pi camera
+'''
+
+import unittest
+
+from Utils.Polaroid_Capture import FrameRing
+
+RESOLUTION = (4, 3)
+
+
+class FakeSource(object):
+    ''' Frame source that fills each frame with its number, and can call back while a frame is being exposed '''
+
+    resolution = RESOLUTION
+
+    def __init__(self, during_capture=None):
+        self.frames = 0
+        self.during_capture = during_capture
+
+    def capture(self, output):
+        self.frames += 1
+        output[...] = self.frames % 256
+        if self.during_capture is not None:
+            self.during_capture()
+
+
+class FrameRingTest(unittest.TestCase):
+
+    def test_frames_read_back_until_overwritten(self):
+        ring = FrameRing(3, RESOLUTION)
+        source = FakeSource()
+        for timestamp in range(5):
+            ring.capture(source, timestamp)
+
+        self.assertIsNone(ring.get(2))
+        self.assertEqual(ring.get(3).image[0, 0, 0], 3)
+        self.assertEqual(ring.numbers_since(0), [3, 4, 5])
+        self.assertEqual(ring.numbers_since(4), [5])
+
+    def test_oldest_frame_is_gone_while_it_is_overwritten(self):
+        ring = FrameRing(3, RESOLUTION)
+        seen = {}
+
+        def read_oldest():
+            seen['get'] = ring.get(1)
+            seen['view'] = ring.view(1)
+            seen['current'] = ring.is_current(1)
+            seen['numbers'] = ring.numbers_since(0)
+
+        source = FakeSource()
+        for timestamp in range(3):
+            ring.capture(source, timestamp)
+        self.assertIsNotNone(ring.get(1))
+
+        source.during_capture = read_oldest     # The fourth frame is exposed into the slot of the first
+        ring.capture(source, 3)
+
+        self.assertIsNone(seen['get'])
+        self.assertIsNone(seen['view'])
+        self.assertFalse(seen['current'])
+        self.assertEqual(seen['numbers'], [2, 3])
+        self.assertEqual(ring.numbers_since(0), [2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
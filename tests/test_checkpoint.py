@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the checkpoint of the mission
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import Polaroid_Reference as r
+from Utils import Polaroid_Hardware as hardware
+from Utils.Polaroid_Checkpoint import MissionCheckpoint, PHASE_ASCENT, PHASE_PHOTOS
+
+
+class MissionCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.checkpoint = MissionCheckpoint(os.path.join(self.folder, 'mission.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def save_at(self, saved_at):
+        # Saves a checkpoint, then rewrites the time it was saved
+        self.checkpoint.save(PHASE_PHOTOS, photos_taken=3)
+        with open(self.checkpoint.path, 'r') as f:
+            state = json.load(f)
+        state['saved_at'] = saved_at
+        with open(self.checkpoint.path, 'w') as f:
+            json.dump(state, f)
+        return self.checkpoint.load()
+
+    def test_recent_checkpoint_is_resumed(self):
+        self.assertTrue(self.checkpoint.save(PHASE_ASCENT, photos_taken=0))
+        state = self.checkpoint.load()
+        self.assertEqual(state['phase'], PHASE_ASCENT)
+        self.assertTrue(self.checkpoint.is_resumable(state))
+
+    def test_stale_checkpoint_is_ignored(self):
+        state = self.save_at(hardware.clock.time() - r.CHECKPOINT_MAX_AGE_SECONDS - 60)
+        self.assertEqual(state['photos_taken'], 3)
+        self.assertFalse(self.checkpoint.is_resumable(state))
+
+    def test_checkpoint_saved_in_the_future_is_ignored(self):
+        state = self.save_at(hardware.clock.time() + r.CHECKPOINT_MAX_CLOCK_SKEW_SECONDS + 60)
+        self.assertFalse(self.checkpoint.is_resumable(state))
+
+    def test_cleared_checkpoint_is_not_resumed(self):
+        self.checkpoint.save(PHASE_PHOTOS, photos_taken=8)
+        self.assertTrue(self.checkpoint.clear())
+        self.assertIsNone(self.checkpoint.load())
+        self.assertFalse(self.checkpoint.is_resumable(self.checkpoint.load()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the planning of the photos over the altitude window
+'''
+
+import unittest
+
+import Polaroid_Reference as r
+from Polaroid_Altitude import AltitudeEstimate
+from Polaroid_Planner import ShotPlanner
+from Utils import Polaroid_Hardware as hardware
+
+
+class FakeEstimator(object):
+    ''' Altitude estimator that returns a fixed estimate '''
+
+    def __init__(self, estimate):
+        self.estimate = estimate
+
+    def latest(self):
+        return self.estimate
+
+
+class FakePayload(object):
+
+    def __init__(self, altitude, ascent_rate, burst=False):
+        self.altitude_estimator = FakeEstimator(AltitudeEstimate(hardware.clock.time(), altitude, ascent_rate,
+                                                                 0.0, burst))
+
+
+class ShotPlannerTest(unittest.TestCase):
+
+    def planner(self, altitude, ascent_rate=5.0, burst=False):
+        return ShotPlanner(FakePayload(altitude, ascent_rate, burst), burst_altitude=30000, min_interval=30,
+                           max_interval=600)
+
+    def test_last_shot_has_time_to_wait_within_the_window(self):
+        planner = self.planner(altitude=30000 - 5.0 * 285 / r.PLANNER_WINDOW_MARGIN)
+        now = hardware.clock.time()
+        plan = planner.plan(1, last_shot=now)
+
+        self.assertAlmostEqual(plan.window_remaining, 285, delta=1)
+        self.assertGreater(plan.deadline - plan.due, 0)
+        self.assertLessEqual(plan.deadline, now + plan.window_remaining + 1)
+
+    def test_shots_are_spread_with_a_gap_after_the_last(self):
+        planner = self.planner(altitude=30000 - 5.0 * 600 / r.PLANNER_WINDOW_MARGIN)
+        now = hardware.clock.time()
+        plan = planner.plan(3, last_shot=now)
+
+        self.assertAlmostEqual(plan.interval, 150, delta=1)
+        self.assertAlmostEqual(plan.due - now, 150, delta=1)
+        self.assertAlmostEqual(plan.deadline - plan.due, 150 * r.PLANNER_DEADLINE_FRACTION, delta=1)
+
+    def test_shots_after_a_burst_still_have_time_to_wait(self):
+        planner = self.planner(altitude=29000, ascent_rate=-20.0, burst=True)
+        now = hardware.clock.time()
+        plan = planner.plan(4, last_shot=now)
+
+        self.assertEqual(plan.window_remaining, 0.0)
+        self.assertEqual(plan.interval, 30)
+        self.assertAlmostEqual(plan.due - now, 30, delta=1)
+        self.assertAlmostEqual(plan.deadline - plan.due, 30 * r.PLANNER_DEADLINE_FRACTION, delta=1)
+        self.assertAlmostEqual(planner.relaxation(plan), 1.0)
+
+    def test_unknown_window_uses_the_fixed_interval(self):
+        planner = self.planner(altitude=10000, ascent_rate=0.0)
+        plan = planner.plan(5, last_shot=None)
+
+        self.assertIsNone(plan.window_remaining)
+        self.assertEqual(plan.interval, r.PHOTOS_INTERVAL_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
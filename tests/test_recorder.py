@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the binary flight data recorder
+'''
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from Utils.Polaroid_Recorder import FILE_EXTENSION, FlightRecorder, read_recordings
+
+PART_SIZE = 64 * 1024
+
+
+class FlightRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.recorder = FlightRecorder()
+        self.channel = self.recorder.channel('imu', ('ax', 'ay', 'az'))
+
+    def tearDown(self):
+        self.recorder.close()
+        shutil.rmtree(self.folder)
+
+    def test_readings_carry_on_across_files(self):
+        self.recorder.open(self.folder, size=PART_SIZE, flush_period=3600)
+        for i in range(10000):
+            self.recorder.record(self.channel, i, (i, 0, 1))
+            if i % 1000 == 0:
+                self.recorder.flush()
+        self.recorder.close()
+
+        paths = sorted(glob.glob(os.path.join(self.folder, '*' + FILE_EXTENSION)))
+        self.assertGreater(len(paths), 2)
+        readings = read_recordings(paths)['imu']
+        self.assertEqual(self.recorder.dropped_records, 0)
+        self.assertEqual(list(readings['time']), range(10000))
+
+    def test_unused_preallocated_file_is_removed(self):
+        self.recorder.open(self.folder, size=PART_SIZE, flush_period=3600)
+        for i in range(PART_SIZE // 2 // self.channel.record.size + 1):
+            self.recorder.record(self.channel, i, (i, 0, 1))
+        self.recorder.close()
+
+        self.assertEqual(len(glob.glob(os.path.join(self.folder, '*' + FILE_EXTENSION))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()